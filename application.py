@@ -16,13 +16,27 @@ from datetime import datetime
 import plotly.express as px
 import plotly.graph_objects as go
 import smtplib
-from flask import json, jsonify, Flask, abort
+import uuid
+import click
+from flask import json, jsonify, Flask, abort, Response, stream_with_context
 from flask import render_template, session, url_for, flash, redirect, request, Flask
 from flask_mail import Mail
 from flask_pymongo import PyMongo
 from tabulate import tabulate
 from achievements import updateAchievments, getAchievements
 from insights import get_insights
+from user_summary import (
+    ensure_summary_index,
+    get_summary,
+    render_summary,
+    record_calories,
+    record_water,
+    record_enrolled,
+    record_unenrolled,
+    record_completed,
+    invalidate_summary,
+    SUMMARY_CACHE_SECONDS,
+)
 from forms import (
     HistoryForm,
     RegistrationForm,
@@ -45,7 +59,11 @@ import threading
 import atexit
 import signal
 import sys
-from rag_burnbot import bot_response, initialize_rag
+from rag_burnbot import bot_response, rag_service, BATCH_MAX_QUESTIONS, build_index_artifact
+from rag_burnbot import BATCH_USERS, BATCH_DEADLINE, BATCH_CONCURRENCY
+from rag_burnbot import chat_pool, generator, ChatOverloaded, CHAT_RETRY_AFTER
+from rag_burnbot import query_embedding_cache, query_encoder
+from rag_burnbot import warmup, CHAT_WARMUP_WAIT, WARMUP_ON_START, is_personal_query, cpu_threads
 
 # Set project root directory for standardization.
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -68,6 +86,7 @@ mail = Mail(app)
 
 insertfooddata()
 insertexercisedata()
+ensure_summary_index(mongo.db)
 
 
 def close_db_connection():
@@ -121,6 +140,17 @@ def reminder_email():
 schedule.every().day.at("08:00").do(reminder_email)
 
 
+@app.before_first_request
+def start_burnbot_warmup():
+    """
+    start_burnbot_warmup() loads the BurnBot models and index in the
+    background once the app is serving, when BURNBOT_WARMUP=1. Importing the
+    app, as tests and the flask CLI do, never starts it.
+    """
+    if WARMUP_ON_START:
+        warmup.start()
+
+
 @app.route("/", methods=["GET", "POST"])
 @app.route("/home")
 def home():
@@ -178,6 +208,7 @@ def logout():
     route "/logout" will redirect to logout() function.
     Output: session clear
     """
+    rag_service.memory.forget(session.get("burnbot_conversation"))
     session.clear()
     return redirect(url_for("login"))
 
@@ -281,6 +312,8 @@ def calories():
                             "burnout": int(burn),
                         }
                     )
+                record_calories(email, mongo.db, cals, burn)
+                forget_chat_profile()
                 flash(f"Successfully updated the data", "success")
                 return redirect(url_for("calories"))
     else:
@@ -470,12 +503,17 @@ def water():
         email = session.get("email")
         intake = request.form.get("intake")
         if request.method == "POST":
-
-            current_time = datetime.now()
-            # Insert the new record
-            mongo.db.intake_collection.insert_one(
-                {"intake": intake, "time": current_time, "email": email}
-            )
+            # The form asks for a positive number of ml, anything else is not logged
+            if not (intake or "").strip().isdigit() or int(intake) <= 0:
+                flash("Please enter your water intake in ml", "danger")
+            else:
+                current_time = datetime.now()
+                # Insert the new record
+                mongo.db.intake_collection.insert_one(
+                    {"intake": intake, "time": current_time, "email": email}
+                )
+                record_water(email, mongo.db, intake, current_time)
+                forget_chat_profile()
 
         # Retrieving records for the logged-in user
         records = mongo.db.intake_collection.find({"email": email}).sort("time", -1)
@@ -508,6 +546,8 @@ def clear_intake():
     if session.get("email"):
         email = session.get("email")
         mongo.db.intake_collection.delete_many({"email": email})
+        invalidate_summary(email, mongo.db)
+        forget_chat_profile()
 
         return redirect(url_for("water"))
     else:
@@ -986,6 +1026,8 @@ def activity_page(activity):
                     "Date": date.today().strftime("%Y-%m-%d"),
                 }
             )
+            record_enrolled(email, mongo.db, activity)
+            forget_chat_profile()
             flash(f"You have successfully enrolled in {activity}!", "success")
             print("Enrolled successfully")
 
@@ -994,6 +1036,8 @@ def activity_page(activity):
             mongo.db.user_activity.delete_one(
                 {"Email": email, "Activity": activity, "Status": "Enrolled"}
             )
+            record_unenrolled(email, mongo.db, activity)
+            forget_chat_profile()
             flash(f"You have successfully unenrolled from {activity}!", "success")
             # return redirect(url_for("activities"))
 
@@ -1009,6 +1053,8 @@ def activity_page(activity):
                     }
                 },
             )
+            record_completed(email, mongo.db, activity, achievement)
+            forget_chat_profile()
             flash(f"You have successfully completed {activity}!", "success")
             if achievement:
                 flash(f'Congratulations! You earned the "{achievement["name"]}" achievement!',"success")
@@ -1103,6 +1149,33 @@ def get_calories(food_item):
     return None
 
 
+def chat_calories(query, slots):
+    """
+    BurnBot handler for calorie questions, answered from the food collection.
+    """
+    food_item = slots.get("food")
+    if not food_item:
+        return None
+    calories = get_calories(food_item)
+    if calories:
+        return f"The calorie count for {food_item} is {calories} kcal."
+    return f"Sorry, I couldn't find the calorie count for {food_item}. Please check the spelling or try a different food item. Otherwise, enter 0 to go back to the menu."
+
+
+def chat_bmi(query, slots):
+    """
+    BurnBot handler for BMI questions, computed like the BMI calculator page.
+    """
+    if "weight" not in slots or slots["weight"] <= 0 or slots["height"] <= 0:
+        return "Tell me your weight and height, for example \"bmi 70 kg 175 cm\", and I'll calculate your BMI."
+    bmi = calc_bmi(slots["weight"], slots["height"])
+    return f"Your BMI is {bmi}, which is in the {get_bmi_category(bmi)} range."
+
+
+rag_service.router.register("calories", chat_calories)
+rag_service.router.register("bmi", chat_bmi)
+
+
 # bot_state = 0
 
 
@@ -1143,6 +1216,58 @@ def get_calories(food_item):
 #     )
 
 
+def chat_conversation_id():
+    """
+    chat_conversation_id() names this browser session's BurnBot conversation,
+    so follow-up questions are answered with the earlier turns in mind.
+    """
+    if "burnbot_conversation" not in session:
+        session["burnbot_conversation"] = uuid.uuid4().hex
+    return session["burnbot_conversation"]
+
+
+def chat_profile(message):
+    """
+    chat_profile() returns the logged-in user's fitness summary for BurnBot
+    when the message asks about the user's own data, and "" otherwise. The
+    rendered summary is kept in the session for SUMMARY_CACHE_SECONDS and
+    dropped by the routes that change the data behind it.
+    """
+    if not is_personal_query(message):
+        return ""
+    today = date.today().strftime("%Y-%m-%d")
+    cached = session.get("burnbot_profile")
+    if cached and cached["day"] == today and cached["expires"] > time.time():
+        return cached["text"]
+    text = render_summary(get_summary(session.get("email"), mongo.db))
+    session["burnbot_profile"] = {
+        "text": text,
+        "day": today,
+        "expires": time.time() + SUMMARY_CACHE_SECONDS,
+    }
+    return text
+
+
+def forget_chat_profile():
+    """
+    forget_chat_profile() drops the session's cached BurnBot summary after a
+    write, so the next personal question sees the new data.
+    """
+    session.pop("burnbot_profile", None)
+
+
+def chat_busy(message="BurnBot is busy, please try again shortly"):
+    """
+    chat_busy() is the fast reply used when BurnBot cannot take the request,
+    because its pool is full or it is still warming up, telling the client
+    when to retry instead of holding a web worker thread.
+    """
+    response = jsonify({"status": "error", "message": message})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(CHAT_RETRY_AFTER)
+    return response
+
+
 @app.route("/chat", methods=["POST"])
 def chat():
     email = session.get("email")
@@ -1153,12 +1278,143 @@ def chat():
     if not user_message:
         return jsonify({"status": "error", "message": "Message is required"}), 400
 
-    index, chunk_store = initialize_rag()
-    response = bot_response(user_message, index, chunk_store)
+    if not warmup.wait(CHAT_WARMUP_WAIT):
+        return chat_busy("BurnBot is warming up, please try again shortly")
+
+    profile = chat_profile(user_message)
+    try:
+        response = chat_pool.run(rag_service.answer, user_message, chat_conversation_id(), profile)
+    except ChatOverloaded:
+        return chat_busy()
     return jsonify({"response": response})
 
 
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """
+    chat_stream() answers like /chat but pushes the reply as Server-Sent Events
+    while it is being generated, finishing with a "done" event. The answer is
+    produced on the chat pool, so streams are shed like /chat requests.
+    """
+    email = session.get("email")
+    if not email:
+        return jsonify({"status": "error", "message": "User not logged in"}), 401
+
+    user_message = request.json.get("message", "")
+    if not user_message:
+        return jsonify({"status": "error", "message": "Message is required"}), 400
+
+    if not warmup.wait(CHAT_WARMUP_WAIT):
+        return chat_busy("BurnBot is warming up, please try again shortly")
+
+    profile = chat_profile(user_message)
+    try:
+        pieces = chat_pool.stream(rag_service.answer_stream, user_message,
+                                  chat_conversation_id(), profile)
+    except ChatOverloaded:
+        return chat_busy()
+
+    def generate():
+        try:
+            for piece in pieces:
+                yield f"data: {json.dumps({'token': piece})}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        finally:
+            # Stops the producer when the browser goes away mid-answer
+            pieces.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/chat/batch", methods=["POST"])
+def chat_batch():
+    """
+    chat_batch() answers a list of questions in one request, for the coaching
+    team to pre-generate FAQ answers. Answers come back in the order of the
+    questions together with the batch throughput; questions not started
+    within BATCH_DEADLINE seconds come back with no answer, to be resent.
+    """
+    email = session.get("email")
+    if not email:
+        return jsonify({"status": "error", "message": "User not logged in"}), 401
+    if email.lower() not in BATCH_USERS:
+        return jsonify({"status": "error", "message": "Batch answers are for the coaching team"}), 403
+
+    questions = request.json.get("questions")
+    if not isinstance(questions, list) or not questions:
+        return jsonify({"status": "error", "message": "A list of questions is required"}), 400
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return jsonify({
+            "status": "error",
+            "message": f"At most {BATCH_MAX_QUESTIONS} questions per batch",
+        }), 400
+    if not all(isinstance(question, str) and question.strip() for question in questions):
+        return jsonify({"status": "error", "message": "Questions must be non-empty text"}), 400
+
+    if not warmup.wait(CHAT_WARMUP_WAIT):
+        return chat_busy("BurnBot is warming up, please try again shortly")
+
+    try:
+        results, stats = chat_pool.run(rag_service.answer_batch, questions,
+                                       BATCH_CONCURRENCY, BATCH_DEADLINE)
+    except ChatOverloaded:
+        return chat_busy()
+    return jsonify({"results": results, "stats": stats})
+
+
+@app.route("/chat/ready", methods=["GET"])
+def chat_ready():
+    """
+    chat_ready() is the BurnBot readiness probe: 200 once the models and
+    index are loaded, 503 while they are warming up or if that failed.
+    """
+    status = warmup.status()
+    return jsonify(status), 503 if status["state"] in ("warming", "failed") else 200
+
+
+@app.route("/chat/metrics", methods=["GET"])
+def chat_metrics():
+    """
+    chat_metrics() reports the BurnBot chat pool (queue wait, execution
+    time, rejections), the query embedding cache and batching encoder, the
+    answer cache and single-flight counters, the generation backend counters
+    and the CPU thread budget of this worker as JSON.
+    """
+    if not session.get("email"):
+        return jsonify({"status": "error", "message": "User not logged in"}), 401
+
+    return jsonify({
+        "pool": chat_pool.stats(),
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "query_encoder": query_encoder.stats(),
+        "answer_cache": rag_service.answer_cache.stats(),
+        "single_flight": rag_service.single_flight.stats(),
+        "generation": generator.stats(),
+        "warmup": warmup.status(),
+        "cpu": cpu_threads.stats(),
+    })
+
+
+@app.cli.command("build-index")
+def build_index_command():
+    """
+    Builds and validates the BurnBot index artifact, so deploys can ship it
+    and set BURNBOT_PREBUILT_INDEX=1 to keep workers from embedding the corpus.
+    """
+    target, problems = build_index_artifact(rag_service.source, rag_service.index_dir)
+    for problem in problems:
+        click.echo(f"BurnBot index problem: {problem}", err=True)
+    if problems:
+        raise click.ClickException(f"BurnBot index {target} is invalid")
+    click.echo(f"BurnBot index {target}: ok")
+
+
 if __name__ == "__main__":
+    warmup.start()
     app.run(debug=True)
 
 @app.route('/recommender')
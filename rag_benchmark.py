@@ -0,0 +1,526 @@
+"""
+Copyright (c) 2025 Hank Lenham, Ryan McPhee, Lawrence Stephenson
+This code is licensed under MIT license (see LICENSE for details)
+
+@author: Burnout
+
+
+This python file is used in and is part of the Burnout project.
+It benchmarks the BurnBot retrieval indexes in rag_burnbot.py and evaluates
+the whole BurnBot pipeline against a labelled question set.
+
+Usage:
+    python rag_benchmark.py                     # vectors from ./data/data.docx
+    python rag_benchmark.py --synthetic 50000   # clustered random vectors
+    python rag_benchmark.py --types sq8,pq      # compressed stores against flat
+    python rag_benchmark.py --eval --json run.json   # recall, MRR, stage latency, throughput
+    python rag_benchmark.py --chunking --scale 200   # native chunker against langchain
+    python rag_benchmark.py --threads 1,2,4 --workers 4   # throughput per CPU thread budget
+
+For more information about the Burnout project, visit:
+https://github.com/CSC510-Spring25-Group14/FitnessApp
+"""
+
+import argparse
+import json
+import multiprocessing
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+import numpy as np
+from tabulate import tabulate
+import rag_burnbot
+
+# Index settings compared by default, flat is always the recall baseline
+DEFAULT_INDEX_CONFIGS = [
+    ("flat", {}),
+    ("hnsw", {"ef_search": 16}),
+    ("hnsw", {"ef_search": 64}),
+    ("hnsw", {"ef_search": 128}),
+    ("ivf_flat", {"nprobe": 1}),
+    ("ivf_flat", {"nprobe": 8}),
+    ("ivf_flat", {"nprobe": 32}),
+    ("ivf_pq", {"nprobe": 8}),
+    ("ivf_pq", {"nprobe": 32}),
+    ("sq8", {}),
+    ("pq", {"pq_m": 16}),
+    ("pq", {"pq_m": 48}),
+]
+
+# Labelled questions, each answer is a snippet found in the chunk that answers it
+EVAL_QUESTIONS_PATH = "./data/eval_questions.json"
+EVAL_STAGES = ("chunking", "encode", "search", "prompt", "generation")
+
+
+def percentile(samples, pct):
+    """
+    Returns the pct-th percentile of the samples, 0.0 when there are none.
+    """
+    if len(samples) == 0:
+        return 0.0
+    return float(np.percentile(np.asarray(samples), pct))
+
+
+def recall_at_k(truth, results, k):
+    """
+    Fraction of the true top-k neighbours that appear in the returned top-k,
+    averaged over all queries.
+    """
+    hits = 0
+    for expected, found in zip(truth, results):
+        hits += len(set(expected[:k]) & set(found[:k]))
+    return hits / float(k * len(truth)) if len(truth) else 0.0
+
+
+def index_memory(index):
+    """
+    Bytes per stored vector for the codes alone, and the size of the whole
+    serialised index (codes, ids, graph links and codebooks).
+    """
+    total_bytes = len(faiss.serialize_index(index))
+    try:
+        code_bytes = index.sa_code_size()
+    except RuntimeError:
+        code_bytes = total_bytes / max(index.ntotal, 1)
+    return code_bytes, total_bytes
+
+
+def search_one_by_one(index, queries, k):
+    """
+    Searches the queries one at a time, the way /chat does, and returns
+    the result ids with the per-query latencies in milliseconds.
+    """
+    ids = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        _, found = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000.0)
+        ids.append(found[0])
+    return np.array(ids), latencies
+
+
+def benchmark_index_types(vectors, queries, k=5, configs=None):
+    """
+    Builds every configured index over the vectors and reports build time,
+    memory per vector, recall@k (and its loss) against the exact flat index
+    and p50/p99 search latency.
+    """
+    configs = configs or DEFAULT_INDEX_CONFIGS
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    k = min(k, len(vectors))
+
+    exact = rag_burnbot.build_vector_index(vectors, "flat")
+    truth, _ = search_one_by_one(exact, queries, k)
+
+    rows = []
+    for index_type, params in configs:
+        start = time.perf_counter()
+        index = rag_burnbot.build_vector_index(vectors, index_type, params)
+        build_seconds = time.perf_counter() - start
+        found, latencies = search_one_by_one(index, queries, k)
+        code_bytes, total_bytes = index_memory(index)
+        recall = recall_at_k(truth, found, k)
+        rows.append({
+            "index": index_type,
+            "params": ", ".join(f"{key}={value}" for key, value in params.items()),
+            "build_s": round(build_seconds, 4),
+            "code_bytes": round(code_bytes, 1),
+            "bytes_per_vector": round(total_bytes / len(vectors), 1),
+            "index_mb": round(total_bytes / 1e6, 3),
+            f"recall@{k}": round(recall, 4),
+            "recall_loss": round(1.0 - recall, 4),
+            "p50_ms": round(percentile(latencies, 50), 4),
+            "p99_ms": round(percentile(latencies, 99), 4),
+        })
+    return rows
+
+
+def latency_summary(samples):
+    """
+    Count, mean and p50/p95/p99 of latencies given in milliseconds.
+    """
+    return {
+        "n": len(samples),
+        "mean_ms": round(float(np.mean(samples)), 4) if len(samples) else 0.0,
+        "p50_ms": round(percentile(samples, 50), 4),
+        "p95_ms": round(percentile(samples, 95), 4),
+        "p99_ms": round(percentile(samples, 99), 4),
+    }
+
+
+def load_questions(path=EVAL_QUESTIONS_PATH):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def relevant_ids(chunks, answer):
+    """
+    Ids of the chunks that contain the labelled answer snippet.
+    """
+    answer = answer.casefold()
+    return {i for i, text in enumerate(chunks) if answer in text.casefold()}
+
+
+def label_recall_at_k(relevant, results, k):
+    """
+    Share of each question's relevant chunks found in its top-k, averaged
+    over questions. A question with more relevant chunks than k counts as
+    fully recalled once k of them are returned.
+    """
+    scores = []
+    for expected, found in zip(relevant, results):
+        if expected:
+            scores.append(len(expected & set(found[:k])) / min(len(expected), k))
+    return sum(scores) / len(scores) if scores else 0.0
+
+
+def mean_reciprocal_rank(relevant, results):
+    """
+    Mean of 1/rank of the first relevant chunk, 0 when none was returned.
+    """
+    total = 0.0
+    for expected, found in zip(relevant, results):
+        for rank, chunk_id in enumerate(found, start=1):
+            if chunk_id in expected:
+                total += 1.0 / rank
+                break
+    return total / len(relevant) if len(relevant) else 0.0
+
+
+def timed(samples, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    samples.append((time.perf_counter() - start) * 1000.0)
+    return result
+
+
+def evaluate_retrieval(questions, chunks, k=3, mode=None, generator=None, repeats=5):
+    """
+    Runs every labelled question through chunk search, prompt assembly and
+    generation, recording per-stage latencies and retrieval quality.
+    Encode times the embedding model itself; search runs on a warm query
+    cache so it measures only the index and BM25 work.
+    """
+    generator = generator or rag_burnbot.Generator(rag_burnbot.StubBackend())
+    index, chunks = rag_burnbot.build_faiss_index(chunks)
+    lexical = rag_burnbot.BM25Index(chunks)
+    stages = {stage: [] for stage in EVAL_STAGES}
+
+    relevant, results = [], []
+    for _ in range(repeats):
+        for item in questions:
+            query = item["question"]
+            timed(stages["encode"], rag_burnbot.embedding_model.encode, [query])
+            rag_burnbot.encode_query(query)
+            ids = timed(stages["search"], rag_burnbot.retrieve_ids, query, index, k, lexical, mode)
+            context = [chunks[i] for i in ids if 0 <= i < len(chunks)]
+            prompt = timed(stages["prompt"], rag_burnbot.build_prompt, context, query)
+            timed(stages["generation"], generator.generate, prompt)
+            if len(results) < len(questions):
+                relevant.append(relevant_ids(chunks, item["answer"]))
+                results.append([int(i) for i in ids])
+
+    return {
+        "questions": len(questions),
+        f"recall@{k}": round(label_recall_at_k(relevant, results, k), 4),
+        "mrr": round(mean_reciprocal_rank(relevant, results), 4),
+        "misses": [item["question"] for item, expected, found in zip(questions, relevant, results)
+                   if not expected & set(found)],
+    }, stages, (index, chunks, lexical)
+
+
+def measure_throughput(questions, index, chunks, lexical, concurrency_levels, requests=200,
+                       k=3, mode=None, generator=None):
+    """
+    End-to-end answers per second (retrieval, prompt and generation) with
+    the given numbers of concurrent callers.
+    """
+    generator = generator or rag_burnbot.Generator(
+        rag_burnbot.StubBackend(), max_concurrency=max(concurrency_levels)
+    )
+    queries = [questions[i % len(questions)]["question"] for i in range(requests)]
+
+    def answer(query):
+        start = time.perf_counter()
+        context = rag_burnbot.retrieve_context(query, index, chunks, k, lexical, mode)
+        generator.generate(rag_burnbot.build_prompt(context, query))
+        return (time.perf_counter() - start) * 1000.0
+
+    rows = []
+    for concurrency in concurrency_levels:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(answer, queries))
+        elapsed = time.perf_counter() - start
+        rows.append({
+            "concurrency": concurrency,
+            "requests": requests,
+            "qps": round(requests / elapsed, 2),
+            **latency_summary(latencies),
+        })
+    return rows
+
+
+def evaluate_pipeline(doc_path=rag_burnbot.DOC_PATH, questions_path=EVAL_QUESTIONS_PATH, k=3,
+                      concurrency_levels=(1, 4, 16), requests=200, repeats=5,
+                      stub_latency=rag_burnbot.STUB_LATENCY):
+    """
+    Full evaluation run over one document, returned as a JSON-ready dict.
+    Generation always goes through the stub backend so runs are comparable
+    and never spend Gemini quota.
+    """
+    questions = load_questions(questions_path)
+    text = rag_burnbot.extract_text_from_file(doc_path)
+    chunking = []
+    for _ in range(repeats):
+        chunks = timed(chunking, rag_burnbot.chunk_text, text)
+
+    generator = rag_burnbot.Generator(
+        rag_burnbot.StubBackend(latency=stub_latency), max_concurrency=max(concurrency_levels)
+    )
+    retrieval, stages, (index, chunks, lexical) = evaluate_retrieval(
+        questions, chunks, k, generator=generator, repeats=repeats
+    )
+    stages["chunking"] = chunking
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "doc": doc_path,
+            "chunks": len(chunks),
+            "k": k,
+            "retrieval_mode": rag_burnbot.RETRIEVAL_MODE,
+            "index_type": rag_burnbot.INDEX_TYPE,
+            "stub_latency_s": stub_latency,
+        },
+        "retrieval": retrieval,
+        "stages": {stage: latency_summary(stages[stage]) for stage in EVAL_STAGES},
+        "throughput": measure_throughput(questions, index, chunks, lexical, concurrency_levels,
+                                         requests, k, generator=generator),
+    }
+
+
+def _thread_budget_worker(conn, threads, chunks, queries, k, model_factory):
+    """
+    One simulated web worker for benchmark_threads. It applies the thread
+    budget before anything starts a thread pool, loads its own model and
+    index like a real worker, then answers the queries when told to go.
+    """
+    rag_burnbot.cpu_threads.apply(threads)
+    model = model_factory()
+    index = rag_burnbot.build_vector_index(np.asarray(model.encode(chunks), dtype="float32"))
+    index.search(np.asarray(model.encode(queries[:1]), dtype="float32"), k)
+    conn.send("ready")
+    conn.recv()
+    latencies = []
+    start = time.monotonic()
+    for query in queries:
+        began = time.perf_counter()
+        index.search(np.asarray(model.encode([query]), dtype="float32"), k)
+        latencies.append((time.perf_counter() - began) * 1000.0)
+    conn.send((start, time.monotonic(), latencies))
+    conn.close()
+
+
+def benchmark_threads(chunks, queries, thread_counts, workers=1, k=3,
+                      model_factory=rag_burnbot.load_sentence_transformer):
+    """
+    Query embedding and search throughput of workers processes running side
+    by side, as web workers on one box do, for each per-worker CPU thread
+    budget. Every budget gets fresh processes, since the tokenizers size
+    their pool only once.
+    """
+    # Spawned, not forked: OpenMP and torch pools do not survive a fork
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    for threads in thread_counts:
+        pipes, processes = [], []
+        try:
+            for _ in range(workers):
+                parent, child = context.Pipe()
+                process = context.Process(
+                    target=_thread_budget_worker,
+                    args=(child, threads, chunks, queries, k, model_factory),
+                    daemon=True,
+                )
+                process.start()
+                child.close()
+                pipes.append(parent)
+                processes.append(process)
+            for conn in pipes:
+                conn.recv()
+            for conn in pipes:
+                conn.send("go")
+            runs = [conn.recv() for conn in pipes]
+        finally:
+            for process in processes:
+                process.join(timeout=30)
+                if process.is_alive():
+                    process.terminate()
+        latencies = [ms for _, _, samples in runs for ms in samples]
+        elapsed = max(end for _, end, _ in runs) - min(start for start, _, _ in runs)
+        rows.append({
+            "threads": threads,
+            "workers": workers,
+            "total_threads": threads * workers,
+            "requests": len(latencies),
+            "qps": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+            **latency_summary(latencies),
+        })
+    return rows
+
+
+def write_json(results, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+
+def langchain_chunks(paragraphs, chunk_size=500, chunk_overlap=50):
+    """
+    The splitter BurnBot used before the native chunker, kept as a reference.
+    Needs the optional langchain package.
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return splitter.split_text("\n".join(paragraphs))
+
+
+def benchmark_chunkers(paragraphs, repeats=5, chunk_size=500, chunk_overlap=50):
+    """
+    Time and peak Python memory of chunking the paragraphs with the native
+    chunker, and with langchain when it is installed. same_chunks tells
+    whether both produced identical chunks.
+    """
+    chunkers = [("native", rag_burnbot.chunk_text)]
+    try:
+        import langchain.text_splitter  # noqa: F401
+        chunkers.append(("langchain", langchain_chunks))
+    except ImportError:
+        pass
+
+    rows, outputs = [], {}
+    for name, chunker in chunkers:
+        timings = []
+        for _ in range(repeats):
+            chunks = timed(timings, chunker, paragraphs, chunk_size, chunk_overlap)
+        tracemalloc.start()
+        # Stream the paragraphs so only the chunker's own allocations are counted
+        chunker(iter(paragraphs), chunk_size, chunk_overlap)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        outputs[name] = chunks
+        rows.append({
+            "chunker": name,
+            "chunks": len(chunks),
+            "mean_ms": round(float(np.mean(timings)), 3),
+            "p50_ms": round(percentile(timings, 50), 3),
+            "peak_mb": round(peak / 1e6, 3),
+            "same_chunks": chunks == outputs["native"],
+        })
+    return rows
+
+
+def synthetic_vectors(count, dimension=384, clusters=64, seed=0):
+    """
+    Clustered, L2-normalised random vectors shaped like sentence embeddings.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimension))
+    labels = rng.integers(0, clusters, size=count)
+    vectors = centers[labels] + 0.5 * rng.normal(size=(count, dimension))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype("float32")
+
+
+def corpus_vectors(doc_path=rag_burnbot.DOC_PATH):
+    """
+    Embeddings of the chunks BurnBot would index for the given document.
+    """
+    chunks = rag_burnbot.chunk_text(rag_burnbot.extract_text_from_document(doc_path))
+    return np.asarray(rag_burnbot.embedding_model.encode(chunks), dtype="float32")
+
+
+def sample_queries(vectors, count, noise=0.05, seed=1):
+    """
+    Queries near existing vectors, so every query has meaningful neighbours.
+    """
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(vectors), size=count)
+    queries = vectors[picks] + noise * rng.normal(size=(count, vectors.shape[1]))
+    return queries.astype("float32")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark BurnBot retrieval indexes")
+    parser.add_argument("--doc", default=rag_burnbot.DOC_PATH, help="document to index")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="use this many synthetic vectors instead of the document")
+    parser.add_argument("--queries", type=int, default=200, help="number of queries")
+    parser.add_argument("--k", type=int, default=5, help="neighbours per query")
+    parser.add_argument("--types", default="",
+                        help="comma separated index types to compare, e.g. flat,sq8,pq")
+    parser.add_argument("--eval", action="store_true",
+                        help="evaluate the whole pipeline on the labelled questions instead")
+    parser.add_argument("--questions", default=EVAL_QUESTIONS_PATH, help="labelled question set")
+    parser.add_argument("--concurrency", default="1,4,16",
+                        help="comma separated caller counts for the throughput run")
+    parser.add_argument("--chunking", action="store_true",
+                        help="compare the native chunker with langchain's splitter instead")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="repeat the document this many times for the chunking run")
+    parser.add_argument("--threads", default="",
+                        help="comma separated CPU thread budgets per worker to compare instead")
+    parser.add_argument("--workers", type=int, default=rag_burnbot.WEB_WORKERS,
+                        help="worker processes running side by side for the --threads run")
+    parser.add_argument("--json", default="", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        chunks = rag_burnbot.chunk_text(rag_burnbot.extract_text_from_file(args.doc))
+        questions = [item["question"] for item in load_questions(args.questions)]
+        queries = [questions[i % len(questions)] for i in range(args.queries)]
+        rows = benchmark_threads(chunks, queries, [int(t) for t in args.threads.split(",")],
+                                 args.workers, args.k)
+        print(f"{args.workers} workers, {len(queries)} queries each, "
+              f"{rag_burnbot.available_cpus()} CPUs available")
+        print(tabulate(rows, headers="keys"))
+        results = {"cpus": rag_burnbot.available_cpus(), "threads": rows}
+    elif args.chunking:
+        paragraphs = rag_burnbot.extract_text_from_file(args.doc) * args.scale
+        rows = benchmark_chunkers(paragraphs)
+        print(f"{len(paragraphs)} paragraphs, {sum(map(len, paragraphs))} characters")
+        print(tabulate(rows, headers="keys"))
+        results = {"paragraphs": len(paragraphs), "chunkers": rows}
+    elif args.eval:
+        results = evaluate_pipeline(args.doc, args.questions, k=args.k,
+                                    concurrency_levels=[int(c) for c in args.concurrency.split(",")],
+                                    requests=args.queries)
+        print(json.dumps(results["retrieval"], indent=2))
+        print(tabulate([{"stage": stage, **row} for stage, row in results["stages"].items()],
+                       headers="keys"))
+        print(tabulate(results["throughput"], headers="keys"))
+    else:
+        configs = DEFAULT_INDEX_CONFIGS
+        if args.types:
+            wanted = {"flat"} | set(args.types.split(","))
+            configs = [config for config in configs if config[0] in wanted]
+
+        if args.synthetic:
+            vectors = synthetic_vectors(args.synthetic)
+        else:
+            vectors = corpus_vectors(args.doc)
+        queries = sample_queries(vectors, args.queries)
+        rows = benchmark_index_types(vectors, queries, args.k, configs)
+        print(f"{len(vectors)} vectors, {len(queries)} queries")
+        print(tabulate(rows, headers="keys"))
+        results = {"vectors": len(vectors), "queries": len(queries), "indexes": rows}
+
+    if args.json:
+        write_json(results, args.json)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,29 @@
 # Import necessary packages
 import os
+import sys
 import re
+import json
+import time
+import shutil
+import tempfile
+import math
+import hashlib
+import queue
+import threading
+from contextlib import contextmanager
+from itertools import chain
+from collections import OrderedDict, Counter, defaultdict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 import faiss
 import numpy as np
 from dotenv import load_dotenv
 from docx import Document
-from sentence_transformers import SentenceTransformer
-import google.generativeai as genai
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+try:
+    import fcntl
+except ImportError:
+    # No file locks on Windows, every worker then builds the index itself
+    fcntl = None
 
 # Loading the API key for the google gemini model
 load_dotenv()
@@ -16,79 +32,2589 @@ api_key = os.getenv("GEMINI_API_KEY")
 bot_state = 0
 
 DOC_PATH = "./data/data.docx"
+# Directory of .docx, .md and .txt documents BurnBot answers from
+CORPUS_DIR = os.getenv("BURNBOT_CORPUS_DIR", "./data")
+CORPUS_EXTENSIONS = (".docx", ".md", ".txt")
+INDEX_DIR = "./data/index"
+INDEX_FORMAT_VERSION = 2
+# Extracted .docx text is cached next to the index artifacts, in this subdirectory
+EXTRACT_CACHE_SUBDIR = "text"
+# Serve only indexes built offline with --build-index; workers then never embed the corpus
+PREBUILT_INDEX_ONLY = os.getenv("BURNBOT_PREBUILT_INDEX", "0") == "1"
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+
+# Query embedding cache limits, overridable from the environment
+QUERY_CACHE_MAX_BYTES = int(os.getenv("BURNBOT_QUERY_CACHE_BYTES", str(16 * 1024 * 1024)))
+QUERY_CACHE_TTL = float(os.getenv("BURNBOT_QUERY_CACHE_TTL", "3600"))
+
+# Micro-batching of concurrent query encodes
+ENCODE_MAX_BATCH_SIZE = int(os.getenv("BURNBOT_ENCODE_BATCH_SIZE", "32"))
+ENCODE_MAX_WAIT_MS = float(os.getenv("BURNBOT_ENCODE_MAX_WAIT_MS", "5"))
+
+# Semantic answer cache limits; distance is cosine distance between query embeddings
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("BURNBOT_ANSWER_CACHE_ENTRIES", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("BURNBOT_ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_DISTANCE = float(os.getenv("BURNBOT_ANSWER_CACHE_DISTANCE", "0.05"))
+
+# Vector index used for chunk retrieval: flat (exact), hnsw, ivf_flat, ivf_pq, or the
+# compressed flat stores sq8 (8-bit scalar quantization) and pq (product quantization)
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq", "sq8", "pq")
+INDEX_TYPE = os.getenv("BURNBOT_INDEX_TYPE", "flat")
+INDEX_PARAMS = {
+    "hnsw_m": int(os.getenv("BURNBOT_HNSW_M", "32")),
+    "ef_construction": int(os.getenv("BURNBOT_HNSW_EF_CONSTRUCTION", "40")),
+    "ef_search": int(os.getenv("BURNBOT_HNSW_EF_SEARCH", "64")),
+    # 0 sizes the IVF coarse quantizer from the number of vectors
+    "nlist": int(os.getenv("BURNBOT_IVF_NLIST", "0")),
+    "nprobe": int(os.getenv("BURNBOT_IVF_NPROBE", "8")),
+    "pq_m": int(os.getenv("BURNBOT_PQ_M", "16")),
+    "pq_bits": int(os.getenv("BURNBOT_PQ_BITS", "8")),
+}
+# Parameters that only affect search and can be changed on a built index
+SEARCH_PARAMS = ("ef_search", "nprobe")
+
+# Retrieval mode: dense (FAISS only), lexical (BM25 only) or hybrid (both, fused with
+# reciprocal rank fusion). Hybrid answers short keyword queries from BM25 alone.
+RETRIEVAL_MODE = os.getenv("BURNBOT_RETRIEVAL_MODE", "hybrid")
+LEXICAL_ONLY_MAX_TERMS = int(os.getenv("BURNBOT_LEXICAL_ONLY_TERMS", "2"))
+RRF_K = 60
+
+# Answer generation: backend (gemini or the offline stub), per-call deadline in seconds
+# (for streams: until the first piece and between pieces), the upstream limit on a whole
+# stream, concurrent upstream calls, and the circuit breaker that fails fast while it is unhealthy
+GENERATION_BACKEND = os.getenv("BURNBOT_GENERATOR", "gemini")
+GENERATION_TIMEOUT = float(os.getenv("BURNBOT_GENERATION_TIMEOUT", "20"))
+GENERATION_STREAM_LIMIT = float(os.getenv("BURNBOT_GENERATION_STREAM_LIMIT", "120"))
+GENERATION_MAX_CONCURRENCY = int(os.getenv("BURNBOT_GENERATION_CONCURRENCY", "8"))
+GENERATION_SLOT_WAIT = float(os.getenv("BURNBOT_GENERATION_SLOT_WAIT", "1"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BURNBOT_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BURNBOT_BREAKER_RESET", "30"))
+STUB_LATENCY = float(os.getenv("BURNBOT_STUB_LATENCY", "0.05"))
+
+# Batch answering: most questions per request and concurrent generations per batch
+BATCH_MAX_QUESTIONS = int(os.getenv("BURNBOT_BATCH_MAX_QUESTIONS", "500"))
+BATCH_CONCURRENCY = int(os.getenv("BURNBOT_BATCH_CONCURRENCY", "4"))
+# /chat/batch is for the coaching team only (comma separated emails), and questions not
+# started within BATCH_DEADLINE seconds come back unanswered; the CLI has neither limit
+BATCH_USERS = {email.strip().lower() for email in os.getenv("BURNBOT_BATCH_USERS", "").split(",")
+               if email.strip()}
+BATCH_DEADLINE = float(os.getenv("BURNBOT_BATCH_DEADLINE", "30"))
+# Chat requests run on their own bounded pool: worker threads, requests allowed to
+# queue behind them, how long a queued request may wait and the Retry-After hint
+CHAT_WORKERS = int(os.getenv("BURNBOT_CHAT_WORKERS", "8"))
+CHAT_QUEUE_LIMIT = int(os.getenv("BURNBOT_CHAT_QUEUE_LIMIT", "16"))
+CHAT_QUEUE_TIMEOUT = float(os.getenv("BURNBOT_CHAT_QUEUE_TIMEOUT", "10"))
+CHAT_RETRY_AFTER = int(os.getenv("BURNBOT_CHAT_RETRY_AFTER", "2"))
+# Where query and chunk embeddings are computed: inline in this process, process
+# (a private worker process) or unix:/path/to.sock (a shared rag_embedding_worker.py sidecar)
+EMBEDDING_WORKER = os.getenv("BURNBOT_EMBEDDING_WORKER", "inline")
+# Warm up the models and index when a served app gets its first request (set by deploys;
+# tests and CLI tools leave it off and load lazily), and the seconds /chat waits for a
+# running warm-up before answering "warming up"
+WARMUP_ON_START = os.getenv("BURNBOT_WARMUP", "0") == "1"
+CHAT_WARMUP_WAIT = float(os.getenv("BURNBOT_CHAT_WARMUP_WAIT", "1"))
+# Conversation memory: live sessions, idle timeout in seconds, turns kept verbatim, and
+# the token budget for the history in each prompt (of which the rolling summary gets a part)
+MEMORY_MAX_SESSIONS = int(os.getenv("BURNBOT_MEMORY_SESSIONS", "1000"))
+MEMORY_IDLE_SECONDS = float(os.getenv("BURNBOT_MEMORY_IDLE", "1800"))
+MEMORY_RECENT_TURNS = int(os.getenv("BURNBOT_MEMORY_TURNS", "3"))
+MEMORY_TOKEN_BUDGET = int(os.getenv("BURNBOT_MEMORY_TOKENS", "256"))
+MEMORY_SUMMARY_TOKENS = int(os.getenv("BURNBOT_MEMORY_SUMMARY_TOKENS", "96"))
+# Token budget for the whole prompt; context chunks are trimmed to fit it
+PROMPT_TOKEN_BUDGET = int(os.getenv("BURNBOT_PROMPT_TOKENS", "1024"))
+MIN_PARTIAL_CHUNK_TOKENS = 32
+MIN_CHUNK_OVERLAP = 20
+MAX_CHUNK_OVERLAP = 200
+
+# CPU threads each web worker process gives torch, FAISS (OpenMP) and the tokenizers:
+# a number, 0 for the libraries' own defaults, or auto to split the cores available to
+# the process evenly between the WEB_CONCURRENCY workers on the box
+CPU_THREADS_SETTING = os.getenv("BURNBOT_CPU_THREADS", "auto")
+WEB_WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Flat codes are mapped in place so workers share one page-cached copy
+FAISS_MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+
+
+class LazyModel:
+    """
+    Stand-in for a model that is slow to import or load. The real object is
+    built on first use, or ahead of time by the warm-up thread, and attribute
+    access is forwarded to it.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._instance = None
+
+    @property
+    def loaded(self):
+        return self._instance is not None
+
+    def load(self):
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+                instance = self._instance
+        return instance
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+# The methods BurnBot calls are defined on the stand-ins, so patching them does not load the model
+class LazyEmbeddingModel(LazyModel):
+    def encode(self, *args, **kwargs):
+        return self.load().encode(*args, **kwargs)
+
+    def get_sentence_embedding_dimension(self):
+        return self.load().get_sentence_embedding_dimension()
+
 
-# Configuring the LLM model and embedding function
-genai.configure(api_key=api_key)
-model = genai.GenerativeModel("gemini-1.5-pro")
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
+class LazyGenerativeModel(LazyModel):
+    def generate_content(self, *args, **kwargs):
+        return self.load().generate_content(*args, **kwargs)
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def cpu_thread_budget(setting=CPU_THREADS_SETTING, workers=WEB_WORKERS, cpus=None):
+    if str(setting).strip().lower() != "auto":
+        return max(0, int(setting))
+    return max(1, (cpus or available_cpus()) // max(1, workers))
+
+
+class CPUThreads:
+    """
+    The CPU thread budget of this process for the native code BurnBot runs:
+    torch intra-op threads for the embedding model, the OpenMP pool FAISS
+    searches with, and the Rayon pool of the Hugging Face tokenizers. Without
+    it every web worker sizes each of them to the whole machine. torch is
+    imported with the model, so the budget is applied again at that point.
+    """
+
+    # Tokenizer settings the operator chose are left as they are. The ones BurnBot set
+    # itself are listed in OWNED_ENV, so child processes can still resize them.
+    ENV_VARS = ("RAYON_NUM_THREADS", "TOKENIZERS_PARALLELISM")
+    OWNED_ENV = "BURNBOT_THREAD_ENV"
+
+    def __init__(self, threads=None):
+        self.threads = cpu_thread_budget() if threads is None else threads
+        owned = os.getenv(self.OWNED_ENV, "").split(",")
+        self._preset = {name for name in self.ENV_VARS if name in os.environ and name not in owned}
+
+    def apply(self, threads=None):
+        if threads is not None:
+            self.threads = threads
+        if self.threads <= 0:
+            return
+        faiss.omp_set_num_threads(self.threads)
+        # The tokenizers read these when their pool starts, so they must be set before first use.
+        # Parallelism is only ever turned off: forcing it on would also turn off the tokenizers'
+        # protection against forking with their pool running.
+        if "RAYON_NUM_THREADS" not in self._preset:
+            os.environ["RAYON_NUM_THREADS"] = str(self.threads)
+        if "TOKENIZERS_PARALLELISM" not in self._preset:
+            if self.threads > 1:
+                os.environ.pop("TOKENIZERS_PARALLELISM", None)
+            else:
+                os.environ["TOKENIZERS_PARALLELISM"] = "false"
+        os.environ[self.OWNED_ENV] = ",".join(name for name in self.ENV_VARS if name not in self._preset)
+        torch = sys.modules.get("torch")
+        if torch is not None:
+            torch.set_num_threads(self.threads)
+
+    def stats(self):
+        torch = sys.modules.get("torch")
+        return {
+            "budget": self.threads,
+            "faiss": faiss.omp_get_max_threads(),
+            "torch": torch.get_num_threads() if torch is not None else None,
+        }
+
+
+cpu_threads = CPUThreads()
+cpu_threads.apply()
+
+def load_sentence_transformer():
+    from sentence_transformers import SentenceTransformer
+    cpu_threads.apply()
+    return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+def _load_embedding_model():
+    if EMBEDDING_WORKER == "inline":
+        return load_sentence_transformer()
+    import rag_embedding_worker
+    if EMBEDDING_WORKER == "process":
+        return rag_embedding_worker.ProcessEmbeddingWorker()
+    if EMBEDDING_WORKER.startswith("unix:"):
+        client = rag_embedding_worker.EmbeddingWorkerClient(
+            EMBEDDING_WORKER[len("unix:"):], rag_embedding_worker.authkey_from_env()
+        )
+        return client.connect(timeout=rag_embedding_worker.START_TIMEOUT)
+    raise ValueError(f"Unknown BURNBOT_EMBEDDING_WORKER {EMBEDDING_WORKER!r}")
+
+def _load_generative_model():
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel("gemini-1.5-pro")
+
+# Configuring the LLM model and embedding function, loaded on first use
+model = LazyGenerativeModel(_load_generative_model)
+embedding_model = LazyEmbeddingModel(_load_embedding_model)
 
 def cleaned_text(text):
     text = re.sub(r"\s+", " ", text)  
     return text.strip()
 
-# Extracting the relevant text from the document for retrieval
-def extract_text_from_document(path):
+# Extracting the relevant text from the document for retrieval, one paragraph at a time
+def iter_document_paragraphs(path):
     doc = Document(path)
-    text = []
     for paragraph in doc.paragraphs:
         if paragraph.text.strip():
-            text.append(paragraph.text.strip())
-    return text
+            yield paragraph.text.strip()
+
+def extract_text_from_document(path):
+    return list(iter_document_paragraphs(path))
+
+# Plain-text and markdown documents are split into paragraphs on blank lines,
+# reading one line at a time so large files are never held whole
+def iter_text_file_paragraphs(path):
+    with open(path, encoding="utf-8") as f:
+        lines = []
+        for line in f:
+            if line.strip():
+                lines.append(line)
+            elif lines:
+                yield cleaned_text("".join(lines))
+                lines = []
+        if lines:
+            yield cleaned_text("".join(lines))
+
+def extract_text_from_text_file(path):
+    return list(iter_text_file_paragraphs(path))
+
+# Parsed .docx text is kept as a JSON lines sidecar in cache_dir: a header with the
+# file's hash, size and mtime, then one paragraph per line. python-docx only runs
+# when the document changed; a touched but unedited file just refreshes the header.
+def extract_cache_path(path, cache_dir):
+    key = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{os.path.basename(path)}-{key}.jsonl")
+
+def _read_extract_cache(cache_path):
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            paragraphs = [json.loads(line) for line in f]
+    except (OSError, ValueError):
+        return None, None
+    if header.get("paragraphs") != len(paragraphs):
+        return None, None
+    return header, paragraphs
+
+def _write_extract_cache(cache_path, header, paragraphs):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(json.dumps(header) + "\n")
+        for paragraph in paragraphs:
+            f.write(json.dumps(paragraph) + "\n")
+    os.replace(cache_path + ".tmp", cache_path)
+
+def cached_document_paragraphs(path, cache_dir, digest=None):
+    stat = os.stat(path)
+    cache_path = extract_cache_path(path, cache_dir)
+    header, paragraphs = _read_extract_cache(cache_path)
+    if header is not None and (header["size"], header["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+        return paragraphs
+    digest = digest or file_hash(path)
+    if header is None or header["sha256"] != digest:
+        paragraphs = extract_text_from_document(path)
+    header = {"sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+              "paragraphs": len(paragraphs)}
+    try:
+        _write_extract_cache(cache_path, header, paragraphs)
+    except OSError as e:
+        print(f"Could not cache the text of {path}: {e}")
+    return paragraphs
+
+# Removes cached text of documents that are no longer in paths, returns how many went
+def prune_extract_cache(cache_dir, paths):
+    keep = {os.path.basename(extract_cache_path(path, cache_dir)) for path in paths}
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return 0
+    pruned = 0
+    for name in names:
+        if name.endswith((".jsonl", ".jsonl.tmp")) and name not in keep:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+                pruned += 1
+            except OSError:
+                pass
+    return pruned
+
+def iter_paragraphs(path, cache_dir=None, digest=None):
+    if path.lower().endswith(".docx"):
+        if cache_dir:
+            return iter(cached_document_paragraphs(path, cache_dir, digest))
+        return iter_document_paragraphs(path)
+    return iter_text_file_paragraphs(path)
+
+def extract_text_from_file(path):
+    return list(iter_paragraphs(path))
+
+# Documents in the corpus: the source itself if it is a file, else the supported files in the directory
+def corpus_files(source):
+    if os.path.isfile(source):
+        return [source]
+    files = []
+    for name in sorted(os.listdir(source)):
+        path = os.path.join(source, name)
+        # Skip hidden files and Word lock files
+        if name.startswith((".", "~$")) or not os.path.isfile(path):
+            continue
+        if name.lower().endswith(CORPUS_EXTENSIONS):
+            files.append(path)
+    return files
+
+# A chunk of the corpus with its character offsets in the newline-joined paragraphs
+Chunk = namedtuple("Chunk", "text start end")
+
+# Pieces of one oversized line: words (each keeping the space before it), and
+# single characters for words that are still too long. None closes a chunk.
+def _split_long_line(line, start, chunk_size):
+    if " " not in line:
+        for i, char in enumerate(line):
+            yield char, start + i
+        return
+    for word in re.split(r"(?= )", line):
+        if not word:
+            continue
+        if len(word) < chunk_size:
+            yield word, start
+        else:
+            yield None
+            for i, char in enumerate(word):
+                yield char, start + i
+            yield None
+        start += len(word)
+
+# Pieces the chunker packs, with their offsets. Each line keeps the newline before
+# it; lines that do not fit in a chunk are cut into words between two chunk breaks.
+def _chunk_pieces(paragraphs, chunk_size):
+    offset = 0
+    for paragraph in paragraphs:
+        for line in paragraph.split("\n"):
+            piece, start = (line, offset) if offset == 0 else ("\n" + line, offset - 1)
+            offset += len(line) + 1
+            if len(piece) < chunk_size:
+                yield piece, start
+            else:
+                yield None
+                yield from _split_long_line(piece, start, chunk_size)
+                yield None
+
+def _window_chunk(window):
+    text = "".join(piece for piece, _ in window)
+    stripped = text.strip()
+    if not stripped:
+        return None
+    start = window[0][1] + len(text) - len(text.lstrip())
+    return Chunk(stripped, start, start + len(stripped))
+
+# Packs paragraphs into chunks of at most chunk_size characters, each starting with
+# up to chunk_overlap characters of whole pieces from the previous chunk. Produces
+# the same chunks as langchain's RecursiveCharacterTextSplitter did, but consumes
+# the paragraphs lazily, so memory stays bounded by one chunk.
+def iter_chunks(paragraphs, chunk_size=500, chunk_overlap=50):
+    window = deque()
+    total = 0
+    for item in chain(_chunk_pieces(paragraphs, chunk_size), [None]):
+        if item is None:
+            chunk = _window_chunk(window) if window else None
+            if chunk:
+                yield chunk
+            window.clear()
+            total = 0
+            continue
+        piece, _ = item
+        if window and total + len(piece) > chunk_size:
+            chunk = _window_chunk(window)
+            if chunk:
+                yield chunk
+            while window and (total > chunk_overlap or total + len(piece) > chunk_size):
+                total -= len(window.popleft()[0])
+        window.append(item)
+        total += len(piece)
 
 def chunk_text(text, chunk_size=500, chunk_overlap=50):
-    text_blob = "\n".join(text)
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap
-    )
-    return splitter.split_text(text_blob)
+    return [chunk.text for chunk in iter_chunks(text, chunk_size, chunk_overlap)]
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache from normalized query text to its embedding vector.
+    Entries expire after ttl seconds and the least recently used ones are
+    evicted once the stored keys and vectors exceed max_bytes.
+    """
+
+    def __init__(self, max_bytes=QUERY_CACHE_MAX_BYTES, ttl=QUERY_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def normalize(query):
+        return cleaned_text(query).lower()
+
+    @staticmethod
+    def _entry_size(key, vector):
+        return len(key.encode("utf-8")) + vector.nbytes
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            vector, expires_at = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key, vector):
+        vector = np.array(vector, dtype="float32")
+        vector.setflags(write=False)
+        size = self._entry_size(key, vector)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (vector, time.monotonic() + self.ttl)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        vector, _ = self._entries.pop(key)
+        self._bytes -= self._entry_size(key, vector)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class BatchingEncoder:
+    """
+    Collects queries arriving within max_wait_ms of each other (up to
+    max_batch_size) and embeds them with a single encode() call. Each caller
+    gets back only its own vector.
+    """
+
+    def __init__(self, max_batch_size=ENCODE_MAX_BATCH_SIZE, max_wait_ms=ENCODE_MAX_WAIT_MS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.batch_sizes = Counter()
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+
+    def submit(self, text):
+        future = Future()
+        self._queue.put((text, future))
+        self._ensure_worker()
+        return future
+
+    def encode(self, text):
+        return self.submit(text).result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for text, _ in batch]
+            try:
+                vectors = np.asarray(embedding_model.encode(texts), dtype="float32")
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self._lock:
+                self.batches += 1
+                self.items += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+                self.batch_sizes[len(batch)] += 1
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "batches": self.batches,
+                "items": self.items,
+                "largest_batch": self.largest_batch,
+                "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+                "batch_sizes": dict(self.batch_sizes),
+            }
 
-def build_faiss_index(chunks):
+
+query_embedding_cache = EmbeddingCache()
+query_encoder = BatchingEncoder()
+
+# Embeds a single query, reusing the cached vector for repeated questions
+def encode_query(query, cache=None):
+    cache = query_embedding_cache if cache is None else cache
+    key = cache.normalize(query)
+    vector = cache.get(key)
+    if vector is None:
+        vector = query_encoder.encode(key)
+        cache.put(key, vector)
+    return vector
+
+# Embeds many queries at once: cached ones are reused, the rest go through one encode() call
+def encode_queries(queries, cache=None):
+    cache = query_embedding_cache if cache is None else cache
+    keys = [cache.normalize(query) for query in queries]
+    vectors = [cache.get(key) for key in keys]
+    missing = sorted({key for key, vector in zip(keys, vectors) if vector is None})
+    if missing:
+        encoded = dict(zip(missing, np.asarray(embedding_model.encode(missing), dtype="float32")))
+        for key, vector in encoded.items():
+            cache.put(key, vector)
+        vectors = [encoded[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+    return np.asarray(vectors, dtype="float32").reshape(len(keys), -1)
+
+class SemanticAnswerCache:
+    """
+    Small FAISS index of past query embeddings and the answers generated for them.
+    A new query within max_distance (cosine) of a cached one reuses its answer.
+    Answers are also keyed by the normalized query text, for queries that are
+    looked up without being embedded. Entries are tagged with the corpus
+    version and dropped when it changes.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl=ANSWER_CACHE_TTL,
+                 max_distance=ANSWER_CACHE_MAX_DISTANCE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._index = None
+        # id -> (answer, expires_at, text), oldest first
+        self._entries = OrderedDict()
+        # normalized query text -> id
+        self._texts = {}
+        self._next_id = 0
+        self._corpus_version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.array(vector, dtype="float32").reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _reset(self, corpus_version):
+        self._index = None
+        self._entries.clear()
+        self._texts.clear()
+        self._corpus_version = corpus_version
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is not None and self._texts.get(entry[2]) == entry_id:
+            del self._texts[entry[2]]
+        if self._index is not None:
+            self._index.remove_ids(np.array([entry_id], dtype="int64"))
+
+    def invalidate(self, corpus_version=None):
+        with self._lock:
+            self._reset(corpus_version)
+
+    def lookup(self, vector, corpus_version):
+        vector = self._normalize(vector)
+        with self._lock:
+            if corpus_version != self._corpus_version:
+                self._reset(corpus_version)
+            if self._index is None or self._index.ntotal == 0:
+                self.misses += 1
+                return None
+            now = time.monotonic()
+            similarities, ids = self._index.search(vector, min(4, self._index.ntotal))
+            for similarity, entry_id in zip(similarities[0], ids[0]):
+                if entry_id < 0 or 1.0 - similarity > self.max_distance:
+                    break
+                answer, expires_at, _ = self._entries[entry_id]
+                if expires_at < now:
+                    self._remove(entry_id)
+                    continue
+                self.hits += 1
+                return answer
+            self.misses += 1
+            return None
+
+    # Exact lookup by normalized query text, no embedding needed
+    def lookup_text(self, text, corpus_version):
+        with self._lock:
+            if corpus_version != self._corpus_version:
+                self._reset(corpus_version)
+            entry_id = self._texts.get(text)
+            if entry_id is not None:
+                answer, expires_at, _ = self._entries[entry_id]
+                if expires_at >= time.monotonic():
+                    self.hits += 1
+                    return answer
+                self._remove(entry_id)
+            self.misses += 1
+            return None
+
+    # vector may be None for queries that were never embedded, text keys the exact lookup
+    def store(self, vector, answer, corpus_version, text=None):
+        if vector is not None:
+            vector = self._normalize(vector)
+        with self._lock:
+            if corpus_version != self._corpus_version:
+                # Answer was generated against a corpus that has since been replaced
+                if self._corpus_version is not None:
+                    return
+                self._corpus_version = corpus_version
+            entry_id = self._next_id
+            self._next_id += 1
+            if vector is not None:
+                if self._index is None:
+                    self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+                self._index.add_with_ids(vector, np.array([entry_id], dtype="int64"))
+            if text is not None:
+                if text in self._texts:
+                    self._remove(self._texts[text])
+                self._texts[text] = entry_id
+            self._entries[entry_id] = (answer, time.monotonic() + self.ttl, text)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "corpus_version": self._corpus_version,
+            }
+
+def index_params(params=None):
+    merged = dict(INDEX_PARAMS)
+    merged.update(params or {})
+    return merged
+
+# Short identifier of the index type and its build-time parameters
+def index_config_key(index_type=None, params=None):
+    index_type = index_type or INDEX_TYPE
+    params = index_params(params)
+    if index_type == "hnsw":
+        return f"hnsw{params['hnsw_m']}-efc{params['ef_construction']}"
+    if index_type == "ivf_flat":
+        return f"ivfflat{params['nlist'] or 'auto'}"
+    if index_type == "ivf_pq":
+        return f"ivfpq{params['nlist'] or 'auto'}-m{params['pq_m']}x{params['pq_bits']}"
+    if index_type == "pq":
+        return f"pq-m{params['pq_m']}x{params['pq_bits']}"
+    return index_type
+
+def _ivf_nlist(params, n_vectors):
+    if params["nlist"]:
+        return max(1, min(params["nlist"], n_vectors))
+    # Roughly 4*sqrt(n) lists with enough points per list to train k-means
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+def _pq_shape(params, dimension, n_vectors):
+    pq_m = max(1, min(params["pq_m"], dimension))
+    while dimension % pq_m:
+        pq_m -= 1
+    # PQ training needs at least 2**bits points per sub-quantizer
+    pq_bits = max(1, min(params["pq_bits"], int(math.log2(max(n_vectors, 2)))))
+    return pq_m, pq_bits
+
+# Creates an empty (untrained) index of the requested type
+def create_index(index_type, dimension, n_vectors, params=None):
+    params = index_params(params)
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dimension)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, params["hnsw_m"])
+        index.hnsw.efConstruction = params["ef_construction"]
+        return index
+    if index_type in ("ivf_flat", "ivf_pq"):
+        quantizer = faiss.IndexFlatL2(dimension)
+        nlist = _ivf_nlist(params, n_vectors)
+        if index_type == "ivf_flat":
+            return faiss.IndexIVFFlat(quantizer, dimension, nlist)
+        pq_m, pq_bits = _pq_shape(params, dimension, n_vectors)
+        return faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, pq_bits)
+    if index_type == "sq8":
+        return faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit)
+    if index_type == "pq":
+        pq_m, pq_bits = _pq_shape(params, dimension, n_vectors)
+        return faiss.IndexPQ(dimension, pq_m, pq_bits)
+    raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+
+# Applies efSearch / nprobe to a built or freshly loaded index
+def apply_search_params(index, params=None):
+    params = index_params(params)
+    base = index
+    if isinstance(index, faiss.IndexIDMap):
+        base = faiss.downcast_index(index.index)
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = params["ef_search"]
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        ivf = None
+    if ivf is not None:
+        ivf.nprobe = min(params["nprobe"], ivf.nlist)
+    return index
+
+def build_vector_index(embeddings, index_type=None, params=None):
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    index = create_index(index_type or INDEX_TYPE, embeddings.shape[1], embeddings.shape[0], params)
+    if not index.is_trained:
+        index.train(embeddings)
+    index.add(embeddings)
+    return apply_search_params(index, params)
+
+def build_faiss_index(chunks, index_type=None, params=None):
     embeddings = embedding_model.encode(chunks)
-    index = faiss.IndexFlatL2(embeddings.shape[1])
-    index.add(np.array(embeddings))
+    index = build_vector_index(embeddings, index_type, params)
     return index, chunks
 
-# Function to retrieve the most relevant text from the document
-def retrieve_context(query, index, chunks, k=3):
-    query_vector = embedding_model.encode([query])
-    _, indices = index.search(np.array(query_vector), k)
+STOPWORDS = frozenset(
+    "a an and are as at be best can do does for from how i in is it me my of on or "
+    "should the to what when which who why with you your".split()
+)
+
+def tokenize(text):
+    return [term for term in re.findall(r"[a-z0-9]+", text.lower()) if term not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    In-memory BM25 inverted index over the same chunk store as the FAISS index,
+    so exact food and exercise names are matched by their terms and not only
+    by embedding similarity.
+    """
+
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        items = chunks.items() if isinstance(chunks, dict) else enumerate(chunks)
+        self.postings = defaultdict(list)
+        self.lengths = {}
+        for chunk_id, text in items:
+            terms = Counter(tokenize(text))
+            self.lengths[chunk_id] = sum(terms.values())
+            for term, tf in terms.items():
+                self.postings[term].append((chunk_id, tf))
+        count = len(self.lengths)
+        self.avg_length = sum(self.lengths.values()) / count if count else 0.0
+        self.idf = {
+            term: math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+    def search(self, terms, k):
+        scores = defaultdict(float)
+        for term in set(terms):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for chunk_id, tf in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[chunk_id] / self.avg_length)
+                scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+# Combines ranked id lists, each contributing 1 / (RRF_K + rank) per id
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] += 1.0 / (k + rank)
+    return [chunk_id for chunk_id, _ in sorted(scores.items(), key=lambda item: item[1], reverse=True)]
+
+def dense_search(query, index, k):
+    query_vector = encode_query(query).reshape(1, -1)
+    _, indices = index.search(query_vector, k)
+    return list(indices[0])
+
+# How many FAISS hits the ranking needs for the top k
+def retrieval_depth(k, lexical=None, mode=None):
+    mode = mode or RETRIEVAL_MODE
+    return k if lexical is None or mode == "dense" else max(4 * k, 20)
+
+# Short keyword queries with a BM25 hit are served from BM25 alone: they skip the
+# intent centroids, are looked up in the answer cache by text and are never embedded
+def is_lexical_only(query, lexical, mode=None):
+    mode = mode or RETRIEVAL_MODE
+    if lexical is None or mode == "dense":
+        return False
+    if mode == "lexical":
+        return True
+    terms = tokenize(query)
+    return len(terms) <= LEXICAL_ONLY_MAX_TERMS and bool(lexical.search(terms, 1))
+
+# Ranked chunk ids for the query, best match first. dense_ids is an already
+# computed FAISS ranking for the query, at least retrieval_depth(k) deep.
+def retrieve_ids(query, index, k=3, lexical=None, mode=None, dense_ids=None):
+    mode = mode or RETRIEVAL_MODE
+    depth = retrieval_depth(k, lexical, mode)
+    if lexical is None or mode == "dense":
+        ids = dense_search(query, index, k) if dense_ids is None else list(dense_ids[:k])
+    else:
+        terms = tokenize(query)
+        lexical_ids = [chunk_id for chunk_id, _ in lexical.search(terms, depth)]
+        # Short keyword queries with a BM25 hit skip the FAISS search, see is_lexical_only
+        if mode == "lexical" or (lexical_ids and len(terms) <= LEXICAL_ONLY_MAX_TERMS):
+            ids = lexical_ids[:k]
+        else:
+            if dense_ids is None:
+                dense_ids = dense_search(query, index, depth)
+            dense_ids = [i for i in dense_ids[:depth] if i >= 0]
+            ids = reciprocal_rank_fusion([dense_ids, lexical_ids])[:k]
+    return ids
+
+def _chunk_texts(ids, chunks):
     arr = []
-    for i in indices[0]:
+    for i in ids:
+        # Corpus chunk stores are keyed by vector id, FAISS pads missing hits with -1
+        if isinstance(chunks, dict) and i not in chunks:
+            continue
         arr.append(chunks[i])
     return arr
 
+# Function to retrieve the most relevant text from the document
+def retrieve_context(query, index, chunks, k=3, lexical=None, mode=None):
+    return _chunk_texts(retrieve_ids(query, index, k, lexical, mode), chunks)
+
+# Contexts for many queries: one encode() call and one multi-query FAISS search
+def retrieve_contexts(queries, index, chunks, k=3, lexical=None, mode=None):
+    if not queries:
+        return []
+    _, found = index.search(encode_queries(queries), retrieval_depth(k, lexical, mode))
+    return [
+        _chunk_texts(retrieve_ids(query, index, k, lexical, mode, dense_ids=list(row)), chunks)
+        for query, row in zip(queries, found)
+    ]
+
+PROMPT_TEMPLATE = "You are a fitness assistant and your task is to answer user query in polite and concise manner.Generate a human response for all the queries.\n\n{profile}{history}Use the following context to answer the query asked by the user.\n\nContext: {context}\n\nQuery: {query}\n\nStick to the context and generate response accordingly.If you don't know the answer, convey that you don't know the answer."
+
+# Questions about the user's own logged data get their fitness summary in the prompt.
+# General first-person questions ("how many calories should I eat") do not, they stay
+# cacheable like any other question
+PERSONAL_PATTERN = re.compile(
+    r"\bmy (?:\w+ )?(?:progress|stats|totals?|log|logs|calories|calorie intake|intake|water|"
+    r"burnout|activities|activity|workouts|achievements?|streak|week)\b"
+    r"|\b(?:did|have|had) i\b|\bi (?:ate|drank|burned|burnt|logged|completed)\b"
+    r"|\bhow am i doing\b|\bam i on track\b|\b(?:this|last) week\b",
+    re.IGNORECASE,
+)
+
+def is_personal_query(query):
+    return PERSONAL_PATTERN.search(query) is not None
+
+# Local token estimate: words and punctuation marks, close to LLM subword counts for English
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text):
+    return sum(1 for _ in TOKEN_PATTERN.finditer(text))
+
+def truncate_to_tokens(text, limit):
+    if limit <= 0:
+        return ""
+    for count, match in enumerate(TOKEN_PATTERN.finditer(text), start=1):
+        if count == limit:
+            return text[:match.end()]
+    return text
+
+# Length of the longest suffix of left that is also a prefix of right
+def _overlap_length(left, right):
+    longest = min(len(left), len(right), MAX_CHUNK_OVERLAP)
+    for size in range(longest, MIN_CHUNK_OVERLAP - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+# Drops repeated chunks and the spans neighbouring chunks share through chunk_overlap
+def dedupe_chunks(chunks):
+    selected = []
+    for chunk in chunks:
+        text = chunk.strip()
+        if not text or any(text in kept for kept in selected):
+            continue
+        for kept in selected:
+            head = _overlap_length(kept, text)
+            if head:
+                text = text[head:].lstrip()
+            tail = _overlap_length(text, kept)
+            if tail:
+                text = text[:-tail].rstrip()
+        if text:
+            selected.append(text)
+    return selected
+
+def _history_block(history):
+    return f"Conversation so far:\n{history}\n\n" if history else ""
+
+def _profile_block(profile):
+    return f"About the user, use this for questions about their own progress:\n{profile}\n\n" if profile else ""
+
+# Keeps the best-ranked chunks that fit the token budget left after the instructions,
+# user profile, history and query
+def assemble_context(chunks, query, token_budget=None, history="", profile=""):
+    token_budget = token_budget or PROMPT_TOKEN_BUDGET
+    remaining = token_budget - estimate_tokens(
+        PROMPT_TEMPLATE.format(profile=_profile_block(profile), history=_history_block(history),
+                               context="", query=query)
+    )
+    context = []
+    for text in dedupe_chunks(chunks):
+        cost = estimate_tokens(text)
+        if cost <= remaining:
+            context.append(text)
+            remaining -= cost
+            continue
+        if remaining >= MIN_PARTIAL_CHUNK_TOKENS:
+            context.append(truncate_to_tokens(text, remaining))
+        break
+    return context
+
+# Builds the prompt sent to the LLM from the retrieved context, best-ranked chunks first,
+# and the user's fitness summary and conversation history if there are any
+def build_prompt(context, query, token_budget=None, history="", profile=""):
+    token_budget = token_budget or PROMPT_TOKEN_BUDGET
+    query = truncate_to_tokens(query, token_budget // 4)
+    history = truncate_to_tokens(history, token_budget // 4)
+    profile = truncate_to_tokens(profile, token_budget // 4)
+    context = "\n".join(assemble_context(context, query, token_budget, history, profile))
+    return PROMPT_TEMPLATE.format(profile=_profile_block(profile), history=_history_block(history),
+                                  context=context, query=query)
+
+class GenerationUnavailable(Exception):
+    """
+    Raised when the generation backend is not called at all or gives up:
+    the circuit breaker is open, every call slot is busy, or the deadline passed.
+    """
+
+
+class GeminiBackend:
+    name = "gemini"
+
+    def generate(self, prompt, timeout):
+        response = model.generate_content(prompt, request_options={"timeout": timeout})
+        return response.text
+
+    def generate_stream(self, prompt, timeout):
+        for chunk in model.generate_content(prompt, stream=True, request_options={"timeout": timeout}):
+            yield chunk.text or ""
+
+
+class StubBackend:
+    """
+    Deterministic offline backend for latency and load tests. It answers with
+    the first sentence of the retrieved context after a fixed delay.
+    """
+    name = "stub"
+
+    def __init__(self, latency=STUB_LATENCY, token_delay=0.0):
+        self.latency = latency
+        self.token_delay = token_delay
+
+    @staticmethod
+    def answer_for(prompt):
+        context = prompt.split("Context: ", 1)[-1].split("\n\nQuery: ", 1)[0]
+        first = re.split(r"(?<=[.!?])\s", cleaned_text(context), maxsplit=1)[0]
+        return f"According to the BurnBot guide: {first}" if first else "I don't know the answer to that."
+
+    def generate(self, prompt, timeout):
+        time.sleep(self.latency)
+        return self.answer_for(prompt)
+
+    def generate_stream(self, prompt, timeout):
+        time.sleep(self.latency)
+        for word in re.findall(r"\S+\s*", self.answer_for(prompt)):
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            yield word
+
+
+GENERATION_BACKENDS = {"gemini": GeminiBackend, "stub": StubBackend}
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and fails fast until
+    reset_seconds have passed; then a single trial call decides whether it
+    closes again or stays open for another period.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                return "half_open"
+            return "open"
+
+    # "call" while closed, "trial" for the single call let through when half open, else None
+    def admit(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "call"
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._trial_running:
+                return None
+            self._trial_running = True
+            return "trial"
+
+    def allow(self):
+        return self.admit() is not None
+
+    # The trial call ended without a result, so the next call may try again
+    def release_trial(self):
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class Generator:
+    """
+    Wraps a generation backend with a per-call deadline, a cap on concurrent
+    upstream calls and a circuit breaker, so a slow or failing LLM cannot tie
+    up Flask worker threads. A call slot is only freed when the upstream call
+    really finishes, so calls that outlive their deadline still count.
+    """
+
+    def __init__(self, backend=None, timeout=GENERATION_TIMEOUT,
+                 max_concurrency=GENERATION_MAX_CONCURRENCY, slot_wait=GENERATION_SLOT_WAIT,
+                 breaker=None, stream_limit=GENERATION_STREAM_LIMIT):
+        self.backend = backend if backend is not None else GENERATION_BACKENDS[GENERATION_BACKEND]()
+        self.timeout = timeout
+        self.stream_limit = stream_limit
+        self.slot_wait = slot_wait
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="burnbot-generate")
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    # Returns the future and whether the call is the breaker's half-open trial
+    def _start(self, fn, *args):
+        admitted = self.breaker.admit()
+        if admitted is None:
+            self._count("rejected_open")
+            raise GenerationUnavailable("circuit breaker is open")
+        trial = admitted == "trial"
+        if not self._slots.acquire(timeout=self.slot_wait):
+            if trial:
+                self.breaker.release_trial()
+            self._count("rejected_busy")
+            raise GenerationUnavailable("all generation slots are busy")
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            if trial:
+                self.breaker.release_trial()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future, trial
+
+    def _failure(self, key):
+        self._count(key)
+        self.breaker.record_failure()
+
+    def generate(self, prompt):
+        future, trial = self._start(self.backend.generate, prompt, self.timeout)
+        try:
+            text = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            self._failure("timeouts")
+            raise GenerationUnavailable(f"no answer within {self.timeout}s")
+        except Exception:
+            self._failure("errors")
+            raise
+        except BaseException:
+            if trial:
+                self.breaker.release_trial()
+            raise
+        self.breaker.record_success()
+        self._count("succeeded")
+        return text
+
+    def generate_stream(self, prompt):
+        pieces = queue.Queue()
+
+        def produce():
+            try:
+                for piece in self.backend.generate_stream(prompt, self.stream_limit):
+                    pieces.put(("piece", piece))
+                pieces.put(("done", None))
+            except Exception as e:
+                pieces.put(("error", e))
+
+        _, trial = self._start(produce)
+        recorded = False
+        try:
+            while True:
+                # The deadline covers the wait for each piece, so long healthy answers are not cut off
+                try:
+                    kind, value = pieces.get(timeout=self.timeout)
+                except queue.Empty:
+                    recorded = True
+                    self._failure("timeouts")
+                    raise GenerationUnavailable(f"no answer piece within {self.timeout}s")
+                if kind == "piece":
+                    yield value
+                elif kind == "done":
+                    recorded = True
+                    self.breaker.record_success()
+                    self._count("succeeded")
+                    return
+                else:
+                    recorded = True
+                    self._failure("errors")
+                    raise value
+        finally:
+            # A client that disconnects mid-stream closes the generator without a result
+            if trial and not recorded:
+                self.breaker.release_trial()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counts)
+        stats["backend"] = self.backend.name
+        stats["breaker"] = self.breaker.state
+        return stats
+
+
+generator = Generator()
+
+TRUNCATED_NOTICE = "\n\n(My answer was cut short, please ask again.)"
+FALLBACK_INTRO = "I can't reach my answer service right now, but here is what I found in the BurnBot guide:"
+
+# Retrieval-only answer served while the generation backend is unhealthy
+def fallback_response(context):
+    if not context:
+        return "I can't reach my answer service right now. Please try again in a moment."
+    return FALLBACK_INTRO + "\n\n" + "\n\n".join(context)
+
+# Only real generated answers are worth caching
+def is_generated_answer(answer):
+    return (
+        bool(answer)
+        and not answer.startswith(("Gemini API error", FALLBACK_INTRO, "I can't reach"))
+        and not answer.endswith(TRUNCATED_NOTICE.strip())
+    )
+
 # Function to generate a response using the LLM model
-def gemini_response(context, query):
-    context = "\n".join(context)
-    prompt = f"You are a fitness assistant and your task is to answer user query in polite and concise manner.Generate a human response for all the queries.\n\nUse the following context to answer the query asked by the user.\n\nContext: {context}\n\nQuery: {query}\n\nStick to the context and generate response accordingly.If you don't know the answer, convey that you don't know the answer."
+def gemini_response(context, query, history="", profile=""):
+    prompt = build_prompt(context, query, history=history, profile=profile)
     try:
-        response = model.generate_content(prompt)
-        answer = response.text.strip()
+        answer = generator.generate(prompt).strip()
         return re.sub(r"\*+", "", answer)
+    except GenerationUnavailable:
+        return fallback_response(context)
+    except Exception as e:
+        return f"Gemini API error: {e}\n\n" + fallback_response(context)
+
+# Streaming variant of gemini_response, yields the answer piece by piece
+def gemini_response_stream(context, query, history="", profile=""):
+    prompt = build_prompt(context, query, history=history, profile=profile)
+    started = False
+    try:
+        for text in generator.generate_stream(prompt):
+            piece = re.sub(r"\*+", "", text)
+            if not started:
+                piece = piece.lstrip()
+                started = bool(piece)
+            if piece:
+                yield piece
+    except GenerationUnavailable:
+        yield fallback_response(context) if not started else TRUNCATED_NOTICE
     except Exception as e:
-        return f"Gemini API error: {e}"
+        yield f"Gemini API error: {e}\n\n" + fallback_response(context) if not started else TRUNCATED_NOTICE
+
+MENU_COMMANDS = ["0", "menu", "start", "reset", "restart"]
+
+def menu_message():
+    return (
+        f"Hello there! I am BurnBot, and I am here to help you achieve your fitness goals.\n\n"
+        + "Select an option below.\n\n"
+        + "0. View the menu again.\n"
+        + "1. Tell me the food item, and I'll fetch its calorie count for you!\n"
+        + "2. Ask a fitness-related question from the document!\n"
+    )
+
+MENU_OPTION_REPLIES = {
+    "1": "Tell me the food item, for example \"calories in banana\", and I'll fetch its calorie count for you!",
+    "2": "Go ahead and ask your fitness-related question!",
+}
+
+# Example utterances for each intent, the centroid of their embeddings backs up the rules
+INTENT_EXAMPLES = {
+    "calories": [
+        "how many calories are in a banana",
+        "calories in rice",
+        "what is the calorie count of an apple",
+        "how much energy does pizza have",
+        "kcal in oatmeal",
+    ],
+    "bmi": [
+        "what is my bmi",
+        "calculate my body mass index",
+        "am I overweight for my height",
+    ],
+    "greeting": ["hi", "hello there", "hey burnbot", "thanks", "thank you so much"],
+    "question": [
+        "what workouts help with belly fat",
+        "who trains the yoga class",
+        "how long is the swimming plan",
+        "what should I eat before a workout",
+        "tips for better recovery after running",
+    ],
+}
+INTENT_MIN_SIMILARITY = float(os.getenv("BURNBOT_INTENT_SIMILARITY", "0.6"))
 
-def bot_response(query, index, chunks):
+CALORIE_PATTERNS = [
+    re.compile(
+        r"^(?:how many |what are the |what is the |number of )?(?:calories|calorie count|kcal)"
+        r"(?: are| is)?(?: there)? (?:in|of|for) (?:an? |the |one )?(?P<food>[a-z][a-z '-]*?)\s*\??$"
+    ),
+    re.compile(r"^how many calories (?:does|do|are in) (?:an? |the )?(?P<food>[a-z][a-z '-]*?)(?: have)?\s*\??$"),
+    re.compile(r"^(?P<food>[a-z][a-z '-]*?) (?:calories|kcal)\s*\??$"),
+]
+BMI_WEIGHT_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*kg")
+BMI_HEIGHT_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*cm")
+# Without kg and cm figures a BMI question is only for the calculator when it is about the
+# user's own BMI; "is bmi accurate for athletes" goes to retrieval instead
+BMI_OWN_PATTERN = re.compile(r"\b(?:my|calculate|compute)\b")
+GREETINGS = {"hi", "hello", "hey", "thanks", "thank you", "good morning", "good evening"}
+CALORIE_WORDS = {"calories", "calorie", "kcal", "many", "much", "count", "energy", "have",
+                 "has", "contain", "contains", "there", "eat", "number"}
+# A calorie lookup names a food in a few words; captures with these words are questions
+# about calories ("how to burn calories") and go to retrieval instead
+NOT_FOOD_WORDS = {"how", "what", "why", "when", "which", "who", "many", "much", "burn", "burned",
+                  "burning", "lose", "losing", "best", "way", "ways", "to", "should", "can", "do",
+                  "does", "i", "my", "me", "need", "per", "day", "daily", "week", "workout", "exercise"}
+FOOD_MAX_TERMS = 3
+
+
+def is_food_phrase(food):
+    terms = food.split()
+    return 0 < len(terms) <= FOOD_MAX_TERMS and NOT_FOOD_WORDS.isdisjoint(terms)
+
+
+class IntentRouter:
+    """
+    Lightweight intent classifier in front of the RAG pipeline. Menu commands,
+    greetings, calorie lookups and BMI questions go to fast local handlers and
+    only open-ended questions reach retrieval and the LLM. Rules settle the
+    clear cases, otherwise the cached query embedding is compared with the
+    centroid of each intent's example utterances.
+    """
+
+    def __init__(self, examples=INTENT_EXAMPLES, min_similarity=INTENT_MIN_SIMILARITY):
+        self.examples = examples
+        self.min_similarity = min_similarity
+        self._centroids = None
+        self._lock = threading.Lock()
+        self.handlers = {
+            "menu": lambda query, slots: menu_message(),
+            "menu_option": lambda query, slots: MENU_OPTION_REPLIES[slots["option"]],
+            "greeting": lambda query, slots: (
+                "Hi! I am BurnBot. Ask me a fitness question, or type 'menu' to see what I can do."
+            ),
+        }
+        self.counts = Counter()
+
+    # Handlers take (query, slots) and return an answer, or None to fall back to the LLM
+    def register(self, intent, handler):
+        self.handlers[intent] = handler
+
+    def _centroid_matrix(self):
+        if self._centroids is None:
+            with self._lock:
+                if self._centroids is None:
+                    names = list(self.examples)
+                    rows = []
+                    for name in names:
+                        vectors = np.asarray(embedding_model.encode(self.examples[name]), dtype="float32")
+                        centroid = vectors.mean(axis=0)
+                        rows.append(centroid / (np.linalg.norm(centroid) or 1.0))
+                    self._centroids = (names, np.vstack(rows))
+        return self._centroids
+
+    def nearest_intent(self, query):
+        names, centroids = self._centroid_matrix()
+        vector = encode_query(query)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        similarities = centroids @ vector
+        best = int(np.argmax(similarities))
+        return names[best], float(similarities[best])
+
+    # centroids=False settles on "question" when no rule matches, without embedding the query
+    def classify(self, query, centroids=True):
+        query = cleaned_text(query.lower())
+        if query in MENU_COMMANDS:
+            return "menu", {}
+        if query in MENU_OPTION_REPLIES:
+            return "menu_option", {"option": query}
+        if query.rstrip("!.") in GREETINGS:
+            return "greeting", {}
+        for pattern in CALORIE_PATTERNS:
+            match = pattern.match(query)
+            if match:
+                food = match.group("food").strip()
+                if not is_food_phrase(food):
+                    return "question", {}
+                return "calories", {"food": food}
+        if re.search(r"\bbmi\b|body mass index", query):
+            return self._bmi_intent(query)
+        if not centroids:
+            return "question", {}
+
+        intent, similarity = self.nearest_intent(query)
+        if intent == "question" or similarity < self.min_similarity:
+            return "question", {}
+        if intent == "calories":
+            food = " ".join(term for term in tokenize(query) if term not in CALORIE_WORDS)
+            if not is_food_phrase(food):
+                return "question", {}
+            return "calories", {"food": food}
+        if intent == "bmi":
+            return self._bmi_intent(query)
+        return intent, {}
+
+    def _bmi_intent(self, query):
+        slots = self._bmi_slots(query)
+        if not slots and not BMI_OWN_PATTERN.search(query):
+            return "question", {}
+        return "bmi", slots
+
+    @staticmethod
+    def _bmi_slots(query):
+        weight = BMI_WEIGHT_PATTERN.search(query)
+        height = BMI_HEIGHT_PATTERN.search(query)
+        slots = {}
+        if weight and height:
+            slots = {"weight": float(weight.group(1)), "height": float(height.group(1))}
+        return slots
+
+    def route(self, query, centroids=True):
+        intent, slots = self.classify(query, centroids)
+        self.counts[intent] += 1
+        handler = self.handlers.get(intent)
+        if handler is None:
+            return None
+        return handler(query, slots)
+
+
+# Cached answer for the query and the vector to store a new answer with. Lexical-only
+# queries are looked up by their text and never embedded.
+def lookup_answer(query, answer_cache, corpus_version, lexical_only=False):
+    if lexical_only:
+        return answer_cache.lookup_text(EmbeddingCache.normalize(query), corpus_version), None
+    query_vector = encode_query(query)
+    return answer_cache.lookup(query_vector, corpus_version), query_vector
+
+def bot_response(query, index, chunks, answer_cache=None, corpus_version=0, lexical=None,
+                 router=None, history="", retrieval_query=None, profile=""):
     query = query.lower().strip()
-    if query in ["0", "menu", "start", "reset", "restart"]:
-        return (
-            f"Hello there! I am BurnBot, and I am here to help you achieve your fitness goals.\n\n"
-            + "Select an option below.\n\n"
-            + "0. View the menu again.\n"
-            + "1. Tell me the food item, and I'll fetch its calorie count for you!\n"
-            + "2. Ask a fitness-related question from the document!\n"
-        )
+    # Answers that depend on earlier turns or on the user's own data are neither
+    # served from nor stored in the cache
+    if history or profile:
+        answer_cache = None
+    if query in MENU_COMMANDS:
+        return menu_message()
+
+    lexical_only = is_lexical_only(query, lexical)
+    if router is not None:
+        routed = router.route(query, centroids=not lexical_only)
+        if routed is not None:
+            return routed
     
-    context = retrieve_context(query, index, chunks)
-    answer = gemini_response(context, query)
+    if answer_cache is not None:
+        cached, query_vector = lookup_answer(query, answer_cache, corpus_version, lexical_only)
+        if cached is not None:
+            return cached
+
+    context = retrieve_context(retrieval_query or query, index, chunks, lexical=lexical)
+    answer = gemini_response(context, query, history=history, profile=profile)
+    if answer_cache is not None and is_generated_answer(answer):
+        answer_cache.store(query_vector, answer, corpus_version, EmbeddingCache.normalize(query))
     return answer
 
-def initialize_rag():
-    paragraphs = extract_text_from_document(DOC_PATH)
+# Streaming variant of bot_response, cached and menu answers are sent in one piece
+def bot_response_stream(query, index, chunks, answer_cache=None, corpus_version=0, lexical=None,
+                        router=None, history="", retrieval_query=None, profile=""):
+    query = query.lower().strip()
+    # Answers that depend on earlier turns or on the user's own data are neither
+    # served from nor stored in the cache
+    if history or profile:
+        answer_cache = None
+    if query in MENU_COMMANDS:
+        yield menu_message()
+        return
+
+    lexical_only = is_lexical_only(query, lexical)
+    if router is not None:
+        routed = router.route(query, centroids=not lexical_only)
+        if routed is not None:
+            yield routed
+            return
+
+    if answer_cache is not None:
+        cached, query_vector = lookup_answer(query, answer_cache, corpus_version, lexical_only)
+        if cached is not None:
+            yield cached
+            return
+
+    context = retrieve_context(retrieval_query or query, index, chunks, lexical=lexical)
+    pieces = []
+    for piece in gemini_response_stream(context, query, history=history, profile=profile):
+        pieces.append(piece)
+        yield piece
+    answer = "".join(pieces).strip()
+    if answer_cache is not None and is_generated_answer(answer):
+        answer_cache.store(query_vector, answer, corpus_version, EmbeddingCache.normalize(query))
+
+# Answers a list of questions in order: retrieval is batched, generation fans out
+# to at most concurrency calls at a time. Generated answers are kept in the answer
+# cache so later /chat requests for the same questions are served from it. With a
+# deadline in seconds, questions not started by then are returned with no answer.
+def answer_batch(queries, index, chunks, lexical=None, concurrency=BATCH_CONCURRENCY,
+                 answer_cache=None, corpus_version=0, deadline=None):
+    start = time.perf_counter()
+    queries = [query.lower().strip() for query in queries]
+    contexts = retrieve_contexts(queries, index, chunks, lexical=lexical)
+    concurrency = max(1, min(concurrency, GENERATION_MAX_CONCURRENCY))
+
+    def answer(context, query):
+        if deadline is not None and time.perf_counter() - start >= deadline:
+            return None
+        return gemini_response(context, query)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="burnbot-batch") as pool:
+        answers = list(pool.map(answer, contexts, queries))
+
+    results = []
+    for query, answer in zip(queries, answers):
+        if answer is None:
+            results.append({"question": query, "answer": None, "generated": False})
+            continue
+        generated = is_generated_answer(answer)
+        if answer_cache is not None and generated:
+            answer_cache.store(encode_query(query), answer, corpus_version, EmbeddingCache.normalize(query))
+        results.append({"question": query, "answer": answer, "generated": generated})
+    elapsed = time.perf_counter() - start
+    stats = {
+        "questions": len(queries),
+        "generated": sum(result["generated"] for result in results),
+        "unanswered": sum(result["answer"] is None for result in results),
+        "seconds": round(elapsed, 3),
+        "questions_per_second": round(len(queries) / elapsed, 2) if elapsed else 0.0,
+    }
+    return results, stats
+
+def initialize_rag(source=DOC_PATH):
+    paragraphs = chain.from_iterable(iter_paragraphs(path) for path in corpus_files(source))
     chunks = chunk_text(paragraphs)
     index, chunk_store = build_faiss_index(chunks)
     return index, chunk_store
-        
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+# Single hash over every document name and content hash in the corpus
+def corpus_hash(document_hashes):
+    sha = hashlib.sha256()
+    for name in sorted(document_hashes):
+        sha.update(f"{name}:{document_hashes[name]}\n".encode("utf-8"))
+    return sha.hexdigest()
+
+# Cheap change detector checked between requests: names, sizes and mtimes of the documents
+def corpus_signature(source):
+    signature = []
+    for path in corpus_files(source):
+        stat = os.stat(path)
+        signature.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+def corpus_fingerprint(source):
+    hashes = {os.path.basename(path): file_hash(path) for path in corpus_files(source)}
+    return hashes, corpus_hash(hashes)
+
+
+class CorpusIndex:
+    """
+    Chunk store and ID-mapped FAISS index built from a corpus of documents.
+    Every chunk keeps its vector id, so syncing the corpus only re-chunks and
+    re-embeds documents that were added or changed and removes the vectors of
+    deleted documents, instead of rebuilding everything.
+    """
+
+    def __init__(self, index_type=None, params=None):
+        self.index_type = index_type or INDEX_TYPE
+        self.params = index_params(params)
+        self.index = None
+        # vector id -> chunk text
+        self.chunks = {}
+        # document name -> {"hash": content hash, "ids": vector ids of its chunks}
+        self.documents = {}
+        self.next_id = 0
+
+    @property
+    def source_hash(self):
+        return corpus_hash({name: doc["hash"] for name, doc in self.documents.items()})
+
+    def copy(self):
+        other = CorpusIndex(self.index_type, self.params)
+        if self.index is not None:
+            # Round trip through bytes so the copy owns its memory even when
+            # this index is memory-mapped from an artifact
+            other.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+            apply_search_params(other.index, self.params)
+        other.chunks = dict(self.chunks)
+        other.documents = {name: dict(doc) for name, doc in self.documents.items()}
+        other.next_id = self.next_id
+        return other
+
+    def _add(self, embeddings, ids):
+        if self.index is None:
+            index = create_index(self.index_type, embeddings.shape[1], len(embeddings), self.params)
+            # IVF indexes store ids natively, the others need an id map
+            if not isinstance(index, faiss.IndexIVF):
+                index = faiss.IndexIDMap2(index)
+            if not index.is_trained:
+                index.train(embeddings)
+            self.index = index
+        self.index.add_with_ids(embeddings, ids)
+
+    def _remove(self, ids):
+        if not ids or self.index is None:
+            return
+        try:
+            self.index.remove_ids(np.array(ids, dtype="int64"))
+        except RuntimeError:
+            # HNSW graphs cannot drop vectors, rebuild from the stored ones instead
+            removed = set(ids)
+            keep = np.array([i for i in self.chunks if i not in removed], dtype="int64")
+            vectors = [self.index.reconstruct(int(i)) for i in keep]
+            self.index = None
+            if vectors:
+                self._add(np.vstack(vectors).astype("float32"), keep)
+
+    # text_cache_dir keeps parsed .docx text between builds, None parses every time
+    def sync(self, source, text_cache_dir=None):
+        current = {os.path.basename(path): path for path in corpus_files(source)}
+        stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0,
+                 "chunks_embedded": 0, "chunks_removed": 0}
+        stale_ids = []
+        for name in list(self.documents):
+            if name not in current:
+                stale_ids.extend(self.documents.pop(name)["ids"])
+                stats["removed"] += 1
+
+        changed = []
+        for name, path in current.items():
+            digest = file_hash(path)
+            doc = self.documents.get(name)
+            if doc is not None and doc["hash"] == digest:
+                stats["unchanged"] += 1
+                continue
+            stats["updated" if doc is not None else "added"] += 1
+            if doc is not None:
+                stale_ids.extend(doc["ids"])
+            changed.append((name, path, digest))
+
+        self._remove(stale_ids)
+        for i in stale_ids:
+            self.chunks.pop(i, None)
+        stats["chunks_removed"] = len(stale_ids)
+
+        new_texts, new_ids = [], []
+        for name, path, digest in changed:
+            chunks = chunk_text(iter_paragraphs(path, text_cache_dir, digest))
+            ids = list(range(self.next_id, self.next_id + len(chunks)))
+            self.next_id += len(chunks)
+            self.documents[name] = {"hash": digest, "ids": ids}
+            self.chunks.update(zip(ids, chunks))
+            new_texts.extend(chunks)
+            new_ids.extend(ids)
+        if new_texts:
+            embeddings = np.ascontiguousarray(embedding_model.encode(new_texts), dtype="float32")
+            self._add(embeddings, np.array(new_ids, dtype="int64"))
+        stats["chunks_embedded"] = len(new_texts)
+
+        if self.index is not None:
+            apply_search_params(self.index, self.params)
+        if text_cache_dir:
+            # Renamed and deleted documents would otherwise leave their text behind for good
+            stats["text_pruned"] = prune_extract_cache(
+                text_cache_dir, [path for path in current.values() if path.lower().endswith(".docx")]
+            )
+        return stats
+
+
+# On-disk index artifacts, one directory per corpus hash and index configuration
+def artifact_path(source_hash, index_dir=INDEX_DIR):
+    return os.path.join(
+        index_dir, f"{source_hash[:16]}-{index_config_key()}-v{INDEX_FORMAT_VERSION}"
+    )
+
+# Names the newest artifact, the starting point for incremental rebuilds
+def latest_artifact_pointer(index_dir=INDEX_DIR):
+    return os.path.join(index_dir, f"LATEST-{index_config_key()}-v{INDEX_FORMAT_VERSION}")
+
+def save_index_artifact(corpus, index_dir=INDEX_DIR):
+    os.makedirs(index_dir, exist_ok=True)
+    source_hash = corpus.source_hash
+    target = artifact_path(source_hash, index_dir)
+    staging = tempfile.mkdtemp(dir=index_dir, prefix=".tmp-")
+    try:
+        index_sha256 = None
+        if corpus.index is not None:
+            faiss.write_index(corpus.index, os.path.join(staging, "index.faiss"))
+            index_sha256 = file_hash(os.path.join(staging, "index.faiss"))
+        manifest = {
+            "format_version": INDEX_FORMAT_VERSION,
+            "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "model": EMBEDDING_MODEL_NAME,
+            "source_hash": source_hash,
+            "index_type": corpus.index_type,
+            "index_config": index_config_key(corpus.index_type, corpus.params),
+            "dimension": corpus.index.d if corpus.index is not None else 0,
+            "chunk_count": len(corpus.chunks),
+            "index_sha256": index_sha256,
+            "next_id": corpus.next_id,
+            "documents": corpus.documents,
+            "chunks": {str(i): text for i, text in corpus.chunks.items()},
+        }
+        with open(os.path.join(staging, "chunks.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.replace(staging, target)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    pointer = latest_artifact_pointer(index_dir)
+    previous = None
+    if os.path.exists(pointer):
+        with open(pointer, encoding="utf-8") as f:
+            previous = f.read().strip()
+    with open(pointer + ".tmp", "w", encoding="utf-8") as f:
+        f.write(source_hash)
+    os.replace(pointer + ".tmp", pointer)
+    # Keep the new artifact and the one before it, workers may still have it mapped
+    keep = {os.path.basename(target)}
+    if previous:
+        keep.add(os.path.basename(artifact_path(previous, index_dir)))
+    suffix = f"-{index_config_key()}-v{INDEX_FORMAT_VERSION}"
+    for name in os.listdir(index_dir):
+        if name.endswith(suffix) and name not in keep and not name.startswith("LATEST"):
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+    return target
+
+def load_index_artifact(source_hash, index_dir=INDEX_DIR):
+    target = artifact_path(source_hash, index_dir)
+    try:
+        with open(os.path.join(target, "chunks.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (
+        manifest.get("format_version") != INDEX_FORMAT_VERSION
+        or manifest.get("model") != EMBEDDING_MODEL_NAME
+        or manifest.get("source_hash") != source_hash
+        or manifest.get("index_config") != index_config_key()
+    ):
+        return None
+    corpus = CorpusIndex(manifest["index_type"])
+    corpus.chunks = {int(i): text for i, text in manifest["chunks"].items()}
+    corpus.documents = manifest["documents"]
+    corpus.next_id = manifest["next_id"]
+    if corpus.chunks:
+        index = faiss.read_index(os.path.join(target, "index.faiss"), FAISS_MMAP_FLAGS)
+        if index.ntotal != len(corpus.chunks):
+            return None
+        corpus.index = apply_search_params(index, corpus.params)
+    return corpus
+
+# Problems found in a saved artifact, an empty list when it is safe to serve
+def validate_index_artifact(target, dimension=None):
+    try:
+        with open(os.path.join(target, "chunks.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        return [f"unreadable manifest: {e}"]
+    problems = []
+    if manifest.get("format_version") != INDEX_FORMAT_VERSION:
+        problems.append(f"format version {manifest.get('format_version')} is not {INDEX_FORMAT_VERSION}")
+    if manifest.get("model") != EMBEDDING_MODEL_NAME:
+        problems.append(f"built with {manifest.get('model')}, not {EMBEDDING_MODEL_NAME}")
+    chunks = manifest.get("chunks", {})
+    if manifest.get("chunk_count") != len(chunks):
+        problems.append(f"manifest lists {manifest.get('chunk_count')} chunks but stores {len(chunks)}")
+    document_ids = sorted(i for document in manifest.get("documents", {}).values() for i in document["ids"])
+    if document_ids != sorted(int(i) for i in chunks):
+        problems.append("document chunk ids do not match the chunk store")
+    if not all(text.strip() for text in chunks.values()):
+        problems.append("chunk store has empty chunks")
+    if not chunks:
+        return problems
+
+    path = os.path.join(target, "index.faiss")
+    if not os.path.exists(path):
+        return problems + ["index.faiss is missing"]
+    if manifest.get("index_sha256") and file_hash(path) != manifest["index_sha256"]:
+        return problems + ["index.faiss does not match its checksum"]
+    try:
+        index = faiss.read_index(path, FAISS_MMAP_FLAGS)
+    except RuntimeError as e:
+        return problems + [f"unreadable index: {e}"]
+    if index.ntotal != len(chunks):
+        problems.append(f"index holds {index.ntotal} vectors for {len(chunks)} chunks")
+    if index.d != manifest.get("dimension") or (dimension is not None and index.d != dimension):
+        problems.append(f"index dimension {index.d} does not match the embedding model")
+    return problems
+
+def load_latest_index_artifact(index_dir=INDEX_DIR):
+    try:
+        with open(latest_artifact_pointer(index_dir), encoding="utf-8") as f:
+            source_hash = f.read().strip()
+    except OSError:
+        return None
+    return load_index_artifact(source_hash, index_dir)
+
+# Lets one process at a time bring the index in index_dir up to date, so web
+# workers that see the same corpus change wait for one build instead of each
+# embedding it
+@contextmanager
+def index_build_lock(index_dir):
+    if fcntl is None or not index_dir:
+        yield
+        return
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, ".build.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# Loads the prebuilt index for this corpus if one exists, otherwise brings the
+# newest index (base) up to date with the corpus and saves the result. With
+# build=False nothing is embedded: the newest prebuilt index is served instead.
+def load_or_build_index(source=CORPUS_DIR, index_dir=INDEX_DIR, source_hash=None, base=None,
+                        build=True):
+    if source_hash is None:
+        source_hash = corpus_fingerprint(source)[1]
+    if index_dir:
+        corpus = load_index_artifact(source_hash, index_dir)
+        if corpus is not None:
+            return corpus
+        if base is None:
+            base = load_latest_index_artifact(index_dir)
+    if not build:
+        if base is None:
+            raise FileNotFoundError(f"No prebuilt BurnBot index in {index_dir}, run --build-index")
+        print("BurnBot corpus changed since the index was built, serving the prebuilt index")
+        return base
+    with index_build_lock(index_dir):
+        if index_dir:
+            # Another worker may have built it while this one waited for the lock
+            corpus = load_index_artifact(source_hash, index_dir)
+            if corpus is not None:
+                return corpus
+        corpus = base.copy() if base is not None else CorpusIndex()
+        stats = corpus.sync(source, os.path.join(index_dir, EXTRACT_CACHE_SUBDIR) if index_dir else None)
+        print(f"BurnBot corpus synced: {stats}")
+        if index_dir:
+            try:
+                save_index_artifact(corpus, index_dir)
+            except OSError as e:
+                print(f"Could not save BurnBot index to {index_dir}: {e}")
+            else:
+                # Serve the saved artifact memory-mapped, sharing its pages with the other workers
+                saved = load_index_artifact(corpus.source_hash, index_dir)
+                if saved is not None:
+                    corpus = saved
+    return corpus
+
+
+# Words and openings that point back at an earlier turn; question fragments of at
+# most FOLLOW_UP_MAX_WORDS words ("how often?", "why?") lean on it too. Other short
+# messages ("best cardio") stand on their own.
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b(it|its|that|this|those|these|them|they|their|he|she|him|her|his|there|one|ones|"
+    r"same|also|else|instead|another|again|more|too|then)\b|^(and|but|so|what about|how about)\b",
+    re.IGNORECASE,
+)
+FOLLOW_UP_FRAGMENT = re.compile(r"^(how|why|what|when|where|which|who)\b", re.IGNORECASE)
+FOLLOW_UP_MAX_WORDS = 2
+
+def is_follow_up(query):
+    query = query.strip()
+    if FOLLOW_UP_PATTERN.search(query) is not None:
+        return True
+    return len(re.findall(r"\w+", query)) <= FOLLOW_UP_MAX_WORDS and FOLLOW_UP_FRAGMENT.match(query) is not None
+
+
+class ConversationMemory:
+    """
+    Per-session chat history for follow-up questions, held to a fixed token
+    budget. The last recent_turns exchanges are kept verbatim; older ones are
+    folded into a rolling summary of what was asked and answered, trimmed
+    oldest first to summary_tokens. Sessions idle for idle_seconds, or the
+    least recently used beyond max_sessions, are evicted.
+    """
+
+    def __init__(self, max_sessions=MEMORY_MAX_SESSIONS, idle_seconds=MEMORY_IDLE_SECONDS,
+                 recent_turns=MEMORY_RECENT_TURNS, token_budget=MEMORY_TOKEN_BUDGET,
+                 summary_tokens=MEMORY_SUMMARY_TOKENS):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.recent_turns = recent_turns
+        self.token_budget = token_budget
+        self.summary_tokens = min(summary_tokens, token_budget)
+        self._lock = threading.Lock()
+        # session id -> {"turns", "summary", "seen"}, least recently used first
+        self._sessions = OrderedDict()
+        self.evictions = 0
+
+    def _digest(self, question, answer):
+        first = re.split(r"(?<=[.!?])\s", cleaned_text(answer), maxsplit=1)[0]
+        return truncate_to_tokens(f"Asked {cleaned_text(question)}; answered {first}", self.summary_tokens // 2)
+
+    def _evict(self, now):
+        while self._sessions:
+            session_id, conversation = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - conversation["seen"] < self.idle_seconds:
+                break
+            del self._sessions[session_id]
+            self.evictions += 1
+
+    def _session(self, session_id, now):
+        conversation = self._sessions.get(session_id)
+        if conversation is not None and now - conversation["seen"] >= self.idle_seconds:
+            del self._sessions[session_id]
+            self.evictions += 1
+            conversation = None
+        if conversation is not None:
+            self._sessions.move_to_end(session_id)
+        return conversation
+
+    def record(self, session_id, question, answer):
+        now = time.monotonic()
+        with self._lock:
+            conversation = self._session(session_id, now)
+            if conversation is None:
+                conversation = self._sessions[session_id] = {"turns": deque(), "summary": deque(), "seen": now}
+            conversation["seen"] = now
+            conversation["turns"].append((cleaned_text(question), cleaned_text(answer)))
+            while len(conversation["turns"]) > self.recent_turns:
+                conversation["summary"].append(self._digest(*conversation["turns"].popleft()))
+            summary = conversation["summary"]
+            while summary and estimate_tokens(" ".join(summary)) > self.summary_tokens:
+                summary.popleft()
+            self._evict(now)
+
+    # History for the prompt: summary first, then the recent turns, newest kept whole if it fits
+    def render(self, session_id):
+        with self._lock:
+            conversation = self._session(session_id, time.monotonic())
+            if conversation is None:
+                return ""
+            summary = " ".join(conversation["summary"])
+            turns = list(conversation["turns"])
+        lines = [f"Earlier: {summary}"] if summary else []
+        budget = self.token_budget - sum(estimate_tokens(line) for line in lines)
+        recent = []
+        for question, answer in reversed(turns):
+            line = truncate_to_tokens(f"User: {question}\nBurnBot: {answer}", budget)
+            if not line:
+                break
+            recent.append(line)
+            budget -= estimate_tokens(line)
+        return "\n".join(lines + recent[::-1])
+
+    def last_question(self, session_id):
+        with self._lock:
+            conversation = self._sessions.get(session_id)
+            return conversation["turns"][-1][0] if conversation and conversation["turns"] else None
+
+    def forget(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "evictions": self.evictions}
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls that share a key into one.
+    The first caller runs the function, callers arriving while it runs
+    wait for it and share its result (or its exception). Streams are shared
+    the same way: the leader's pieces are kept in a buffer that followers
+    read from as they arrive.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # key -> {"pieces", "done", "error", "followers", "changed"} of each stream in flight
+        self._streams = {}
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.leaders += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            with self._lock:
+                self._calls.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._calls.pop(key, None)
+        future.set_result(result)
+        return result
+
+    # Streaming variant of do(): fn returns an iterator and every caller gets all its pieces.
+    # Callers join the flight when they start reading.
+    def stream(self, key, fn, *args, **kwargs):
+        with self._lock:
+            flight = self._streams.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._streams[key] = {
+                    "pieces": [], "done": False, "error": None, "followers": 0,
+                    "changed": threading.Condition(self._lock),
+                }
+                self.leaders += 1
+            else:
+                flight["followers"] += 1
+                self.shared += 1
+        if leader:
+            yield from self._lead(key, flight, fn, args, kwargs)
+        else:
+            yield from self._follow(flight)
+
+    def _publish(self, flight, piece):
+        with self._lock:
+            flight["pieces"].append(piece)
+            flight["changed"].notify_all()
+
+    def _finish(self, key, flight, error=None):
+        with self._lock:
+            flight["done"] = True
+            flight["error"] = error
+            if self._streams.get(key) is flight:
+                del self._streams[key]
+            flight["changed"].notify_all()
+
+    def _lead(self, key, flight, fn, args, kwargs):
+        source = None
+        try:
+            source = fn(*args, **kwargs)
+            for piece in source:
+                self._publish(flight, piece)
+                yield piece
+        except Exception as e:
+            self._finish(key, flight, e)
+            raise
+        finally:
+            if not flight["done"]:
+                # Closed before the end: finish the answer if anyone else is reading it
+                with self._lock:
+                    orphaned = flight["followers"] == 0
+                    if orphaned:
+                        del self._streams[key]
+                try:
+                    if source is not None:
+                        if orphaned:
+                            source.close()
+                        else:
+                            for piece in source:
+                                self._publish(flight, piece)
+                    self._finish(key, flight)
+                except Exception as e:
+                    self._finish(key, flight, e)
+
+    def _follow(self, flight):
+        sent = 0
+        try:
+            while True:
+                with self._lock:
+                    while sent == len(flight["pieces"]) and not flight["done"]:
+                        flight["changed"].wait()
+                    pieces = flight["pieces"][sent:]
+                    done, error = flight["done"], flight["error"]
+                for piece in pieces:
+                    yield piece
+                sent += len(pieces)
+                if done:
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            with self._lock:
+                flight["followers"] -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls) + len(self._streams), "leaders": self.leaders,
+                    "shared": self.shared}
+
+
+# Offline build for deploy pipelines: brings the artifact for the corpus up to
+# date, then checks what was written. Returns the artifact path and any problems.
+def build_index_artifact(source=CORPUS_DIR, index_dir=INDEX_DIR):
+    corpus = load_or_build_index(source, index_dir)
+    target = artifact_path(corpus.source_hash, index_dir)
+    return target, validate_index_artifact(target, embedding_model.get_sentence_embedding_dimension())
+
+
+class WarmUp:
+    """
+    Loads the embedding model and the index on a background thread at boot,
+    so the first chat does not pay for it and other routes are never held up.
+    state is cold, warming, ready or failed.
+    """
+
+    def __init__(self, service, models=(embedding_model, model)):
+        self.service = service
+        self.models = models
+        self.state = "cold"
+        self.error = None
+        self.seconds = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self.state = "warming"
+                self._thread = threading.Thread(target=self._run, name="burnbot-warmup", daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            for lazy in self.models:
+                lazy.load()
+            # The first encode is much slower than the rest, pay for it here
+            embedding_model.encode(["warm up"])
+            self.service.snapshot()
+            self.state = "ready"
+        except Exception as e:
+            # Requests load lazily again and surface the error themselves
+            self.error = str(e)
+            self.state = "failed"
+            print(f"BurnBot warm-up failed: {e}")
+        finally:
+            self.seconds = round(time.perf_counter() - start, 3)
+            self._done.set()
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    # True once warm-up has finished (or was never started), False if it is still running after timeout
+    def wait(self, timeout=None):
+        if self._thread is None:
+            return True
+        return self._done.wait(timeout)
+
+    def status(self):
+        return {"state": self.state, "error": self.error, "seconds": self.seconds}
+
+
+class ChatOverloaded(Exception):
+    """Raised when the chat pool has no room for another request."""
+
+
+class ChatWorkerPool:
+    """
+    Runs chat requests on a fixed set of worker threads with a bounded queue,
+    so a burst of chat traffic cannot tie up every web worker thread.
+    Requests beyond the queue limit are refused at once, and requests that
+    wait in the queue longer than queue_timeout are dropped. Streamed answers
+    are produced on the pool too and relayed to the request thread piece by
+    piece.
+    """
+
+    def __init__(self, workers=CHAT_WORKERS, queue_limit=CHAT_QUEUE_LIMIT,
+                 queue_timeout=CHAT_QUEUE_TIMEOUT, samples=1000):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="burnbot-chat")
+        self._lock = threading.Lock()
+        self.counts = Counter()
+        self.queued = 0
+        self.active = 0
+        # Recent queue wait and execution times in milliseconds
+        self._wait_ms = deque(maxlen=samples)
+        self._run_ms = deque(maxlen=samples)
+
+    def _run(self, enqueued, fn, args):
+        started = time.perf_counter()
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self._wait_ms.append((started - enqueued) * 1000.0)
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.active -= 1
+                self._run_ms.append((time.perf_counter() - started) * 1000.0)
+
+    def _done(self, future):
+        self._slots.release()
+        with self._lock:
+            if future.cancelled():
+                self.queued -= 1
+                self.counts["expired"] += 1
+            elif future.exception() is not None:
+                self.counts["failed"] += 1
+            else:
+                self.counts["completed"] += 1
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.counts["rejected"] += 1
+            raise ChatOverloaded("chat queue is full")
+        with self._lock:
+            self.queued += 1
+            self.counts["accepted"] += 1
+        future = self._executor.submit(self._run, time.perf_counter(), fn, args)
+        future.add_done_callback(self._done)
+        return future
+
+    def run(self, fn, *args):
+        future = self.submit(fn, *args)
+        try:
+            return future.result(timeout=self.queue_timeout)
+        except FutureTimeout:
+            # Still queued: give the slot back. Already running: generation has its own deadline.
+            if future.cancel():
+                raise ChatOverloaded("chat request waited too long in the queue")
+            return future.result()
+
+    # Runs fn(*args), which returns an iterator, on the pool and returns an iterator over
+    # what it yields. Admission works like run(); once started, the request thread only
+    # relays the pieces, and closing the relay stops the producer at its next piece.
+    def stream(self, fn, *args):
+        pieces = queue.Queue()
+        started = threading.Event()
+        closed = threading.Event()
+
+        def produce():
+            started.set()
+            iterator = None
+            try:
+                iterator = fn(*args)
+                for piece in iterator:
+                    if closed.is_set():
+                        break
+                    pieces.put(("piece", piece))
+            except Exception as e:
+                pieces.put(("error", e))
+                raise
+            finally:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()
+                pieces.put(("done", None))
+
+        future = self.submit(produce)
+        with self._lock:
+            self.counts["streams"] += 1
+        if not started.wait(self.queue_timeout) and future.cancel():
+            raise ChatOverloaded("chat request waited too long in the queue")
+        return self._relay(pieces, closed)
+
+    @staticmethod
+    def _relay(pieces, closed):
+        try:
+            while True:
+                kind, value = pieces.get()
+                if kind == "piece":
+                    yield value
+                elif kind == "error":
+                    raise value
+                else:
+                    return
+        finally:
+            closed.set()
+
+    @staticmethod
+    def _percentiles(name, samples):
+        if not samples:
+            return {f"{name}_p50_ms": 0.0, f"{name}_p95_ms": 0.0, f"{name}_p99_ms": 0.0}
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+        return {f"{name}_p50_ms": round(float(p50), 3), f"{name}_p95_ms": round(float(p95), 3),
+                f"{name}_p99_ms": round(float(p99), 3)}
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "queued": self.queued,
+                "active": self.active,
+                **{key: self.counts[key]
+                   for key in ("accepted", "completed", "failed", "rejected", "expired", "streams")},
+            }
+            wait, run = list(self._wait_ms), list(self._run_ms)
+        stats.update(self._percentiles("queue_wait", wait))
+        stats.update(self._percentiles("execution", run))
+        return stats
+
+
+# Everything a request needs from one build of the corpus, replaced as a whole
+RAGSnapshot = namedtuple("RAGSnapshot", "index chunks lexical signature source_hash version")
+
+
+class RAGService:
+    """
+    Process-wide holder for the FAISS index and chunk store.
+    The index is built once and shared by every request; when the corpus
+    changes it is brought up to date on a background thread and swapped in.
+    """
+
+    def __init__(self, source=CORPUS_DIR, check_interval=5.0, index_dir=INDEX_DIR,
+                 answer_cache=None, router=None, single_flight=None,
+                 prebuilt_only=PREBUILT_INDEX_ONLY, memory=None):
+        self.source = source
+        self.prebuilt_only = prebuilt_only
+        self.index_dir = index_dir
+        self.answer_cache = SemanticAnswerCache() if answer_cache is None else answer_cache
+        self.router = IntentRouter() if router is None else router
+        # Identical questions asked at the same time share one retrieval and generation
+        self.single_flight = SingleFlight() if single_flight is None else single_flight
+        self.memory = ConversationMemory() if memory is None else memory
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = 0
+        self._last_check = 0.0
+        self._rebuild_thread = None
+        # Most recent corpus, the base for incremental rebuilds
+        self._corpus = None
+
+    @property
+    def version(self):
+        return self._version
+
+    def _build(self):
+        signature = corpus_signature(self.source)
+        corpus = load_or_build_index(self.source, self.index_dir, base=self._corpus,
+                                     build=not self.prebuilt_only)
+        self._corpus = corpus
+        lexical = BM25Index(corpus.chunks)
+        return corpus.index, corpus.chunks, lexical, signature, corpus.source_hash
+
+    def _install(self, index, chunks, lexical, signature, sha):
+        with self._lock:
+            self._version += 1
+            self._snapshot = RAGSnapshot(index, chunks, lexical, signature, sha, self._version)
+            # Answers generated from the old corpus must not outlive it
+            self.answer_cache.invalidate(self._version)
+
+    def snapshot(self):
+        snap = self._snapshot
+        if snap is None:
+            with self._lock:
+                snap = self._snapshot
+                if snap is None:
+                    self._version += 1
+                    snap = RAGSnapshot(*self._build(), self._version)
+                    self._snapshot = snap
+            self._last_check = time.monotonic()
+            return snap
+        self._maybe_refresh(snap)
+        return snap
+
+    def get(self):
+        snap = self.snapshot()
+        return snap.index, snap.chunks
+
+    def _maybe_refresh(self, snap):
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        try:
+            signature = corpus_signature(self.source)
+        except OSError:
+            return
+        if signature == snap.signature:
+            return
+        with self._lock:
+            if self._rebuild_thread is not None and self._rebuild_thread.is_alive():
+                return
+            self._rebuild_thread = threading.Thread(
+                target=self._rebuild, args=(snap,), daemon=True
+            )
+            self._rebuild_thread.start()
+
+    def _rebuild(self, previous):
+        try:
+            signature = corpus_signature(self.source)
+            if corpus_fingerprint(self.source)[1] == previous.source_hash:
+                # Touched but not edited, keep serving the current index
+                with self._lock:
+                    if self._snapshot is previous:
+                        self._snapshot = previous._replace(signature=signature)
+                return
+            self._install(*self._build())
+        except Exception as e:
+            print(f"BurnBot index rebuild failed: {e}")
+
+    def refresh(self):
+        # Synchronous rebuild, used by tests and admin tooling
+        self._install(*self._build())
+
+    # History and retrieval query for a follow-up in session_id. Questions that stand on
+    # their own get neither, so they are still served from the answer cache and single-flight
+    def _conversation(self, query, session_id):
+        if session_id is None:
+            return "", None
+        if EmbeddingCache.normalize(query) in ("reset", "restart"):
+            self.memory.forget(session_id)
+            return "", None
+        previous = self.memory.last_question(session_id)
+        if previous is None or not is_follow_up(query):
+            return "", None
+        return self.memory.render(session_id), f"{previous} {query}"
+
+    # Menu, greetings and the local handlers answer without the index, so they never
+    # wait for it to be built (or fail when no prebuilt one exists)
+    def _route(self, query):
+        query = query.lower().strip()
+        if query in MENU_COMMANDS:
+            return menu_message()
+        # Once the index is loaded, short keyword queries skip the intent centroids
+        snap = self._snapshot
+        lexical_only = snap is not None and is_lexical_only(query, snap.lexical)
+        return self.router.route(query, centroids=not lexical_only)
+
+    # profile is the asking user's fitness summary, for questions about their own progress
+    def answer(self, query, session_id=None, profile=""):
+        history, retrieval_query = self._conversation(query, session_id)
+        answer = self._route(query)
+        if answer is None:
+            snap = self.snapshot()
+            if history or profile:
+                answer = bot_response(query, snap.index, snap.chunks, None, snap.version, snap.lexical,
+                                      None, history, retrieval_query, profile)
+            else:
+                key = (EmbeddingCache.normalize(query), snap.version)
+                answer = self.single_flight.do(key, bot_response, query, snap.index, snap.chunks,
+                                               self.answer_cache, snap.version, snap.lexical)
+        self._remember(session_id, query, answer)
+        return answer
+
+    def answer_batch(self, queries, concurrency=BATCH_CONCURRENCY, deadline=None):
+        snap = self.snapshot()
+        return answer_batch(queries, snap.index, snap.chunks, snap.lexical, concurrency,
+                            self.answer_cache, snap.version, deadline)
+
+    def answer_stream(self, query, session_id=None, profile=""):
+        history, retrieval_query = self._conversation(query, session_id)
+        routed = self._route(query)
+        if routed is not None:
+            pieces = iter([routed])
+        elif history or profile:
+            snap = self.snapshot()
+            pieces = bot_response_stream(query, snap.index, snap.chunks, None, snap.version,
+                                         snap.lexical, None, history, retrieval_query, profile)
+        else:
+            snap = self.snapshot()
+            # Same key as answer(), browsers asking the same question at once share one stream
+            key = (EmbeddingCache.normalize(query), snap.version)
+            pieces = self.single_flight.stream(key, bot_response_stream, query, snap.index, snap.chunks,
+                                               self.answer_cache, snap.version, snap.lexical)
+        if session_id is None:
+            return pieces
+        return self._remember_stream(pieces, query, session_id)
+
+    def _remember_stream(self, pieces, query, session_id):
+        answer = []
+        for piece in pieces:
+            answer.append(piece)
+            yield piece
+        self._remember(session_id, query, "".join(answer))
+
+    def _remember(self, session_id, query, answer):
+        # The menu is navigation, not conversation
+        if session_id is not None and query.lower().strip() not in MENU_COMMANDS:
+            self.memory.record(session_id, query, answer)
+
+
+rag_service = RAGService()
+chat_pool = ChatWorkerPool()
+warmup = WarmUp(rag_service)
+
 if __name__=="__main__":
-    index, chunk_store = initialize_rag()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="BurnBot retrieval-augmented answers")
+    parser.add_argument("--batch", help="file with one question per line to answer in a batch")
+    parser.add_argument("--output", help="write the batch answers here as JSON lines")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY,
+                        help="generation calls in flight during a batch")
+    parser.add_argument("--build-index", action="store_true",
+                        help="build and validate the index artifact for the corpus, then exit")
+    parser.add_argument("--verify-index", metavar="ARTIFACT",
+                        help="validate an existing index artifact directory, then exit")
+    parser.add_argument("--source", default=CORPUS_DIR, help="corpus file or directory")
+    parser.add_argument("--index-dir", default=INDEX_DIR, help="where index artifacts are kept")
+    args = parser.parse_args()
+
+    if args.build_index or args.verify_index:
+        if args.build_index:
+            target, problems = build_index_artifact(args.source, args.index_dir)
+        else:
+            target = args.verify_index
+            problems = validate_index_artifact(target, embedding_model.get_sentence_embedding_dimension())
+        for problem in problems:
+            print(f"BurnBot index problem: {problem}")
+        print(f"BurnBot index {target}: {'invalid' if problems else 'ok'}")
+        raise SystemExit(1 if problems else 0)
+
+    rag_service = RAGService(args.source, index_dir=args.index_dir)
+    index, chunk_store = rag_service.get()
+    if args.batch:
+        with open(args.batch, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+        results, stats = rag_service.answer_batch(questions, args.concurrency)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                for result in results:
+                    f.write(json.dumps(result) + "\n")
+        else:
+            for result in results:
+                print(f"Q: {result['question']}\nA: {result['answer']}\n")
+        print(f"BurnBot batch: {stats}")
@@ -0,0 +1,269 @@
+"""
+Copyright (c) 2025 Hank Lenham, Ryan McPhee, Lawrence Stephenson
+This code is licensed under MIT license (see LICENSE for details)
+
+@author: Burnout
+
+
+This python file is used in and is part of the Burnout project.
+It runs the BurnBot embedding model outside the web workers, so inference
+does not compete with request handling for the GIL and gets its own CPU
+threads. Texts are sent over a Unix socket and vectors come back through a
+shared memory block owned by each client.
+
+Usage:
+    python rag_embedding_worker.py /run/burnbot-embed.sock --threads 2   # sidecar
+    BURNBOT_EMBEDDING_WORKER=unix:/run/burnbot-embed.sock                # web workers use it
+    BURNBOT_EMBEDDING_WORKER=process     # each web process starts its own worker
+
+The sidecar and the web workers using it need the same BURNBOT_EMBEDDING_AUTHKEY.
+
+For more information about the Burnout project, visit:
+https://github.com/CSC510-Spring25-Group14/FitnessApp
+"""
+
+import argparse
+import atexit
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import AuthenticationError, resource_tracker
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+# Shared secret for the socket handshake; the sidecar and web workers must agree.
+# It is required: messages are pickled, so an unauthenticated peer could run code.
+AUTHKEY_ENV = "BURNBOT_EMBEDDING_AUTHKEY"
+# Texts per round trip, which also sizes each client's shared memory block
+MAX_BATCH = int(os.getenv("BURNBOT_EMBEDDING_WORKER_BATCH", "256"))
+# CPU threads for inference in the worker, 0 keeps the BURNBOT_CPU_THREADS budget
+WORKER_THREADS = int(os.getenv("BURNBOT_EMBEDDING_WORKER_THREADS", "0"))
+START_TIMEOUT = float(os.getenv("BURNBOT_EMBEDDING_WORKER_START_TIMEOUT", "120"))
+
+
+def authkey_from_env():
+    key = os.getenv(AUTHKEY_ENV)
+    return key.encode("utf-8") if key else None
+
+
+def check_authkey(authkey):
+    if not authkey:
+        raise ValueError(f"The embedding worker socket needs a shared key, set {AUTHKEY_ENV}")
+    return authkey
+
+
+def attach_shared_memory(name):
+    """
+    Opens a block created by another process without taking ownership of it,
+    so the worker never unlinks a client's memory when it exits.
+    """
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching always registers with the resource tracker
+        shm = SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _serve_connection(conn, model, lock):
+    shm = out = None
+    try:
+        conn.send(("ready", model.get_sentence_embedding_dimension()))
+        _, name, capacity = conn.recv()
+        shm = attach_shared_memory(name)
+        out = np.ndarray((capacity, model.get_sentence_embedding_dimension()),
+                         dtype="float32", buffer=shm.buf)
+        while True:
+            message = conn.recv()
+            if message[0] == "close":
+                break
+            texts = message[1][:capacity]
+            try:
+                # One inference at a time keeps the worker inside its thread budget
+                with lock:
+                    vectors = np.asarray(model.encode(texts), dtype="float32")
+                out[:len(texts)] = vectors
+                conn.send(("ok", len(texts)))
+            except Exception as e:
+                conn.send(("error", str(e)))
+    except (EOFError, OSError):
+        pass
+    finally:
+        if shm is not None:
+            out = None
+            shm.close()
+        conn.close()
+
+
+def serve(address, authkey, threads=WORKER_THREADS, model=None, ready=None):
+    """
+    Loads the embedding model and answers encode requests from any number of
+    clients on the Unix socket at address, one thread per client. The socket
+    is only accessible to its owner and clients must pass the authkey handshake.
+    """
+    check_authkey(authkey)
+    import rag_burnbot
+    if threads > 0:
+        rag_burnbot.cpu_threads.apply(threads)
+    if model is None:
+        model = rag_burnbot.load_sentence_transformer()
+    if os.path.exists(address):
+        os.unlink(address)
+    lock = threading.Lock()
+    # Created 0600, so other local users cannot even reach the handshake
+    umask = os.umask(0o177)
+    try:
+        listener = Listener(address, family="AF_UNIX", authkey=authkey)
+    finally:
+        os.umask(umask)
+    with listener:
+        if ready is not None:
+            ready.set()
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError, EOFError):
+                # A client that failed the handshake, keep serving the others
+                continue
+            threading.Thread(target=_serve_connection, args=(conn, model, lock), daemon=True).start()
+
+
+class EmbeddingWorkerClient:
+    """
+    Drop-in for SentenceTransformer.encode backed by an embedding worker.
+    Requests are sent in slices of max_batch texts; the worker writes the
+    vectors into this client's shared memory block and they are copied out.
+    Reconnects once if the worker went away.
+    """
+
+    def __init__(self, address, authkey, max_batch=MAX_BATCH):
+        self.address = address
+        self.authkey = check_authkey(authkey)
+        self.max_batch = max_batch
+        self.dimension = None
+        self._lock = threading.Lock()
+        self._conn = None
+        self._shm = None
+        self._out = None
+
+    def connect(self, timeout=0.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline or not self._alive():
+                    raise
+                time.sleep(0.1)
+        _, self.dimension = conn.recv()
+        if self._shm is None:
+            self._shm = SharedMemory(create=True, size=self.max_batch * self.dimension * 4)
+            self._out = np.ndarray((self.max_batch, self.dimension), dtype="float32",
+                                   buffer=self._shm.buf)
+        conn.send(("attach", self._shm.name, self.max_batch))
+        self._conn = conn
+        return self
+
+    def _alive(self):
+        return True
+
+    def _encode_slice(self, texts):
+        self._conn.send(("encode", texts))
+        status, value = self._conn.recv()
+        if status != "ok":
+            raise RuntimeError(f"embedding worker failed: {value}")
+        return self._out[:value].copy()
+
+    def encode(self, sentences, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        with self._lock:
+            if self._conn is None:
+                self.connect()
+            parts = []
+            for start in range(0, len(texts), self.max_batch):
+                batch = texts[start:start + self.max_batch]
+                try:
+                    parts.append(self._encode_slice(batch))
+                except (EOFError, OSError):
+                    self.connect()
+                    parts.append(self._encode_slice(batch))
+        vectors = np.concatenate(parts) if parts else np.zeros((0, self.dimension or 0), dtype="float32")
+        return vectors[0] if single else vectors
+
+    def get_sentence_embedding_dimension(self):
+        if self.dimension is None:
+            with self._lock:
+                if self._conn is None:
+                    self.connect()
+        return self.dimension
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.send(("close",))
+                except OSError:
+                    pass
+                self._conn.close()
+                self._conn = None
+            if self._shm is not None:
+                self._out = None
+                self._shm.close()
+                self._shm.unlink()
+                self._shm = None
+
+
+class ProcessEmbeddingWorker(EmbeddingWorkerClient):
+    """
+    Starts a private embedding worker process for this web process and
+    talks to it like a sidecar; the process is stopped at exit.
+    """
+
+    def __init__(self, max_batch=MAX_BATCH, threads=WORKER_THREADS, start_timeout=START_TIMEOUT):
+        self._dir = tempfile.mkdtemp(prefix="burnbot-embed-")
+        authkey = secrets.token_hex(16)
+        super().__init__(os.path.join(self._dir, "worker.sock"), authkey.encode("utf-8"), max_batch)
+        env = dict(os.environ, **{AUTHKEY_ENV: authkey})
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), self.address, "--threads", str(threads)],
+            env=env,
+        )
+        atexit.register(self.close)
+        self.connect(timeout=start_timeout)
+
+    def _alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        super().close()
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        if os.path.isdir(self._dir):
+            os.rmdir(self._dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="BurnBot embedding worker")
+    parser.add_argument("address", help="Unix socket path to listen on")
+    parser.add_argument("--threads", type=int, default=WORKER_THREADS,
+                        help="CPU threads for inference, 0 for the BURNBOT_CPU_THREADS budget")
+    args = parser.parse_args(argv)
+    authkey = authkey_from_env()
+    if authkey is None:
+        parser.error(f"{AUTHKEY_ENV} must be set to the key the web workers use")
+    serve(args.address, authkey, args.threads)
+
+
+if __name__ == "__main__":
+    main()
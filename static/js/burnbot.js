@@ -36,17 +36,64 @@ function sendMessage() {
     if (!userInput) return;
 
     appendMessage("You: " + userInput, "user");
+    document.getElementById("chat-input").value = "";
+
+    // Browsers without streaming fetch fall back to the plain /chat endpoint
+    if (!window.ReadableStream || !window.TextDecoder) {
+        fetch("/chat", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ message: userInput })
+        })
+            .then(response => response.json())
+            .then(data => appendMessage("BurnBot: " + data.response, "bot"))
+            .catch(error => console.error("Error:", error));
+        return;
+    }
+
+    streamMessage(userInput);
+}
+
+// Renders the reply from /chat/stream token by token as Server-Sent Events arrive
+function streamMessage(userInput) {
+    let botElement = appendMessage("BurnBot: ", "bot");
+    let answer = "";
+    let buffer = "";
+    let decoder = new TextDecoder();
 
-    fetch("/chat", {
+    fetch("/chat/stream", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({ message: userInput })
     })
-        .then(response => response.json())
-        .then(data => appendMessage("BurnBot: " + data.response, "bot"))
-        .catch(error => console.error("Error:", error));
+        .then(response => {
+            if (!response.ok) {
+                return response.json().then(data => updateMessage(botElement, "BurnBot: " + data.message));
+            }
+            let reader = response.body.getReader();
 
-    document.getElementById("chat-input").value = "";
+            function read() {
+                return reader.read().then(({ done, value }) => {
+                    if (done) return;
+                    buffer += decoder.decode(value, { stream: true });
+                    let events = buffer.split("\n\n");
+                    buffer = events.pop();
+                    events.forEach(event => {
+                        let data = event.split("\n")
+                            .filter(line => line.startsWith("data: "))
+                            .map(line => line.slice(6))
+                            .join("\n");
+                        if (!data || event.startsWith("event: done")) return;
+                        answer += JSON.parse(data).token;
+                        updateMessage(botElement, "BurnBot: " + answer);
+                    });
+                    return read();
+                });
+            }
+
+            return read();
+        })
+        .catch(error => console.error("Error:", error));
 }
 
 function appendMessage(message, sender) {
@@ -58,4 +105,11 @@ function appendMessage(message, sender) {
 
     chatBox.appendChild(messageElement);
     chatBox.scrollTop = chatBox.scrollHeight;
+    return messageElement;
+}
+
+function updateMessage(messageElement, message) {
+    let chatBox = document.getElementById("chat-box");
+    messageElement.innerHTML = message.replace(/\n/g, "<br>");
+    chatBox.scrollTop = chatBox.scrollHeight;
 }
@@ -6,6 +6,7 @@ import pytest
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from application import app, mongo, bot_response, get_calories
+from rag_burnbot import ChatOverloaded, CHAT_RETRY_AFTER
 from flask import session, url_for
 
 
@@ -79,6 +80,15 @@ class TestApplicationExtra(unittest.TestCase):
             response = client.post("/water", data={"intake": "250"})
             self.assertEqual(response.status_code, 200)
 
+    def test_water_route_invalid_intake(self):
+        with self.app as client:
+            with client.session_transaction() as sess:
+                sess["email"] = "testuser@example.com"
+            response = client.post("/water", data={"intake": "lots"})
+            self.assertEqual(response.status_code, 200)
+            response = client.post("/water", data={})
+            self.assertEqual(response.status_code, 200)
+
     def test_clear_intake_route(self):
         with self.app as client:
             with client.session_transaction() as sess:
@@ -373,6 +383,167 @@ def test_chatbot_valid_response_zero(client, mock_user):
 #     )
 
 
+# Test streaming chat requires login
+def test_chatbot_stream_unauthenticated(client):
+    response = client.post("/chat/stream", json={"message": "Hello"})
+    assert response.status_code == 401
+    assert b"User not logged in" in response.data
+
+
+# Test streaming chat sends tokens as Server-Sent Events
+def test_chatbot_stream_events(client, mock_user, monkeypatch):
+    with client.session_transaction() as sess:
+        sess["email"] = mock_user["email"]
+
+    monkeypatch.setattr(
+        "application.rag_service.answer_stream",
+        lambda message, conversation_id, profile="": iter(["Hi", " there"]),
+    )
+    response = client.post("/chat/stream", json={"message": "hello"})
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    body = response.get_data(as_text=True)
+    assert 'data: {"token": "Hi"}' in body
+    assert "event: done" in body
+
+
+# Test streaming chat sheds load with a 503 and Retry-After when the pool is full
+def test_chatbot_stream_busy(client, mock_user, monkeypatch):
+    with client.session_transaction() as sess:
+        sess["email"] = mock_user["email"]
+
+    def full(fn, *args):
+        raise ChatOverloaded("chat queue is full")
+
+    monkeypatch.setattr("application.chat_pool.stream", full)
+    response = client.post("/chat/stream", json={"message": "hello"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(CHAT_RETRY_AFTER)
+
+
+# Test personal questions get the user's summary, read once and then kept in the session
+def test_chatbot_personal_profile(client, mock_user, monkeypatch):
+    with client.session_transaction() as sess:
+        sess["email"] = mock_user["email"]
+
+    reads = []
+
+    def get_summary(email, db):
+        reads.append(email)
+        return {"days": {}, "enrolled": ["yoga"], "completed": [], "achievements": []}
+
+    monkeypatch.setattr("application.get_summary", get_summary)
+    monkeypatch.setattr(
+        "application.rag_service.answer",
+        lambda message, conversation_id, profile="": profile or "no profile",
+    )
+    response = client.post("/chat", json={"message": "How did I do this week?"})
+    assert b"Enrolled in: yoga." in response.data
+    client.post("/chat", json={"message": "What were my totals last week?"})
+    assert reads == [mock_user["email"]]
+
+    response = client.post("/chat", json={"message": "what is hiit"})
+    assert response.json["response"] == "no profile"
+
+
+# Test batch chat answers every question in order, for the coaching team only
+def test_chatbot_batch(client, mock_user, monkeypatch):
+    with client.session_transaction() as sess:
+        sess["email"] = mock_user["email"]
+
+    monkeypatch.setattr("application.BATCH_USERS", set())
+    response = client.post("/chat/batch", json={"questions": ["yoga?"]})
+    assert response.status_code == 403
+    monkeypatch.setattr("application.BATCH_USERS", {mock_user["email"].lower()})
+
+    def answer_batch(questions, concurrency, deadline):
+        results = [{"question": q, "answer": q.upper(), "generated": True} for q in questions]
+        return results, {"questions": len(questions)}
+
+    monkeypatch.setattr("application.rag_service.answer_batch", answer_batch)
+    response = client.post("/chat/batch", json={"questions": ["yoga?", "swim?"]})
+    assert response.status_code == 200
+    assert [r["answer"] for r in response.json["results"]] == ["YOGA?", "SWIM?"]
+    assert response.json["stats"]["questions"] == 2
+
+    response = client.post("/chat/batch", json={"questions": "yoga?"})
+    assert response.status_code == 400
+
+
+# Test chat sheds load with a 503 and Retry-After when the pool is full
+def test_chatbot_busy(client, mock_user, monkeypatch):
+    with client.session_transaction() as sess:
+        sess["email"] = mock_user["email"]
+
+    def full(fn, *args):
+        raise ChatOverloaded("chat queue is full")
+
+    monkeypatch.setattr("application.chat_pool.run", full)
+    response = client.post("/chat", json={"message": "hello"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(CHAT_RETRY_AFTER)
+
+
+# Test chat answers "warming up" while the models are still loading
+def test_chatbot_warming_up(client, mock_user, monkeypatch):
+    with client.session_transaction() as sess:
+        sess["email"] = mock_user["email"]
+
+    monkeypatch.setattr("application.warmup.wait", lambda timeout: False)
+    response = client.post("/chat", json={"message": "hello"})
+    assert response.status_code == 503
+    assert b"warming up" in response.data
+    assert "Retry-After" in response.headers
+
+
+# Test chat metrics require login and report the pool and generation counters
+def test_chat_metrics(client, mock_user):
+    response = client.get("/chat/metrics")
+    assert response.status_code == 401
+
+    with client.session_transaction() as sess:
+        sess["email"] = mock_user["email"]
+    response = client.get("/chat/metrics")
+    assert response.status_code == 200
+    assert "rejected" in response.json["pool"]
+    assert "streams" in response.json["pool"]
+    assert "generation" in response.json
+    assert "hits" in response.json["query_embedding_cache"]
+    assert "batches" in response.json["query_encoder"]
+    assert "hits" in response.json["answer_cache"]
+    assert "shared" in response.json["single_flight"]
+
+
+# Test chatbot answers calorie questions from the food collection
+def test_chatbot_calorie_lookup(client, mock_user, monkeypatch):
+    with client.session_transaction() as sess:
+        sess["email"] = mock_user["email"]
+
+    monkeypatch.setattr(
+        "application.get_calories", lambda food: 105 if food == "banana" else None
+    )
+    response = client.post("/chat", json={"message": "How many calories are in a banana?"})
+    assert response.status_code == 200
+    assert b"The calorie count for banana is 105 kcal." in response.data
+
+    response = client.post("/chat", json={"message": "calories in dragonfruit pie"})
+    assert b"Sorry, I couldn't find the calorie count for dragonfruit pie" in response.data
+
+
+# Test chatbot computes BMI from weight and height
+def test_chatbot_bmi(client, mock_user):
+    with client.session_transaction() as sess:
+        sess["email"] = mock_user["email"]
+
+    response = client.post("/chat", json={"message": "bmi 70 kg 175 cm"})
+    assert response.status_code == 200
+    assert b"Your BMI is 22.86, which is in the Normal Weight range." in response.data
+
+    response = client.post("/chat", json={"message": "bmi 70 kg 0 cm"})
+    assert response.status_code == 200
+    assert b"Tell me your weight and height" in response.data
+
+
 # Test chatbot asking for menu with non numeric input
 def test_chatbot_valid_response_non_numeric(client, mock_user):
     with client.session_transaction() as sess:
@@ -0,0 +1,141 @@
+"""
+  Copyright (c) 2025 Hank Lenham, Ryan McPhee, Lawrence Stephenson
+  This code is licensed under MIT license (see LICENSE for details)
+
+  This file tests the functions in rag_benchmark.py
+
+  For more information about the Burnout project, visit:
+  https://github.com/CSC510-Spring25-Group14/FitnessApp
+"""
+
+import json
+from unittest.mock import patch
+import numpy as np
+from rag_benchmark import recall_at_k, percentile, benchmark_index_types, synthetic_vectors, sample_queries
+from rag_benchmark import benchmark_chunkers, relevant_ids, label_recall_at_k, mean_reciprocal_rank, evaluate_pipeline, main
+from rag_benchmark import benchmark_threads
+
+
+def test_recall_at_k():
+  """
+    Test recall_at_k counts the overlap of the top-k ids
+  """
+  truth = [[1, 2, 3], [4, 5, 6]]
+  results = [[1, 2, 9], [6, 5, 4]]
+  assert recall_at_k(truth, results, 3) == 5 / 6
+
+
+def test_percentile_empty():
+  """
+    Test percentile of no samples is zero
+  """
+  assert percentile([], 99) == 0.0
+  assert percentile([1.0, 2.0, 3.0], 50) == 2.0
+
+
+def test_benchmark_index_types_flat_is_exact():
+  """
+    Test the flat index always has perfect recall against itself
+  """
+  vectors = synthetic_vectors(200, dimension=32, clusters=4)
+  queries = sample_queries(vectors, 10)
+  rows = benchmark_index_types(vectors, queries, k=3, configs=[("flat", {}), ("hnsw", {"ef_search": 32})])
+  assert [row["index"] for row in rows] == ["flat", "hnsw"]
+  assert rows[0]["recall@3"] == 1.0
+  assert all(row["p99_ms"] >= row["p50_ms"] for row in rows)
+
+
+def test_benchmark_reports_compressed_memory():
+  """
+    Test scalar quantization stores a quarter of the flat index bytes per vector
+  """
+  vectors = synthetic_vectors(300, dimension=32, clusters=4)
+  queries = sample_queries(vectors, 10)
+  rows = benchmark_index_types(vectors, queries, k=3, configs=[("flat", {}), ("sq8", {}), ("pq", {"pq_m": 8})])
+  flat, sq8, pq = rows
+  assert flat["code_bytes"] == 32 * 4
+  assert sq8["code_bytes"] == 32
+  assert pq["code_bytes"] < sq8["code_bytes"]
+  assert flat["recall_loss"] == 0.0
+
+
+def test_label_metrics():
+  """
+    Test recall@k and MRR over labelled relevant chunks
+  """
+  chunks = ["Yoga with Anvita", "Swimming is low impact", "Plank and squats"]
+  relevant = [relevant_ids(chunks, "low impact"), relevant_ids(chunks, "plank")]
+  assert relevant == [{1}, {2}]
+  results = [[1, 0], [0, 1]]
+  assert label_recall_at_k(relevant, results, 2) == 0.5
+  assert mean_reciprocal_rank(relevant, results) == 0.5
+
+
+def fake_encode(texts):
+  return np.array([[t.count(word) for word in ("yoga", "swim", "plank", "walk")] + [1.0]
+                   for t in [t.lower() for t in texts]], dtype="float32")
+
+
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_evaluate_pipeline_reports_every_stage(mock_encode, tmp_path):
+  """
+    Test the evaluation run reports retrieval quality, stage latencies and
+    throughput, and can be written as JSON
+  """
+  doc = tmp_path / "guide.txt"
+  doc.write_text("Yoga session with Anvita.\n\nSwim laps for low impact cardio.\n\nPlank for core.")
+  questions = tmp_path / "questions.json"
+  questions.write_text(json.dumps([
+    {"question": "who teaches yoga", "answer": "Anvita"},
+    {"question": "why swim laps", "answer": "low impact"},
+  ]))
+  results = evaluate_pipeline(str(doc), str(questions), k=1, concurrency_levels=(1, 2),
+                              requests=4, repeats=2, stub_latency=0)
+  assert results["retrieval"]["recall@1"] == 1.0
+  assert results["retrieval"]["mrr"] == 1.0
+  assert set(results["stages"]) == {"chunking", "encode", "search", "prompt", "generation"}
+  assert results["stages"]["search"]["n"] == 4
+  assert [row["concurrency"] for row in results["throughput"]] == [1, 2]
+  json.dumps(results)
+
+
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_main_writes_json(mock_encode, tmp_path):
+  """
+    Test the index benchmark can save its rows for later comparison
+  """
+  out = tmp_path / "run.json"
+  main(["--synthetic", "100", "--queries", "5", "--k", "3", "--types", "sq8", "--json", str(out)])
+  saved = json.loads(out.read_text())
+  assert [row["index"] for row in saved["indexes"]] == ["flat", "sq8"]
+
+
+def test_benchmark_chunkers_native():
+  """
+    Test the chunker benchmark reports the native chunker and matches any reference
+  """
+  rows = benchmark_chunkers(["Yoga session.", "Swim " * 200, "Plank."], repeats=2)
+  assert rows[0]["chunker"] == "native"
+  assert rows[0]["chunks"] >= 2
+  assert all(row["same_chunks"] for row in rows)
+
+
+class FakeModel:
+  def encode(self, texts):
+    return fake_encode(texts)
+
+
+def fake_model():
+  return FakeModel()
+
+
+def test_benchmark_threads():
+  """
+    Test every thread budget runs all worker processes and reports their combined throughput
+  """
+  chunks = ["Yoga session with Anvita.", "Swim laps.", "Plank for core."]
+  rows = benchmark_threads(chunks, ["yoga?", "swim?", "plank?"], [1, 2], workers=2, k=2,
+                           model_factory=fake_model)
+  assert [row["threads"] for row in rows] == [1, 2]
+  assert [row["total_threads"] for row in rows] == [2, 4]
+  assert all(row["requests"] == 6 and row["qps"] > 0 for row in rows)
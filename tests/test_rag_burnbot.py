@@ -1,4 +1,8 @@
 import os
+import shutil
+import json
+import time
+import threading
 import pytest
 from unittest.mock import patch, MagicMock
 import rag_burnbot
@@ -155,4 +159,1042 @@ def test_retrieve_context_k_greater_than_chunks(mock_encode):
     chunks = ["A"] * 3
     index, chunk_store = build_faiss_index(chunks)
     context = retrieve_context("test", index, chunk_store, k=10)
-    assert len(context) <= 10
\ No newline at end of file
+    assert len(context) <= 10
+
+
+def fake_encode(texts):
+    return np.random.default_rng(len(texts)).random((len(texts), 384)).astype("float32")
+
+# Test 21: The RAG service builds the index once and reuses it
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_rag_service_builds_once(mock_encode, tmp_path):
+    (tmp_path / "doc.txt").write_text("chunk1\n\nchunk2")
+    service = rag_burnbot.RAGService(str(tmp_path), check_interval=60, index_dir=None)
+    first = service.get()
+    second = service.get()
+    assert mock_encode.call_count == 1
+    assert first[0] is second[0]
+    assert service.version == 1
+
+# Test 22: The RAG service swaps in a new index when the corpus changes
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_rag_service_rebuilds_on_change(mock_encode, tmp_path):
+    path = tmp_path / "doc.txt"
+    path.write_text("v1")
+    service = rag_burnbot.RAGService(str(tmp_path), check_interval=0, index_dir=None)
+    old_index, _ = service.get()
+    path.write_text("v2")
+    os.utime(path, ns=(1, 1))
+    service.get()
+    service._rebuild_thread.join()
+    new_index, chunks = service.get()
+    assert new_index is not old_index
+    assert list(chunks.values()) == ["v2"]
+    assert service.version == 2
+
+# Test 23: Touching a document without editing it keeps the current index
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_rag_service_ignores_touch(mock_encode, tmp_path):
+    path = tmp_path / "doc.txt"
+    path.write_text("v1")
+    service = rag_burnbot.RAGService(str(tmp_path), check_interval=0, index_dir=None)
+    old_index, _ = service.get()
+    os.utime(path, ns=(1, 1))
+    service.get()
+    service._rebuild_thread.join()
+    assert service.get()[0] is old_index
+    assert mock_encode.call_count == 1
+
+# Test 24: Saving and memory-mapping an index artifact round trips the corpus
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_index_artifact_round_trip(mock_encode, tmp_path):
+    corpus_dir = tmp_path / "corpus"
+    corpus_dir.mkdir()
+    (corpus_dir / "doc.txt").write_text("chunk1\n\nchunk2")
+    corpus = rag_burnbot.CorpusIndex()
+    corpus.sync(str(corpus_dir))
+    rag_burnbot.save_index_artifact(corpus, str(tmp_path / "index"))
+    loaded = rag_burnbot.load_index_artifact(corpus.source_hash, str(tmp_path / "index"))
+    assert loaded is not None
+    assert loaded.index.ntotal == corpus.index.ntotal
+    assert loaded.chunks == corpus.chunks
+    assert loaded.documents == corpus.documents
+
+# Test 25: Artifacts for another corpus hash or embedding model are ignored
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_index_artifact_mismatch(mock_encode, tmp_path):
+    corpus_dir = tmp_path / "corpus"
+    corpus_dir.mkdir()
+    (corpus_dir / "doc.txt").write_text("chunk")
+    corpus = rag_burnbot.CorpusIndex()
+    corpus.sync(str(corpus_dir))
+    index_dir = str(tmp_path / "index")
+    rag_burnbot.save_index_artifact(corpus, index_dir)
+    assert rag_burnbot.load_index_artifact("def456", index_dir) is None
+    with patch("rag_burnbot.EMBEDDING_MODEL_NAME", "other-model"):
+        assert rag_burnbot.load_index_artifact(corpus.source_hash, index_dir) is None
+
+# Test 26: A saved artifact is reused instead of re-encoding the corpus
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_load_or_build_index_reuses_artifact(mock_encode, tmp_path):
+    corpus_dir = tmp_path / "corpus"
+    corpus_dir.mkdir()
+    (corpus_dir / "doc.txt").write_text("chunk")
+    index_dir = str(tmp_path / "index")
+    rag_burnbot.load_or_build_index(str(corpus_dir), index_dir)
+    corpus = rag_burnbot.load_or_build_index(str(corpus_dir), index_dir)
+    assert mock_encode.call_count == 1
+    assert list(corpus.chunks.values()) == ["chunk"]
+
+# Test 27: Repeated queries are served from the embedding cache
+def test_encode_query_uses_cache():
+    cache = rag_burnbot.EmbeddingCache(max_bytes=1 << 20, ttl=60)
+    with patch("rag_burnbot.embedding_model.encode", return_value=np.ones((1, 384), dtype="float32")) as mock_encode:
+        first = rag_burnbot.encode_query("Best  Cardio ", cache=cache)
+        second = rag_burnbot.encode_query("best cardio", cache=cache)
+    assert mock_encode.call_count == 1
+    assert np.array_equal(first, second)
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+# Test 28: The cache evicts least recently used entries past its memory cap
+def test_embedding_cache_evicts_lru():
+    vector = np.zeros(384, dtype="float32")
+    entry_size = len("q0") + vector.nbytes
+    cache = rag_burnbot.EmbeddingCache(max_bytes=entry_size * 2, ttl=60)
+    cache.put("q0", vector)
+    cache.put("q1", vector)
+    cache.get("q0")
+    cache.put("q2", vector)
+    assert cache.get("q1") is None
+    assert cache.get("q0") is not None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] <= cache.max_bytes
+
+# Test 29: Expired cache entries count as misses
+def test_embedding_cache_ttl_expiry():
+    cache = rag_burnbot.EmbeddingCache(max_bytes=1 << 20, ttl=-1)
+    cache.put("menu", np.zeros(384, dtype="float32"))
+    assert cache.get("menu") is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["entries"] == 0
+
+# Test 30: Near-duplicate queries reuse the cached answer, distant ones miss
+def test_semantic_answer_cache_lookup():
+    cache = rag_burnbot.SemanticAnswerCache(max_entries=10, ttl=60, max_distance=0.05)
+    vector = np.zeros(384, dtype="float32")
+    vector[0] = 1.0
+    cache.store(vector, "Eat 2000 kcal.", corpus_version=1)
+    near = vector.copy()
+    near[1] = 0.1
+    far = np.zeros(384, dtype="float32")
+    far[2] = 1.0
+    assert cache.lookup(near, corpus_version=1) == "Eat 2000 kcal."
+    assert cache.lookup(far, corpus_version=1) is None
+
+# Test 31: A corpus rebuild invalidates every cached answer
+def test_semantic_answer_cache_corpus_version():
+    cache = rag_burnbot.SemanticAnswerCache(max_entries=10, ttl=60, max_distance=0.05)
+    vector = np.ones(384, dtype="float32")
+    cache.store(vector, "old answer", corpus_version=1)
+    assert cache.lookup(vector, corpus_version=2) is None
+    cache.store(vector, "stale answer", corpus_version=1)
+    assert cache.stats()["entries"] == 0
+
+# Test 32: The answer cache evicts by size and by age
+def test_semantic_answer_cache_eviction():
+    cache = rag_burnbot.SemanticAnswerCache(max_entries=1, ttl=60, max_distance=0.05)
+    first = np.eye(384, dtype="float32")[0]
+    second = np.eye(384, dtype="float32")[1]
+    cache.store(first, "first", corpus_version=1)
+    cache.store(second, "second", corpus_version=1)
+    assert cache.lookup(first, corpus_version=1) is None
+    assert cache.stats()["evictions"] == 1
+    expired = rag_burnbot.SemanticAnswerCache(max_entries=10, ttl=-1, max_distance=0.05)
+    expired.store(first, "first", corpus_version=1)
+    assert expired.lookup(first, corpus_version=1) is None
+
+# Test 33: bot_response skips Gemini when the answer cache has a match
+@patch("rag_burnbot.gemini_response", return_value="Cardio answer")
+@patch("rag_burnbot.embedding_model.encode", return_value=np.ones((1, 384), dtype="float32"))
+def test_bot_response_uses_answer_cache(mock_encode, mock_gemini):
+    index, chunk_store = build_faiss_index(["Sample context"])
+    cache = rag_burnbot.SemanticAnswerCache(max_entries=10, ttl=60, max_distance=0.05)
+    first = bot_response("best cardio for beginners", index, chunk_store, cache, 1)
+    second = bot_response("best cardio for beginners?", index, chunk_store, cache, 1)
+    assert first == second == "Cardio answer"
+    assert mock_gemini.call_count == 1
+
+# Test 34: Concurrent queries are embedded together in one encode() call
+def test_batching_encoder_batches_concurrent_queries():
+    encoder = rag_burnbot.BatchingEncoder(max_batch_size=8, max_wait_ms=200)
+
+    def fake_encode(texts):
+        return np.array([[float(len(t))] * 4 for t in texts], dtype="float32")
+
+    with patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode) as mock_encode:
+        futures = [encoder.submit("q" * n) for n in range(1, 5)]
+        vectors = [f.result(timeout=5) for f in futures]
+    assert mock_encode.call_count == 1
+    assert [v[0] for v in vectors] == [1.0, 2.0, 3.0, 4.0]
+    stats = encoder.stats()
+    assert stats["batches"] == 1
+    assert stats["largest_batch"] == 4
+    assert stats["queue_depth"] == 0
+
+# Test 35: Encoder failures are raised in every waiting caller
+def test_batching_encoder_propagates_errors():
+    encoder = rag_burnbot.BatchingEncoder(max_batch_size=8, max_wait_ms=0)
+    with patch("rag_burnbot.embedding_model.encode", side_effect=RuntimeError("model down")):
+        with pytest.raises(RuntimeError):
+            encoder.encode("menu")
+
+# Test 36: Streaming responses yield Gemini pieces as they arrive
+@patch("rag_burnbot.retrieve_context", return_value=["Calories info"])
+@patch("rag_burnbot.model.generate_content")
+def test_bot_response_stream_yields_pieces(mock_generate, mock_context):
+    mock_generate.return_value = [MagicMock(text=" **Rice"), MagicMock(text=" has 200"), MagicMock(text=" kcal.")]
+    pieces = list(rag_burnbot.bot_response_stream("calories in rice?", None, None))
+    assert pieces == ["Rice", " has 200", " kcal."]
+    assert mock_generate.call_args.kwargs["stream"] is True
+
+# Test 37: Streaming the menu returns the whole menu at once
+def test_bot_response_stream_menu():
+    pieces = list(rag_burnbot.bot_response_stream("menu", None, None))
+    assert len(pieces) == 1
+    assert "BurnBot" in pieces[0]
+
+# Test 38: Every supported index type builds and finds the nearest chunk
+@pytest.mark.parametrize("index_type", rag_burnbot.INDEX_TYPES)
+def test_build_vector_index_types(index_type):
+    vectors = np.random.default_rng(0).random((300, 384)).astype("float32")
+    index = rag_burnbot.build_vector_index(vectors, index_type, {"nprobe": 64, "ef_search": 64})
+    assert index.ntotal == 300
+    _, ids = index.search(vectors[:1], 1)
+    assert ids[0][0] == 0
+
+# Test 39: Search parameters are applied to HNSW and IVF indexes
+def test_apply_search_params():
+    vectors = np.random.default_rng(0).random((300, 384)).astype("float32")
+    hnsw = rag_burnbot.build_vector_index(vectors, "hnsw", {"ef_search": 99})
+    assert hnsw.hnsw.efSearch == 99
+    ivf = rag_burnbot.build_vector_index(vectors, "ivf_flat", {"nlist": 4, "nprobe": 3})
+    assert ivf.nprobe == 3
+
+# Test 40: Unknown index types are rejected
+def test_create_index_unknown_type():
+    with pytest.raises(ValueError):
+        rag_burnbot.create_index("annoy", 384, 10)
+
+# Test 41: Syncing a corpus only embeds added or changed documents
+@pytest.mark.parametrize("index_type", rag_burnbot.INDEX_TYPES)
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_corpus_sync_is_incremental(mock_encode, index_type, tmp_path):
+    (tmp_path / "cardio.md").write_text("# Cardio\n\nRunning burns calories.")
+    (tmp_path / "diet.txt").write_text("Eat more protein.")
+    (tmp_path / "notes.pdf").write_text("ignored")
+    corpus = rag_burnbot.CorpusIndex(index_type)
+    stats = corpus.sync(str(tmp_path))
+    assert stats["added"] == 2
+    assert stats["chunks_embedded"] == 2
+
+    stats = corpus.sync(str(tmp_path))
+    assert stats["unchanged"] == 2
+    assert stats["chunks_embedded"] == 0
+
+    (tmp_path / "diet.txt").write_text("Eat more vegetables.")
+    stats = corpus.sync(str(tmp_path))
+    assert stats["updated"] == 1
+    assert stats["chunks_embedded"] == 1
+    assert mock_encode.call_args[0][0] == ["Eat more vegetables."]
+
+    (tmp_path / "cardio.md").unlink()
+    stats = corpus.sync(str(tmp_path))
+    assert stats["removed"] == 1
+    assert corpus.index.ntotal == len(corpus.chunks) == 1
+    assert list(corpus.chunks.values()) == ["Eat more vegetables."]
+
+# Test 42: A copy of a corpus can be synced without touching the original
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_corpus_copy_is_independent(mock_encode, tmp_path):
+    (tmp_path / "a.txt").write_text("first")
+    corpus = rag_burnbot.CorpusIndex()
+    corpus.sync(str(tmp_path))
+    copy = corpus.copy()
+    (tmp_path / "b.txt").write_text("second")
+    copy.sync(str(tmp_path))
+    assert corpus.index.ntotal == 1
+    assert copy.index.ntotal == 2
+
+# Test 43: Markdown and text documents are split into paragraphs
+def test_extract_text_from_text_file(tmp_path):
+    path = tmp_path / "plan.md"
+    path.write_text("# Plan\n\nWeek one:\nwalk daily.\n\n\n  Week two  ")
+    assert rag_burnbot.extract_text_from_file(str(path)) == ["# Plan", "Week one: walk daily.", "Week two"]
+
+# Test 44: BM25 ranks chunks containing the exact keyword first
+def test_bm25_index_ranks_keyword_hits():
+    chunks = {10: "Oatmeal has 150 calories per cup.", 11: "Swimming is low impact cardio.", 12: "Rest days matter."}
+    lexical = rag_burnbot.BM25Index(chunks)
+    hits = lexical.search(rag_burnbot.tokenize("oatmeal calories"), 3)
+    assert hits[0][0] == 10
+    assert lexical.search(["quinoa"], 3) == []
+
+# Test 45: Reciprocal rank fusion favours ids ranked well by both lists
+def test_reciprocal_rank_fusion():
+    fused = rag_burnbot.reciprocal_rank_fusion([[1, 2, 3], [2, 4, 1]])
+    assert fused[0] == 2
+    assert set(fused) == {1, 2, 3, 4}
+
+# Test 46: Short keyword queries are retrieved from BM25 alone, with no FAISS search
+def test_retrieve_context_lexical_only_skips_faiss():
+    chunks = ["Oatmeal has 150 calories per cup.", "Swimming is low impact cardio."]
+    lexical = rag_burnbot.BM25Index(chunks)
+    with patch("rag_burnbot.encode_query") as mock_encode:
+        context = retrieve_context("swimming", None, chunks, k=1, lexical=lexical, mode="hybrid")
+    assert context == ["Swimming is low impact cardio."]
+    mock_encode.assert_not_called()
+
+# Test 47: Longer queries fuse dense and lexical results
+@patch("rag_burnbot.dense_search", return_value=[1, 0])
+def test_retrieve_context_hybrid_fuses_results(mock_dense):
+    chunks = ["Oatmeal has 150 calories per cup.", "Swimming is low impact cardio.", "Rest days matter."]
+    lexical = rag_burnbot.BM25Index(chunks)
+    context = retrieve_context("how many calories are in oatmeal with milk", None, chunks, k=2,
+                               lexical=lexical, mode="hybrid")
+    mock_dense.assert_called_once()
+    assert context[0] == "Oatmeal has 150 calories per cup."
+    assert len(context) == 2
+
+# Test 48: Rules route calorie, BMI, greeting and menu questions without the encoder
+@pytest.mark.parametrize("query, intent, slots", [
+    ("How many calories are in a banana?", "calories", {"food": "banana"}),
+    ("calories in brown rice", "calories", {"food": "brown rice"}),
+    ("avocado calories", "calories", {"food": "avocado"}),
+    ("how to burn calories", "question", {}),
+    ("best way to burn calories?", "question", {}),
+    ("how many calories", "question", {}),
+    ("what is my bmi? 70 kg and 175 cm", "bmi", {"weight": 70.0, "height": 175.0}),
+    ("bmi 70 kg 175 cm", "bmi", {"weight": 70.0, "height": 175.0}),
+    ("what is my bmi", "bmi", {}),
+    ("what is a healthy bmi range for women", "question", {}),
+    ("does bmi matter for athletes", "question", {}),
+    ("is bmi accurate for muscular people", "question", {}),
+    ("Hello!", "greeting", {}),
+    ("1", "menu_option", {"option": "1"}),
+    ("menu", "menu", {}),
+])
+def test_intent_router_rules(query, intent, slots):
+    router = rag_burnbot.IntentRouter()
+    with patch("rag_burnbot.encode_query") as mock_encode:
+        assert router.classify(query) == (intent, slots)
+    mock_encode.assert_not_called()
+
+# Test 49: Without a rule match the nearest intent centroid decides
+def test_intent_router_nearest_centroid():
+    examples = {"calories": ["calories food"], "question": ["yoga trainer"]}
+    router = rag_burnbot.IntentRouter(examples=examples, min_similarity=0.5)
+    router._centroids = (["calories", "question"], np.eye(2, 384, dtype="float32"))
+    with patch("rag_burnbot.encode_query", return_value=np.eye(1, 384, dtype="float32")[0]):
+        assert router.classify("energy contained in a mango") == ("calories", {"food": "contained mango"})
+        assert router.classify("energy I burn per day") == ("question", {})
+    with patch("rag_burnbot.encode_query", return_value=np.eye(2, 384, dtype="float32")[1]):
+        assert router.classify("who leads the yoga sessions") == ("question", {})
+    router._centroids = (["bmi", "question"], np.eye(2, 384, dtype="float32"))
+    with patch("rag_burnbot.encode_query", return_value=np.eye(1, 384, dtype="float32")[0]):
+        assert router.classify("am i overweight for my height") == ("bmi", {})
+        assert router.classify("is body fat a better measure than weight") == ("question", {})
+
+# Test 50: Routed questions skip retrieval and Gemini, unhandled ones fall through
+@patch("rag_burnbot.retrieve_context", return_value=["context"])
+@patch("rag_burnbot.gemini_response", return_value="LLM answer")
+def test_bot_response_uses_router(mock_gemini, mock_context):
+    router = rag_burnbot.IntentRouter()
+    router.register("calories", lambda query, slots: f"{slots['food']} has 105 kcal.")
+    assert bot_response("calories in banana", None, None, router=router) == "banana has 105 kcal."
+    mock_gemini.assert_not_called()
+    router.register("calories", lambda query, slots: None)
+    assert bot_response("calories in banana", None, None, router=router) == "LLM answer"
+
+# Test 51: The circuit breaker opens after repeated failures and allows one trial call later
+def test_circuit_breaker_transitions():
+    breaker = rag_burnbot.CircuitBreaker(failure_threshold=2, reset_seconds=0.05)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+# Test 52: Slow backends hit the deadline and keep their call slot until they finish
+def test_generator_timeout_and_concurrency_cap():
+    generator = rag_burnbot.Generator(rag_burnbot.StubBackend(latency=0.3), timeout=0.05,
+                                      max_concurrency=1, slot_wait=0.01)
+    with pytest.raises(rag_burnbot.GenerationUnavailable):
+        generator.generate("Context: Walk daily.\n\nQuery: tips")
+    with pytest.raises(rag_burnbot.GenerationUnavailable):
+        generator.generate("Context: Walk daily.\n\nQuery: tips")
+    stats = generator.stats()
+    assert stats["timeouts"] == 1
+    assert stats["rejected_busy"] == 1
+
+# Test 53: An open breaker serves the retrieved chunks without calling the backend
+def test_gemini_response_falls_back_when_breaker_open():
+    backend = MagicMock()
+    breaker = rag_burnbot.CircuitBreaker(failure_threshold=1, reset_seconds=60)
+    breaker.record_failure()
+    with patch("rag_burnbot.generator", rag_burnbot.Generator(backend, breaker=breaker)):
+        answer = gemini_response(["Swimming is low impact cardio."], "best cardio?")
+    backend.generate.assert_not_called()
+    assert answer.startswith(rag_burnbot.FALLBACK_INTRO)
+    assert "Swimming is low impact cardio." in answer
+    assert not rag_burnbot.is_generated_answer(answer)
+
+# Test 54: The stub backend answers deterministically from the context
+def test_stub_backend_is_deterministic():
+    generator = rag_burnbot.Generator(rag_burnbot.StubBackend(latency=0))
+    with patch("rag_burnbot.generator", generator):
+        first = gemini_response(["Yoga builds flexibility. It also helps balance."], "yoga?")
+        pieces = list(rag_burnbot.gemini_response_stream(["Yoga builds flexibility. It also helps balance."], "yoga?"))
+    assert first == "According to the BurnBot guide: Yoga builds flexibility."
+    assert "".join(pieces) == first
+
+# Test 55: Overlapping spans and repeated chunks are removed from the context
+def test_dedupe_chunks_removes_overlap():
+    first = "Swimming is a full body workout. Start with three sessions per week."
+    second = "Start with three sessions per week. Add a fourth after a month."
+    deduped = rag_burnbot.dedupe_chunks([first, second, first, "per week."])
+    assert deduped == [first, "Add a fourth after a month."]
+
+# Test 56: The prompt stays inside the token budget and keeps the best chunk first
+def test_build_prompt_respects_token_budget():
+    chunks = [f"Chunk {i} " + "word " * 150 for i in range(10)]
+    prompt = rag_burnbot.build_prompt(chunks, "what should I do?", token_budget=400)
+    assert rag_burnbot.estimate_tokens(prompt) <= 400
+    assert prompt.index("Chunk 0") < prompt.index("Chunk 1")
+    assert "Chunk 3" not in prompt
+
+# Test 57: Oversized queries are truncated instead of blowing the budget
+def test_build_prompt_truncates_long_query():
+    prompt = rag_burnbot.build_prompt(["Rice has 200 calories."], "carbs " * 1000, token_budget=300)
+    assert rag_burnbot.estimate_tokens(prompt) <= 300
+
+# Test 58: Concurrent identical calls share one computation
+def test_single_flight_shares_result():
+    flight = rag_burnbot.SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def slow(value):
+        calls.append(value)
+        started.set()
+        time.sleep(0.2)
+        return value * 2
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("q", slow, 21)))
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=lambda: results.append(flight.do("q", slow, 21)))
+                 for _ in range(4)]
+    for thread in followers:
+        thread.start()
+    for thread in [leader] + followers:
+        thread.join()
+    assert results == [42] * 5
+    assert calls == [21]
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "shared": 4}
+
+# Test 59: A failing leader passes its exception on and the key can be retried
+def test_single_flight_propagates_errors():
+    flight = rag_burnbot.SingleFlight()
+
+    def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        flight.do("q", fail)
+    assert flight.do("q", lambda: "ok") == "ok"
+
+# Test 60: Chunks carry their offsets in the newline-joined paragraphs
+def test_iter_chunks_offsets():
+    paragraphs = ["Yoga with Anvita.", "Swim " * 30, "Plank for core."]
+    blob = "\n".join(paragraphs)
+    chunks = list(rag_burnbot.iter_chunks(paragraphs, chunk_size=60, chunk_overlap=15))
+    assert all(blob[c.start:c.end] == c.text and len(c.text) <= 60 for c in chunks)
+    assert chunks[0].text.startswith("Yoga") and chunks[-1].text.endswith("core.")
+
+# Test 61: The chunker pulls paragraphs only as it needs them
+def test_iter_chunks_is_lazy():
+    def paragraphs():
+        yield "a" * 40
+        yield "b" * 40
+        raise AssertionError("read past the first chunk")
+
+    first = next(rag_burnbot.iter_chunks(paragraphs(), chunk_size=50, chunk_overlap=0))
+    assert first.text == "a" * 40
+
+# Test 62: Batch retrieval embeds all questions in one call and matches single retrieval
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_retrieve_contexts_batches_encode(mock_encode):
+    chunks = ["Yoga with Anvita.", "Swimming is low impact.", "Plank for core.", "Walk daily."]
+    index, _ = build_faiss_index(chunks)
+    rag_burnbot.query_embedding_cache.clear()
+    queries = ["batch question one", "batch question two", "batch question three"]
+    contexts = rag_burnbot.retrieve_contexts(queries, index, chunks, k=2, mode="dense")
+    assert mock_encode.call_count == 2
+    assert contexts == [retrieve_context(q, index, chunks, k=2, mode="dense") for q in queries]
+    assert mock_encode.call_count == 2
+
+# Test 63: Batch answers come back in order and are cached for later chats
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_answer_batch_in_order(mock_encode):
+    chunks = ["Yoga with Anvita.", "Swimming is low impact."]
+    index, _ = build_faiss_index(chunks)
+    cache = rag_burnbot.SemanticAnswerCache()
+    with patch("rag_burnbot.gemini_response", side_effect=lambda context, q: f"answer to {q}"):
+        results, stats = rag_burnbot.answer_batch(["Q1", "Q2", "Q3"], index, chunks,
+                                                  concurrency=3, answer_cache=cache)
+    assert [r["answer"] for r in results] == ["answer to q1", "answer to q2", "answer to q3"]
+    assert stats["questions"] == 3 and stats["generated"] == 3
+    assert cache.lookup(rag_burnbot.encode_query("q2"), 0) == "answer to q2"
+
+# Test 64: An offline build writes an artifact that validates
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+@patch("rag_burnbot.embedding_model.get_sentence_embedding_dimension", return_value=384)
+def test_build_index_artifact_validates(mock_dimension, mock_encode, tmp_path):
+    corpus = tmp_path / "corpus"
+    corpus.mkdir()
+    (corpus / "doc.txt").write_text("Yoga with Anvita.\n\nSwimming is low impact.")
+    target, problems = rag_burnbot.build_index_artifact(str(corpus), str(tmp_path / "index"))
+    assert problems == []
+    with open(os.path.join(target, "chunks.json")) as f:
+        manifest = json.load(f)
+    assert manifest["chunk_count"] == 1 and manifest["dimension"] == 384
+    with open(os.path.join(target, "index.faiss"), "ab") as f:
+        f.write(b"corrupt")
+    assert rag_burnbot.validate_index_artifact(target) == ["index.faiss does not match its checksum"]
+
+# Test 65: Prebuilt-only services load the artifact and never embed the corpus
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_rag_service_prebuilt_only(mock_encode, tmp_path):
+    corpus = tmp_path / "corpus"
+    corpus.mkdir()
+    (corpus / "doc.txt").write_text("v1")
+    index_dir = str(tmp_path / "index")
+    with pytest.raises(FileNotFoundError):
+        rag_burnbot.RAGService(str(corpus), index_dir=index_dir, prebuilt_only=True).get()
+    rag_burnbot.load_or_build_index(str(corpus), index_dir)
+    calls = mock_encode.call_count
+    (corpus / "doc.txt").write_text("v2")
+    _, chunks = rag_burnbot.RAGService(str(corpus), index_dir=index_dir, prebuilt_only=True).get()
+    assert list(chunks.values()) == ["v1"]
+    assert mock_encode.call_count == calls
+
+# Test 66: The chat pool refuses work once its workers and queue are full
+def test_chat_pool_sheds_load():
+    pool = rag_burnbot.ChatWorkerPool(workers=1, queue_limit=1, queue_timeout=5)
+    release = threading.Event()
+    running = pool.submit(release.wait)
+    queued = pool.submit(lambda: "queued")
+    with pytest.raises(rag_burnbot.ChatOverloaded):
+        pool.submit(lambda: "refused")
+    release.set()
+    assert running.result(timeout=5) is True
+    assert queued.result(timeout=5) == "queued"
+    time.sleep(0.05)
+    stats = pool.stats()
+    assert stats["accepted"] == 2 and stats["rejected"] == 1 and stats["completed"] == 2
+    assert stats["queued"] == 0 and stats["active"] == 0
+    assert stats["queue_wait_p99_ms"] >= stats["queue_wait_p50_ms"] >= 0
+
+# Test 67: Requests stuck in the queue past the timeout are dropped
+def test_chat_pool_queue_timeout():
+    pool = rag_burnbot.ChatWorkerPool(workers=1, queue_limit=1, queue_timeout=0.05)
+    release = threading.Event()
+    pool.submit(release.wait)
+    with pytest.raises(rag_burnbot.ChatOverloaded):
+        pool.run(lambda: "late")
+    release.set()
+    time.sleep(0.05)
+    assert pool.stats()["expired"] == 1
+    assert pool.run(lambda: "ok") == "ok"
+
+# Test 68: Lazy models load once, on first use, and patching encode does not load them
+def test_lazy_model_loads_once():
+    loads = []
+
+    def factory():
+        loads.append(1)
+        time.sleep(0.05)
+        return MagicMock(encode=lambda texts: "vectors")
+
+    lazy = rag_burnbot.LazyEmbeddingModel(factory)
+    with patch.object(lazy, "encode", return_value="patched"):
+        assert lazy.encode(["x"]) == "patched"
+    assert not lazy.loaded
+    threads = [threading.Thread(target=lazy.encode, args=(["x"],)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loads == [1] and lazy.loaded
+    assert lazy.encode(["x"]) == "vectors"
+
+# Test 69: Warm-up loads the models and index in the background and reports readiness
+def test_warmup_reports_ready():
+    service = MagicMock()
+    lazy = rag_burnbot.LazyEmbeddingModel(MagicMock)
+    warm = rag_burnbot.WarmUp(service, models=(lazy,))
+    assert warm.wait(0) and warm.state == "cold"
+    with patch("rag_burnbot.embedding_model.encode"):
+        assert warm.start().wait(5)
+    assert warm.ready and lazy.loaded
+    service.snapshot.assert_called_once()
+
+# Test 70: A failed warm-up is reported and does not block requests
+def test_warmup_failure():
+    service = MagicMock()
+    service.snapshot.side_effect = FileNotFoundError("no index")
+    warm = rag_burnbot.WarmUp(service, models=())
+    with patch("rag_burnbot.embedding_model.encode"):
+        assert warm.start().wait(5)
+    assert warm.status()["state"] == "failed" and "no index" in warm.status()["error"]
+
+# Test 71: Parsed docx text is cached and python-docx only runs when the file changes
+def test_cached_document_paragraphs(tmp_path):
+    path = tmp_path / "guide.docx"
+    doc = Document()
+    doc.add_paragraph("Yoga with Anvita.")
+    doc.save(path)
+    cache_dir = str(tmp_path / "text")
+    first = rag_burnbot.cached_document_paragraphs(str(path), cache_dir)
+    assert first == ["Yoga with Anvita."]
+    with patch("rag_burnbot.Document", side_effect=AssertionError("parsed again")):
+        assert rag_burnbot.cached_document_paragraphs(str(path), cache_dir) == first
+        os.utime(path, ns=(1, 1))
+        assert rag_burnbot.cached_document_paragraphs(str(path), cache_dir) == first
+
+    doc.add_paragraph("Swimming is low impact.")
+    doc.save(path)
+    assert rag_burnbot.cached_document_paragraphs(str(path), cache_dir) == [
+        "Yoga with Anvita.", "Swimming is low impact."
+    ]
+
+# Test 72: Full rebuilds read unchanged documents from the text cache
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_rebuild_uses_text_cache(mock_encode, tmp_path):
+    corpus = tmp_path / "corpus"
+    corpus.mkdir()
+    doc = Document()
+    doc.add_paragraph("Plank for core.")
+    doc.save(corpus / "guide.docx")
+    rag_burnbot.load_or_build_index(str(corpus), str(tmp_path / "first"))
+    # A fresh index directory that only has the text cache forces a full rebuild
+    shutil.copytree(tmp_path / "first" / "text", tmp_path / "second" / "text")
+    with patch("rag_burnbot.Document", side_effect=AssertionError("parsed again")):
+        corpus_index = rag_burnbot.load_or_build_index(str(corpus), str(tmp_path / "second"))
+    assert list(corpus_index.chunks.values()) == ["Plank for core."]
+
+# Test 73: Older turns fold into a summary and history stays inside its token budget
+def test_conversation_memory_budget():
+    memory = rag_burnbot.ConversationMemory(recent_turns=2, token_budget=80, summary_tokens=30)
+    for turn in range(20):
+        memory.record("s1", f"question {turn}", f"Answer {turn}. " + "detail " * 40)
+    history = memory.render("s1")
+    assert rag_burnbot.estimate_tokens(history) <= 80
+    assert history.startswith("Earlier: ")
+    assert "User: question 19" in history and "User: question 5" not in history
+    assert memory.render("other") == ""
+
+# Test 74: Idle and least recently used sessions are evicted
+def test_conversation_memory_eviction():
+    memory = rag_burnbot.ConversationMemory(max_sessions=2, idle_seconds=60)
+    memory.record("a", "q", "a")
+    memory.record("b", "q", "a")
+    memory.render("a")
+    memory.record("c", "q", "a")
+    assert memory.render("b") == "" and memory.render("a") != ""
+    with patch("rag_burnbot.time.monotonic", return_value=time.monotonic() + 120):
+        assert memory.render("a") == ""
+    assert memory.stats()["evictions"] == 2
+
+# Test 75: Follow-ups carry history into the prompt and skip the shared answer cache
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_rag_service_follow_up(mock_encode, tmp_path):
+    (tmp_path / "doc.txt").write_text("Swimming is low impact.\n\nYoga with Anvita.")
+    cache = MagicMock(**{"lookup.return_value": None, "lookup_text.return_value": None})
+    service = rag_burnbot.RAGService(str(tmp_path), index_dir=None, answer_cache=cache)
+    prompts = []
+
+    def respond(context, query, history="", profile=""):
+        prompts.append(history)
+        return f"answer to {query}"
+
+    with patch("rag_burnbot.gemini_response", side_effect=respond):
+        service.answer("is swimming good?", "s1")
+        service.answer("how often?", "s1")
+        service.answer("how often?", "s2")
+    assert prompts[0] == ""
+    assert "User: is swimming good?" in prompts[1]
+    assert prompts[2] == ""
+    assert cache.store.call_count == 2
+    service.answer("reset", "s1")
+    assert service.memory.render("s1") == ""
+
+# Test 76: The user's fitness summary goes into the prompt ahead of the context, within budget
+def test_build_prompt_with_profile():
+    profile = "Last 7 days: 9000 kcal eaten, 1200 kcal burned, 5000 ml water.\n" + "filler " * 500
+    prompt = rag_burnbot.build_prompt(["Rice has 200 calories."], "how did I do this week?",
+                                      token_budget=400, profile=profile)
+    assert "About the user" in prompt and "9000 kcal eaten" in prompt
+    assert prompt.index("About the user") < prompt.index("Context:")
+    assert rag_burnbot.estimate_tokens(prompt) <= 400
+    assert "About the user" not in rag_burnbot.build_prompt(["Rice has 200 calories."], "rice?")
+    assert rag_burnbot.is_personal_query("How did I do this week?")
+    assert rag_burnbot.is_personal_query("what's my water intake")
+    assert not rag_burnbot.is_personal_query("is swimming good cardio?")
+    assert rag_burnbot.is_personal_query("how many calories did I burn yesterday")
+    assert not rag_burnbot.is_personal_query("how many calories should I eat")
+    assert not rag_burnbot.is_personal_query("what should I eat before a workout")
+
+# Test 77: Personal answers use the profile and never touch the shared answer cache
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_rag_service_profile(mock_encode, tmp_path):
+    (tmp_path / "doc.txt").write_text("Swimming is low impact.\n\nYoga with Anvita.")
+    cache = MagicMock(**{"lookup.return_value": None, "lookup_text.return_value": None})
+    service = rag_burnbot.RAGService(str(tmp_path), index_dir=None, answer_cache=cache)
+    profiles = []
+
+    def respond(context, query, history="", profile=""):
+        profiles.append(profile)
+        return f"answer to {query}"
+
+    with patch("rag_burnbot.gemini_response", side_effect=respond):
+        service.answer("how much water did i drink?", profile="Today: 500 ml water")
+    with patch("rag_burnbot.gemini_response_stream", side_effect=lambda *a, **kw: iter(
+            [respond(*a, **kw)])):
+        assert "".join(service.answer_stream("my calories?", profile="Today: 1800 kcal")) == \
+            "answer to my calories?"
+    assert profiles == ["Today: 500 ml water", "Today: 1800 kcal"]
+    cache.lookup.assert_not_called()
+    cache.store.assert_not_called()
+
+# Test 78: The thread budget is a fixed number or the cores split between the web workers
+def test_cpu_thread_budget():
+    assert rag_burnbot.cpu_thread_budget("3", workers=4, cpus=16) == 3
+    assert rag_burnbot.cpu_thread_budget("0", workers=4, cpus=16) == 0
+    assert rag_burnbot.cpu_thread_budget("auto", workers=4, cpus=16) == 4
+    assert rag_burnbot.cpu_thread_budget("AUTO", workers=8, cpus=4) == 1
+
+# Test 79: Applying the budget sizes FAISS's OpenMP pool and the tokenizers' pool
+def test_cpu_threads_apply(monkeypatch):
+    before = faiss.omp_get_max_threads()
+    monkeypatch.delenv("RAYON_NUM_THREADS", raising=False)
+    monkeypatch.delenv("TOKENIZERS_PARALLELISM", raising=False)
+    threads = rag_burnbot.CPUThreads(1)
+    try:
+        threads.apply()
+        assert faiss.omp_get_max_threads() == 1
+        assert os.environ["RAYON_NUM_THREADS"] == "1"
+        assert os.environ["TOKENIZERS_PARALLELISM"] == "false"
+        assert threads.stats()["budget"] == 1
+        rag_burnbot.CPUThreads(0).apply()
+        assert faiss.omp_get_max_threads() == 1
+    finally:
+        faiss.omp_set_num_threads(before)
+
+# Test 80: A half-open trial turned away because every slot is busy lets the next call try
+def test_breaker_trial_rejected_as_busy():
+    breaker = rag_burnbot.CircuitBreaker(failure_threshold=1, reset_seconds=0.01)
+    generator = rag_burnbot.Generator(rag_burnbot.StubBackend(latency=0.3), timeout=0.05,
+                                      max_concurrency=1, slot_wait=0.01, breaker=breaker)
+    with pytest.raises(rag_burnbot.GenerationUnavailable):
+        generator.generate("Context: Walk daily.\n\nQuery: tips")
+    time.sleep(0.02)
+    with pytest.raises(rag_burnbot.GenerationUnavailable, match="busy"):
+        generator.generate("Context: Walk daily.\n\nQuery: tips")
+    time.sleep(0.3)
+    generator.backend.latency = 0
+    assert generator.generate("Context: Walk daily.\n\nQuery: tips").startswith("According to")
+    assert breaker.state == "closed"
+
+# Test 81: A stream closed early by the client does not hold on to the half-open trial
+def test_breaker_trial_stream_closed_early():
+    breaker = rag_burnbot.CircuitBreaker(failure_threshold=1, reset_seconds=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    generator = rag_burnbot.Generator(rag_burnbot.StubBackend(latency=0), breaker=breaker)
+    stream = generator.generate_stream("Context: Walk daily. Stretch after.\n\nQuery: tips")
+    next(stream)
+    stream.close()
+    assert breaker.allow()
+
+# Test 82: Only follow-ups carry history; standalone questions in a session keep the shared caches
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_rag_service_standalone_question_in_session(mock_encode, tmp_path):
+    (tmp_path / "doc.txt").write_text("Swimming is low impact.\n\nYoga with Anvita.")
+    service = rag_burnbot.RAGService(str(tmp_path), index_dir=None,
+                                     answer_cache=MagicMock(**{"lookup.return_value": None, "lookup_text.return_value": None}))
+    service.single_flight = MagicMock(wraps=service.single_flight)
+    prompts = []
+
+    def respond(context, query, history="", profile=""):
+        prompts.append(history)
+        return f"answer to {query}"
+
+    with patch("rag_burnbot.gemini_response", side_effect=respond):
+        service.answer("is swimming good for the knees?", "s1")
+        service.answer("who teaches the yoga classes?", "s1")
+        service.answer("is it good for beginners?", "s1")
+    assert prompts[:2] == ["", ""]
+    assert "User: who teaches the yoga classes?" in prompts[2]
+    assert service.single_flight.do.call_count == 2
+    assert rag_burnbot.is_follow_up("how often?")
+    assert rag_burnbot.is_follow_up("Why?")
+    assert rag_burnbot.is_follow_up("what about swimming")
+    assert not rag_burnbot.is_follow_up("what is hiit training")
+    for query in ("best cardio", "yoga benefits", "menu please", "hiit"):
+        assert not rag_burnbot.is_follow_up(query)
+
+# Test 83: Batch questions not started before the deadline come back unanswered
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_answer_batch_deadline(mock_encode):
+    chunks = ["Yoga with Anvita.", "Swimming is low impact."]
+    index, _ = build_faiss_index(chunks)
+
+    def slow(context, query):
+        time.sleep(0.05)
+        return f"answer to {query}"
+
+    with patch("rag_burnbot.gemini_response", side_effect=slow):
+        results, stats = rag_burnbot.answer_batch(["Q1", "Q2", "Q3"], index, chunks,
+                                                  concurrency=1, deadline=0.01)
+    assert results[0]["answer"] == "answer to q1"
+    assert [r["answer"] for r in results[1:]] == [None, None]
+    assert stats["unanswered"] == 2 and stats["generated"] == 1
+
+# Test 84: Served short keyword queries skip the encoder: no centroids, text-keyed cache, no FAISS
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_bot_response_lexical_only_skips_encoder(mock_encode):
+    chunks = ["Oatmeal has 150 calories per cup.", "Swimming is low impact cardio."]
+    lexical = rag_burnbot.BM25Index(chunks)
+    cache = rag_burnbot.SemanticAnswerCache()
+    router = rag_burnbot.IntentRouter()
+    with patch("rag_burnbot.gemini_response", side_effect=lambda context, q, **kw: context[0]) as mock_gemini:
+        answer = bot_response("swimming", None, chunks, cache, lexical=lexical, router=router)
+        assert bot_response("Swimming ", None, chunks, cache, lexical=lexical, router=router) == answer
+    assert answer == "Swimming is low impact cardio."
+    assert mock_gemini.call_count == 1
+    mock_encode.assert_not_called()
+    assert cache.stats()["hits"] == 1
+
+    index, _ = build_faiss_index(chunks)
+    with patch("rag_burnbot.gemini_response", return_value="Start slowly."):
+        bot_response("how do i start swimming laps", index, chunks, cache, lexical=lexical)
+    assert mock_encode.called
+
+# Test 90: Text-keyed answers share the cache's version, TTL and eviction rules
+def test_semantic_answer_cache_text_lookup():
+    cache = rag_burnbot.SemanticAnswerCache(max_entries=2, ttl=60, max_distance=0.05)
+    vector = np.eye(1, 384, dtype="float32")[0]
+    cache.store(None, "Swim twice a week.", corpus_version=1, text="swimming")
+    cache.store(vector, "Stretch daily.", corpus_version=1, text="stretching tips")
+    assert cache.lookup_text("swimming", 1) == "Swim twice a week."
+    assert cache.lookup_text("stretching tips", 1) == "Stretch daily."
+    assert cache.lookup(vector, 1) == "Stretch daily."
+    cache.store(None, "Rest on Sundays.", corpus_version=1, text="rest days")
+    assert cache.lookup_text("swimming", 1) is None
+    assert cache.lookup_text("swimming", 2) is None
+    assert cache.lookup(vector, 2) is None
+
+# Test 85: Cached text of renamed and deleted documents is removed on the next sync
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_sync_prunes_text_cache(mock_encode, tmp_path):
+    corpus_dir = tmp_path / "corpus"
+    corpus_dir.mkdir()
+    for name in ("guide.docx", "plans.docx"):
+        doc = Document()
+        doc.add_paragraph(f"Text of {name}.")
+        doc.save(corpus_dir / name)
+    cache_dir = tmp_path / "text"
+    corpus = rag_burnbot.CorpusIndex()
+    corpus.sync(str(corpus_dir), str(cache_dir))
+    assert len(os.listdir(cache_dir)) == 2
+    os.rename(corpus_dir / "guide.docx", corpus_dir / "basics.docx")
+    os.remove(corpus_dir / "plans.docx")
+    stats = corpus.sync(str(corpus_dir), str(cache_dir))
+    assert stats["text_pruned"] == 2
+    assert os.listdir(cache_dir) == [
+        os.path.basename(rag_burnbot.extract_cache_path(str(corpus_dir / "basics.docx"), str(cache_dir)))
+    ]
+
+# Test 86: Streams run on the chat pool, are shed when it is full and stop when the client goes away
+def test_chat_pool_stream():
+    pool = rag_burnbot.ChatWorkerPool(workers=1, queue_limit=0, queue_timeout=5)
+    assert list(pool.stream(lambda words: iter(words), ["a", "b"])) == ["a", "b"]
+    while pool.stats()["completed"] < 1:
+        time.sleep(0.01)
+
+    produced = []
+    stopped = threading.Event()
+
+    def endless():
+        try:
+            while True:
+                produced.append(len(produced))
+                yield "piece"
+                time.sleep(0.01)
+        finally:
+            stopped.set()
+
+    pieces = pool.stream(endless)
+    assert next(pieces) == "piece"
+    with pytest.raises(rag_burnbot.ChatOverloaded):
+        pool.stream(endless)
+    pieces.close()
+    assert stopped.wait(5)
+    count = len(produced)
+    time.sleep(0.05)
+    assert len(produced) == count
+    stats = pool.stats()
+    assert stats["streams"] == 2 and stats["rejected"] == 1
+
+# Test 87: Identical streams in flight share the leader's pieces, even if the leader leaves early
+def test_single_flight_stream_shares_pieces():
+    flight = rag_burnbot.SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def answer(query):
+        calls.append(query)
+        yield "Yoga "
+        release.wait(5)
+        yield "helps "
+        yield "flexibility."
+
+    leader = flight.stream("yoga", answer, "yoga")
+    assert next(leader) == "Yoga "
+    results = []
+    followers = [
+        threading.Thread(target=lambda: results.append("".join(flight.stream("yoga", answer, "yoga"))))
+        for _ in range(3)
+    ]
+    for thread in followers:
+        thread.start()
+    while flight.stats()["shared"] < 3:
+        time.sleep(0.01)
+    release.set()
+    leader.close()
+    for thread in followers:
+        thread.join(5)
+    assert results == ["Yoga helps flexibility."] * 3
+    assert calls == ["yoga"]
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "shared": 3}
+    assert "".join(flight.stream("yoga", answer, "yoga")) == "Yoga helps flexibility."
+    assert len(calls) == 2
+
+# Test 88: The service streams identical questions from one generation
+@patch("rag_burnbot.gemini_response_stream")
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_answer_stream_single_flight(mock_encode, mock_stream, tmp_path):
+    (tmp_path / "guide.txt").write_text("Running builds stamina.\n", encoding="utf-8")
+    release = threading.Event()
+
+    def stream(context, query, history="", profile=""):
+        yield "Running "
+        release.wait(5)
+        yield "builds stamina."
+
+    mock_stream.side_effect = stream
+    service = rag_burnbot.RAGService(str(tmp_path), index_dir=None, router=rag_burnbot.IntentRouter(examples={}))
+    service.router.classify = lambda query, centroids=True: ("question", {})
+    first = service.answer_stream("What does running build?")
+    assert next(first) == "Running "
+    second = service.answer_stream("what does running build?")
+    results = []
+    thread = threading.Thread(target=lambda: results.append("".join(second)))
+    thread.start()
+    while service.single_flight.stats()["shared"] < 1:
+        time.sleep(0.01)
+    release.set()
+    assert "Running " + "".join(first) == "Running builds stamina."
+    thread.join(5)
+    assert results == ["Running builds stamina."]
+    assert mock_stream.call_count == 1
+
+# Test 89: Menu, greetings and local handlers answer before the index is loaded
+def test_routed_answers_skip_the_index(tmp_path):
+    service = rag_burnbot.RAGService(str(tmp_path), index_dir=str(tmp_path / "index"), prebuilt_only=True)
+    service.router.register("calories", lambda query, slots: f"{slots['food']} has 105 kcal.")
+    assert service.answer("menu") == rag_burnbot.menu_message()
+    assert service.answer("Hello!").startswith("Hi! I am BurnBot")
+    assert "".join(service.answer_stream("calories in banana", "s1")) == "banana has 105 kcal."
+    assert service._snapshot is None
+    with pytest.raises(FileNotFoundError):
+        service.answer("what is hiit")
+
+# Test 91: The stream deadline covers the first piece and each gap, not the whole answer
+def test_generate_stream_deadline_per_piece():
+    prompt = "Context: Walk every day for thirty minutes at a brisk pace.\n\nQuery: tips"
+    generator = rag_burnbot.Generator(rag_burnbot.StubBackend(latency=0, token_delay=0.03), timeout=0.15)
+    assert "".join(generator.generate_stream(prompt)) == rag_burnbot.StubBackend.answer_for(prompt)
+    assert generator.stats()["succeeded"] == 1 and "timeouts" not in generator.stats()
+
+    generator.backend = rag_burnbot.StubBackend(latency=0.5)
+    with pytest.raises(rag_burnbot.GenerationUnavailable):
+        list(generator.generate_stream(prompt))
+    assert generator.stats()["timeouts"] == 1
+
+# Test 92: A fresh build is served memory-mapped from its artifact, and concurrent builds embed once
+@patch("rag_burnbot.embedding_model.encode", side_effect=fake_encode)
+def test_load_or_build_index_shares_one_build(mock_encode, tmp_path):
+    corpus_dir = tmp_path / "corpus"
+    corpus_dir.mkdir()
+    (corpus_dir / "doc.txt").write_text("Squats build leg strength.")
+    index_dir = str(tmp_path / "index")
+    with patch("rag_burnbot.faiss.read_index", wraps=faiss.read_index) as mock_read:
+        corpus = rag_burnbot.load_or_build_index(str(corpus_dir), index_dir)
+    mock_read.assert_called_once()
+    assert mock_read.call_args[0][1] == rag_burnbot.FAISS_MMAP_FLAGS
+    assert list(corpus.chunks.values()) == ["Squats build leg strength."]
+
+    (corpus_dir / "doc.txt").write_text("Lunges build leg strength.")
+    calls = mock_encode.call_count
+    built = []
+    workers = [
+        threading.Thread(target=lambda: built.append(rag_burnbot.load_or_build_index(str(corpus_dir), index_dir)))
+        for _ in range(3)
+    ]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join(10)
+    assert [list(c.chunks.values()) for c in built] == [["Lunges build leg strength."]] * 3
+    assert mock_encode.call_count == calls + 1
+
+# Test 93: Tokenizer settings from the environment are kept and parallelism is never forced on
+def test_cpu_threads_keep_operator_settings(monkeypatch):
+    before = faiss.omp_get_max_threads()
+    monkeypatch.delenv(rag_burnbot.CPUThreads.OWNED_ENV, raising=False)
+    monkeypatch.setenv("RAYON_NUM_THREADS", "3")
+    monkeypatch.setenv("TOKENIZERS_PARALLELISM", "true")
+    try:
+        rag_burnbot.CPUThreads(1).apply()
+        assert os.environ["RAYON_NUM_THREADS"] == "3"
+        assert os.environ["TOKENIZERS_PARALLELISM"] == "true"
+        monkeypatch.delenv("RAYON_NUM_THREADS")
+        monkeypatch.delenv("TOKENIZERS_PARALLELISM")
+        rag_burnbot.CPUThreads(2).apply()
+        assert os.environ["RAYON_NUM_THREADS"] == "2"
+        assert "TOKENIZERS_PARALLELISM" not in os.environ
+        # A child process inherits the values this one set and may still change them
+        rag_burnbot.CPUThreads(1).apply()
+        assert os.environ["RAYON_NUM_THREADS"] == "1"
+        assert os.environ["TOKENIZERS_PARALLELISM"] == "false"
+    finally:
+        faiss.omp_set_num_threads(before)
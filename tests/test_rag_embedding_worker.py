@@ -0,0 +1,94 @@
+"""
+  Copyright (c) 2025 Hank Lenham, Ryan McPhee, Lawrence Stephenson
+  This code is licensed under MIT license (see LICENSE for details)
+
+  This file tests the functions in rag_embedding_worker.py
+
+  For more information about the Burnout project, visit:
+  https://github.com/CSC510-Spring25-Group14/FitnessApp
+"""
+
+import os
+import stat
+import threading
+import numpy as np
+import pytest
+from rag_embedding_worker import AUTHKEY_ENV, EmbeddingWorkerClient, main, serve
+
+
+class FakeModel:
+  def get_sentence_embedding_dimension(self):
+    return 4
+
+  def encode(self, texts):
+    if "fail" in texts:
+      raise ValueError("cannot encode")
+    return np.array([[len(t), 1, 2, 3] for t in texts], dtype="float32")
+
+
+@pytest.fixture
+def worker(tmp_path):
+  address = str(tmp_path / "embed.sock")
+  ready = threading.Event()
+  threading.Thread(target=serve, args=(address, b"secret"),
+                   kwargs={"model": FakeModel(), "ready": ready}, daemon=True).start()
+  assert ready.wait(5)
+  return address
+
+
+def test_client_encodes_in_slices(worker):
+  """
+    Test vectors come back in order through shared memory, across several slices
+  """
+  client = EmbeddingWorkerClient(worker, b"secret", max_batch=2).connect()
+  try:
+    vectors = client.encode(["a", "bb", "ccc", "dddd", "eeeee"])
+    assert vectors.shape == (5, 4)
+    assert list(vectors[:, 0]) == [1, 2, 3, 4, 5]
+    assert client.encode("single").shape == (4,)
+    assert client.get_sentence_embedding_dimension() == 4
+  finally:
+    client.close()
+
+
+def test_client_reports_worker_errors(worker):
+  """
+    Test an encode failure in the worker is raised in the client, which keeps working
+  """
+  client = EmbeddingWorkerClient(worker, b"secret").connect()
+  try:
+    with pytest.raises(RuntimeError):
+      client.encode(["fail"])
+    assert client.encode(["ok"]).shape == (1, 4)
+  finally:
+    client.close()
+
+
+def test_client_needs_the_authkey(worker):
+  """
+    Test clients without the shared key are refused
+  """
+  with pytest.raises(Exception):
+    EmbeddingWorkerClient(worker, b"wrong").connect()
+
+
+def test_socket_is_private(worker):
+  """
+    Test the worker socket is only accessible to its owner
+  """
+  assert stat.S_IMODE(os.stat(worker).st_mode) == 0o600
+
+
+def test_authkey_is_required(tmp_path, monkeypatch):
+  """
+    Test neither the sidecar nor a client runs without the shared key
+  """
+  monkeypatch.delenv(AUTHKEY_ENV, raising=False)
+  address = str(tmp_path / "embed.sock")
+  with pytest.raises(SystemExit):
+    main([address])
+  with pytest.raises(ValueError):
+    serve(address, None, model=FakeModel())
+  with pytest.raises(ValueError):
+    EmbeddingWorkerClient(address, None)
+  assert not os.path.exists(address)
@@ -0,0 +1,143 @@
+"""
+  Copyright (c) 2025 Hank Lenham, Ryan McPhee, Lawrence Stephenson
+  This code is licensed under MIT license (see LICENSE for details)
+
+  This file tests the functions in user_summary.py
+
+  For more information about the Burnout project, visit:
+  https://github.com/CSC510-Spring25-Group14/FitnessApp
+"""
+
+from datetime import date, datetime, timedelta
+import mongomock
+import pytest
+from user_summary import (
+  ensure_summary_index, get_summary, rebuild_summary, render_summary, record_calories,
+  record_water, record_enrolled, record_unenrolled, record_completed, invalidate_summary,
+  SUMMARY_DAYS,
+)
+
+EMAIL = "mpartha@gmail.com"
+
+
+@pytest.fixture
+def db():
+  db = mongomock.MongoClient().test
+  ensure_summary_index(db)
+  return db
+
+
+def day(offset=0):
+  return (date.today() - timedelta(days=offset)).strftime("%Y-%m-%d")
+
+
+def test_get_summary_builds_from_source_collections(db):
+  """
+    Test a missing summary is built from calories, water, activities and achievements
+  """
+  db.calories.insert_many([
+    {"email": EMAIL, "date": day(), "calories": 1800, "burnout": 300},
+    {"email": EMAIL, "date": day(1), "calories": 2100, "burnout": 0},
+    {"email": EMAIL, "date": day(SUMMARY_DAYS), "calories": 5000, "burnout": 0},
+    {"email": "other@gmail.com", "date": day(), "calories": 999, "burnout": 9},
+  ])
+  db.intake_collection.insert_one({"email": EMAIL, "intake": "500", "time": datetime.now()})
+  db.user_activity.insert_many([
+    {"Email": EMAIL, "Activity": "yoga", "Status": "Enrolled", "Date": day()},
+    {"Email": EMAIL, "Activity": "swim", "Status": "Completed", "Date": day(2)},
+  ])
+  db.achievements.insert_one({"Email": EMAIL, "Name": "Yogi", "Date": day(3)})
+
+  summary = get_summary(EMAIL, db)
+  assert summary["days"] == {
+    day(): {"calories": 1800, "burnout": 300, "water": 500},
+    day(1): {"calories": 2100, "burnout": 0},
+  }
+  assert summary["enrolled"] == ["yoga"]
+  assert summary["completed"] == ["swim"]
+  assert summary["achievements"] == [{"name": "Yogi", "date": day(3)}]
+  assert db.user_summary.count_documents({"email": EMAIL}) == 1
+
+
+def test_record_updates_summary_in_place(db):
+  """
+    Test writes are applied to an existing summary without rereading the sources
+  """
+  rebuild_summary(EMAIL, db)
+  record_calories(EMAIL, db, 400, "150")
+  record_calories(EMAIL, db, 600, 50)
+  record_water(EMAIL, db, "250", datetime.now())
+  record_enrolled(EMAIL, db, "yoga")
+  record_enrolled(EMAIL, db, "swim")
+  record_enrolled(EMAIL, db, "yoga")
+  record_unenrolled(EMAIL, db, "swim")
+  record_completed(EMAIL, db, "yoga", {"name": "Yogi", "description": "First yoga class"})
+
+  summary = get_summary(EMAIL, db)
+  assert summary["days"][day()] == {"calories": 1000, "burnout": 200, "water": 250}
+  assert summary["enrolled"] == []
+  assert summary["completed"] == ["yoga"]
+  assert summary["achievements"] == [{"name": "Yogi", "date": day()}]
+
+
+def test_record_drops_days_outside_window(db):
+  """
+    Test recording a day prunes totals older than the summary window
+  """
+  db.user_summary.insert_one({"email": EMAIL, "days": {day(SUMMARY_DAYS + 3): {"calories": 10}}})
+  record_calories(EMAIL, db, 100, 0)
+  assert list(get_summary(EMAIL, db)["days"]) == [day()]
+
+
+def test_record_without_summary_waits_for_rebuild(db):
+  """
+    Test writes for a user without a summary leave it to be built on the next read
+  """
+  record_calories(EMAIL, db, 100, 0)
+  assert db.user_summary.count_documents({}) == 0
+
+
+def test_invalidate_summary_rebuilds_on_read(db):
+  """
+    Test an invalidated summary is rebuilt from the sources
+  """
+  db.intake_collection.insert_one({"email": EMAIL, "intake": "500", "time": datetime.now()})
+  assert get_summary(EMAIL, db)["days"][day()]["water"] == 500
+  db.intake_collection.delete_many({"email": EMAIL})
+  invalidate_summary(EMAIL, db)
+  assert get_summary(EMAIL, db)["days"] == {}
+
+
+def test_render_summary():
+  """
+    Test the summary renders totals, daily lines, activities and achievements
+  """
+  today = date(2025, 4, 10)
+  summary = {
+    "days": {
+      "2025-04-10": {"calories": 1800, "burnout": 300, "water": 500},
+      "2025-04-09": {"calories": 2000},
+      "2025-04-01": {"calories": 9999},
+    },
+    "enrolled": ["yoga", "swim"],
+    "completed": ["hiit"],
+    "achievements": [{"name": "Yogi", "date": "2025-04-08"}],
+  }
+  text = render_summary(summary, today)
+  assert text.splitlines() == [
+    "Today is 2025-04-10.",
+    f"Last {SUMMARY_DAYS} days: 3800 kcal eaten, 300 kcal burned, 500 ml water.",
+    "2025-04-09: 2000 kcal eaten, 0 kcal burned, 0 ml water",
+    "2025-04-10: 1800 kcal eaten, 300 kcal burned, 500 ml water",
+    "Enrolled in: yoga, swim.",
+    "Recently completed: hiit.",
+    "Latest achievements: Yogi (2025-04-08).",
+  ]
+
+
+def test_render_empty_summary():
+  """
+    Test a user with no data gets a short note instead of totals
+  """
+  text = render_summary({"days": {}}, date(2025, 4, 10))
+  assert "No calories, burnout or water logged" in text
@@ -0,0 +1,203 @@
+"""
+Copyright (c) 2025 Hank Lenham, Ryan McPhee, Lawrence Stephenson
+This code is licensed under MIT license (see LICENSE for details)
+
+@author: Burnout
+
+
+This python file is used in and is part of the Burnout project.
+It keeps one small summary document per user in the user_summary collection
+(daily calorie, burnout and water totals for the last few days, enrolled and
+recently completed activities, latest achievements), so BurnBot can answer
+questions about the user's own progress with a single indexed read instead
+of running the insights aggregations on every chat message.
+
+The summary is updated in place by the routes that write the underlying
+data. When it is missing, for example for users who signed up before it
+existed or after a change that cannot be applied incrementally, it is
+rebuilt from the source collections on the next read.
+
+For more information about the Burnout project, visit:
+https://github.com/CSC510-Spring25-Group14/FitnessApp
+"""
+
+from datetime import date, datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# Days of calorie, burnout and water totals kept in a summary
+SUMMARY_DAYS = 7
+# Completed activities and achievements kept in a summary, newest last
+SUMMARY_RECENT = 5
+# Seconds a session keeps its rendered summary before reading it again
+SUMMARY_CACHE_SECONDS = 300
+
+
+def ensure_summary_index(db):
+    """
+    Creates the unique index on email that every summary read and update uses.
+    """
+    db.user_summary.create_index("email", unique=True)
+
+
+def _day(day=None):
+    return (day or date.today()).strftime("%Y-%m-%d")
+
+
+def _window_start(today=None):
+    return _day((today or date.today()) - timedelta(days=SUMMARY_DAYS - 1))
+
+
+def _record_day(email, db, totals, day=None):
+    """
+    Adds totals ({"calories": n, ...}) to one day of the summary and drops
+    days that have left the window. Does nothing if the user has no summary
+    yet, the next read builds it from the source collections instead.
+    """
+    day = _day(day)
+    summary = db.user_summary.find_one_and_update(
+        {"email": email},
+        {"$inc": {f"days.{day}.{field}": amount for field, amount in totals.items()}},
+        projection={"days": True},
+        return_document=ReturnDocument.AFTER,
+    )
+    if summary is None:
+        return
+    start = _window_start()
+    stale = {f"days.{old}": "" for old in summary.get("days", {}) if old < start}
+    if stale:
+        db.user_summary.update_one({"email": email}, {"$unset": stale})
+
+
+def record_calories(email, db, calories, burnout, day=None):
+    _record_day(email, db, {"calories": int(calories), "burnout": int(burnout)}, day)
+
+
+def record_water(email, db, intake, day=None):
+    _record_day(email, db, {"water": int(intake)}, day)
+
+
+def record_enrolled(email, db, activity):
+    db.user_summary.update_one({"email": email}, {"$addToSet": {"enrolled": activity}})
+
+
+def record_unenrolled(email, db, activity):
+    db.user_summary.update_one({"email": email}, {"$pull": {"enrolled": activity}})
+
+
+def record_completed(email, db, activity, achievement=None):
+    """
+    Moves activity from enrolled to the recently completed list and keeps the
+    achievement it earned, if any, with the latest achievements.
+    """
+    update = {
+        "$pull": {"enrolled": activity},
+        "$push": {"completed": {"$each": [activity], "$slice": -SUMMARY_RECENT}},
+    }
+    if achievement is not None:
+        update["$push"]["achievements"] = {
+            "$each": [{"name": achievement["name"], "date": _day()}],
+            "$slice": -SUMMARY_RECENT,
+        }
+    db.user_summary.update_one({"email": email}, update)
+
+
+def invalidate_summary(email, db):
+    """
+    Drops the summary after a change that cannot be applied incrementally,
+    such as clearing the water log; it is rebuilt on the next read.
+    """
+    db.user_summary.delete_one({"email": email})
+
+
+def rebuild_summary(email, db, today=None):
+    """
+    Builds the summary from the calories, water, activity and achievement
+    collections and stores it.
+    """
+    start = _window_start(today)
+    days = {}
+    for entry in db.calories.find({"email": email, "date": {"$gte": start}}):
+        totals = days.setdefault(entry["date"], {})
+        totals["calories"] = totals.get("calories", 0) + int(entry.get("calories", 0))
+        totals["burnout"] = totals.get("burnout", 0) + int(entry.get("burnout", 0))
+    since = datetime.strptime(start, "%Y-%m-%d")
+    for entry in db.intake_collection.find({"email": email, "time": {"$gte": since}}):
+        totals = days.setdefault(_day(entry["time"]), {})
+        totals["water"] = totals.get("water", 0) + int(entry["intake"])
+
+    enrolled = [
+        entry["Activity"]
+        for entry in db.user_activity.find({"Email": email, "Status": "Enrolled"})
+    ]
+    completed = [
+        entry["Activity"]
+        for entry in db.user_activity.find({"Email": email, "Status": "Completed"})
+        .sort("Date", -1).limit(SUMMARY_RECENT)
+    ]
+    achievements = [
+        {"name": entry.get("Name", "Unknown"), "date": entry.get("Date", "Unknown")}
+        for entry in db.achievements.find({"Email": email}).sort("Date", -1).limit(SUMMARY_RECENT)
+    ]
+    summary = {
+        "email": email,
+        "days": days,
+        "enrolled": enrolled,
+        "completed": completed[::-1],
+        "achievements": achievements[::-1],
+    }
+    try:
+        db.user_summary.replace_one({"email": email}, summary, upsert=True)
+    except DuplicateKeyError:
+        # Another request built the same summary at the same time
+        pass
+    return summary
+
+
+def get_summary(email, db):
+    """
+    Returns the user's summary with one read, building it first if needed.
+    """
+    summary = db.user_summary.find_one({"email": email})
+    if summary is None:
+        summary = rebuild_summary(email, db)
+    return summary
+
+
+def render_summary(summary, today=None):
+    """
+    Formats a summary as a few short lines for the BurnBot prompt.
+    """
+    today = today or date.today()
+    start = _window_start(today)
+    days = {
+        day: totals for day, totals in summary.get("days", {}).items()
+        if start <= day <= _day(today)
+    }
+    lines = [f"Today is {_day(today)}."]
+    if days:
+        total = {
+            field: sum(totals.get(field, 0) for totals in days.values())
+            for field in ("calories", "burnout", "water")
+        }
+        lines.append(
+            f"Last {SUMMARY_DAYS} days: {total['calories']} kcal eaten, "
+            f"{total['burnout']} kcal burned, {total['water']} ml water."
+        )
+        for day in sorted(days):
+            totals = days[day]
+            lines.append(
+                f"{day}: {totals.get('calories', 0)} kcal eaten, "
+                f"{totals.get('burnout', 0)} kcal burned, {totals.get('water', 0)} ml water"
+            )
+    else:
+        lines.append(f"No calories, burnout or water logged in the last {SUMMARY_DAYS} days.")
+    if summary.get("enrolled"):
+        lines.append("Enrolled in: " + ", ".join(summary["enrolled"]) + ".")
+    if summary.get("completed"):
+        lines.append("Recently completed: " + ", ".join(summary["completed"]) + ".")
+    if summary.get("achievements"):
+        lines.append("Latest achievements: " + ", ".join(
+            f"{achievement['name']} ({achievement['date']})" for achievement in summary["achievements"]
+        ) + ".")
+    return "\n".join(lines)